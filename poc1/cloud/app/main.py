@@ -1,4 +1,4 @@
-from fastapi import FastAPI, Request, status, BackgroundTasks, Response
+from fastapi import FastAPI, Request, status, BackgroundTasks, Response, HTTPException, Query
 import os
 from urllib.parse import unquote
 import logging
@@ -7,6 +7,12 @@ from fastapi.responses import StreamingResponse
 from starlette.background import BackgroundTask as StarletteBackgroundTask
 from usecase.point_cloud_usecase import PointCloudUsecase
 from usecase.stream_usecase import StreamUsecase
+from repository.point_cloud_repository import PointCloudRepository, delta_manifest_key, mesh_key_for_lod
+from repository.async_s3 import AsyncS3
+from repository.single_flight import SingleFlight
+from repository.negative_cache import NegativeCache
+from response import byte_range, conditional
+from typing import Mapping, Optional
 from datetime import timezone
 from prometheus_fastapi_instrumentator import Instrumentator
 
@@ -60,8 +66,15 @@ MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY", "minio_password")
 MINIO_SECURE = os.getenv("MINIO_SECURE", "false").lower() == "true"
      
 mc = Minio(MINIO_ENDPOINT, MINIO_ACCESS_KEY, MINIO_SECRET_KEY, secure=MINIO_SECURE)
+# GET /pointcloud・/mesh の stat・取得と webhook の取り込みのコピーは非同期アダプタで行う（S3_HTTP_* で接続数・タイムアウトを指定）
+async_s3 = AsyncS3(MINIO_ENDPOINT, MINIO_ACCESS_KEY, MINIO_SECRET_KEY, secure=MINIO_SECURE)
 
-def handle_record_sync(rec, mc: Minio):
+@app.on_event("shutdown")
+async def _close_s3():
+    await async_s3.aclose()
+
+# BackgroundTasks からイベントループ上で実行する（コピーは非同期アダプタで待つのでスレッドを使わない）
+async def handle_record(rec, mc: Minio):
     s3 = rec.get("s3", {})
     bucket = s3.get("bucket", {}).get("name")
     key = s3.get("object", {}).get("key")
@@ -72,7 +85,7 @@ def handle_record_sync(rec, mc: Minio):
         return
     key = unquote(key)
     
-    PointCloudUsecase(mc, s3).save(key)
+    await PointCloudUsecase(mc, s3, negative_cache, async_s3).save(key)
 
 @app.post("/minio/webhook")
 async def PCLocalAlignmentHandler(request: Request, background: BackgroundTasks):
@@ -83,37 +96,90 @@ async def PCLocalAlignmentHandler(request: Request, background: BackgroundTasks)
 
     records = body.get("Records", [body]) if isinstance(body, dict) else []
     for rec in records:
-        background.add_task(handle_record_sync, rec, mc)
+        background.add_task(handle_record, rec, mc)
 
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
+CLOUD_BUCKET = "cloud-point-cloud"
+# 同じオブジェクトへの同時の全体取得は MinIO からの読み出しを1本にまとめる
+single_flight = SingleFlight()
+# 無い geohash への GET /pointcloud を MinIO へ問い合わせずに 404 にする
+# （NEGATIVE_BLOOM=true ならバケット直下の geohash プレフィックスから Bloom filter を作る）
+negative_cache = NegativeCache(lambda: PointCloudRepository(mc).list_geohashes(CLOUD_BUCKET))
+
+# 転送はイベントループ上で行い、スレッドプールのスレッドを占有しない
 @app.get("/pointcloud/{geohash}")
-def get_city_model(geohash: str):
+async def get_city_model(geohash: str, request: Request):
+    if negative_cache.is_absent(geohash) or not negative_cache.may_exist(geohash):
+        raise HTTPException(status_code=404, detail="point cloud not found")
     key = f"{geohash}/{geohash}.ply"
-    obj, st = StreamUsecase(mc, key).stream()
+    try:
+        # 差分同期で届いた差分があれば base につなげて返す
+        return await _stream_response(key, f"{geohash}.ply", request.headers, delta_manifest_key(geohash))
+    except HTTPException as e:
+        if e.status_code == 404:
+            negative_cache.add(geohash)
+        raise
+
+@app.get("/mesh/{geohash}")
+async def get_city_mesh(geohash: str, request: Request, lod: Optional[int] = Query(None, ge=0)):
+    # エッジの同期で作られた LOD ピラミッドから1レベルを返す（lod 省略時は最も粗いレベル）
+    manifest = await StreamUsecase(async_s3, f"{geohash}/mesh/manifest.json").read_json()
+    key = mesh_key_for_lod(geohash, manifest, lod)
+    if key is None:
+        raise HTTPException(status_code=404, detail="mesh not found")
+    name = f"{geohash}-mesh.ply" if lod is None else f"{geohash}-mesh-lod{lod}.ply"
+    return await _stream_response(key, name, request.headers)
+
+async def _stream_response(key: str, filename: str, request_headers: Optional[Mapping[str, str]] = None, manifest_key: Optional[str] = None):
+    request_headers = request_headers or {}
+    obj, st = await StreamUsecase(async_s3, key).stream(manifest_key)
     
     # HTTPヘッダを整形
     last_modified = st.last_modified
     # MinIOのlast_modifiedはTZ付きdatetime想定
     if last_modified.tzinfo is None:
         last_modified = last_modified.replace(tzinfo=timezone.utc)
+    validators = {
+        "ETag": conditional.strong_etag(st.etag),
+        "Last-Modified": last_modified.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+    }
+    # 変わっていなければ stat だけで 304 を返す
+    if conditional.not_modified(
+        validators["ETag"], last_modified,
+        request_headers.get("If-None-Match"), request_headers.get("If-Modified-Since"),
+    ):
+        return Response(status_code=304, headers=validators)
+
     headers = {
         "Content-Length": str(st.size),
-        "Last-Modified": last_modified.strftime("%a, %d %b %Y %H:%M:%S GMT"),
-        "Content-Disposition": f'attachment; filename="{geohash}.ply"',
+        **validators,
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Accept-Ranges": "bytes",
     }
     
-    def _close():
+    async def _close(body):
         try:
-            obj.close()
+            await body.aclose()
         except Exception:
             pass
+    
+    # Range があれば ranged get で 206 を返す
+    ranges = byte_range.parse_range(request_headers.get("Range"), st.size)
+    if ranges is not None:
+        return byte_range.range_response(obj, ranges, st.size, headers, 32 * 1024, StarletteBackgroundTask(_close, obj))
+    
+    # 全体の取得は、同じオブジェクト（キー＋ETag）を読んでいる他のリクエストと1本の get_object を共有する
+    async def opener():
+        return obj, st, st.size
+
+    body, _ = await single_flight.open(f"{key}@{st.etag}", opener)
         
     return StreamingResponse(
-        obj.stream(32 * 1024),
+        body.astream(32 * 1024),
         media_type="application/octet-stream",
         headers=headers,
-        background=StarletteBackgroundTask(_close),
+        background=StarletteBackgroundTask(_close, body),
     )
     
 Instrumentator().instrument(app).expose(app)
\ No newline at end of file
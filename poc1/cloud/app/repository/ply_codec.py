@@ -0,0 +1,264 @@
+# PLY を一時ファイルを介さずに NumPy 配列と相互変換する（MinIO の get_object / put_object ストリームを直接扱う）
+import io
+import numpy as np
+import open3d as o3d
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+# PLY の型名 → NumPy の dtype 文字
+_PLY_TYPES = {
+    "char": "i1", "int8": "i1",
+    "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2",
+    "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4",
+    "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4",
+    "double": "f8", "float64": "f8",
+}
+_BYTE_ORDER = {"binary_little_endian": "<", "binary_big_endian": ">", "ascii": "<"}
+
+_HEADER_END = b"end_header"
+_READ_CHUNK = 1 << 20  # 1MB
+_MAX_HEADER = 64 * 1024
+
+# 書き出し時の1チャンクあたりの点数
+WRITE_CHUNK_POINTS = 64 * 1024
+
+
+# ヘッダを読み込み、(format, vertex数, [(property名, dtype文字)], ヘッダ直後に読みすぎた分) を返す
+def _read_header(stream: BinaryIO) -> Tuple[str, int, List[Tuple[str, str]], bytes]:
+    buf = b""
+    while True:
+        idx = buf.find(_HEADER_END)
+        if idx >= 0:
+            nl = buf.find(b"\n", idx)
+            if nl >= 0:
+                break
+        if len(buf) > _MAX_HEADER:
+            raise ValueError("ply header too large or end_header not found")
+        chunk = stream.read(4096)
+        if not chunk:
+            raise ValueError("unexpected end of stream while reading ply header")
+        buf += chunk
+    header, rest = buf[:nl + 1], buf[nl + 1:]
+
+    lines = header.decode("ascii", errors="replace").splitlines()
+    if not lines or lines[0].strip() != "ply":
+        raise ValueError("not a ply stream")
+
+    fmt = None
+    vertex_count = None
+    props: List[Tuple[str, str]] = []
+    current = None
+    for line in lines[1:]:
+        parts = line.split()
+        if not parts or parts[0] in ("comment", "obj_info"):
+            continue
+        if parts[0] == "format":
+            fmt = parts[1]
+        elif parts[0] == "element":
+            current = parts[1]
+            if current == "vertex":
+                vertex_count = int(parts[2])
+            elif vertex_count is None:
+                # vertex より前の要素はサイズを確定できないので非対応
+                raise ValueError(f"unsupported ply layout: element '{current}' before vertex")
+        elif parts[0] == "property" and current == "vertex":
+            if parts[1] == "list":
+                raise ValueError("unsupported ply layout: list property in vertex element")
+            if parts[1] not in _PLY_TYPES:
+                raise ValueError(f"unsupported ply property type: {parts[1]}")
+            props.append((parts[2], _PLY_TYPES[parts[1]]))
+        elif parts[0] == "end_header":
+            break
+
+    if fmt not in _BYTE_ORDER:
+        raise ValueError(f"unsupported ply format: {fmt}")
+    if vertex_count is None:
+        raise ValueError("ply has no vertex element")
+    return fmt, vertex_count, props, rest
+
+
+# PLY の先頭（ヘッダを含むバイト列）から (vertex の dtype, vertex数, ヘッダのバイト長) を返す
+#   binary little endian 以外（本体をそのままつなげられない）なら dtype は None
+def read_header_info(stream: BinaryIO) -> Tuple[Optional[np.dtype], int, int]:
+    head = io.BytesIO(stream.read(_MAX_HEADER))
+    fmt, count, props, rest = _read_header(head)
+    header_bytes = head.tell() - len(rest)
+    if fmt != "binary_little_endian":
+        return None, count, header_bytes
+    return np.dtype([(name, "<" + t) for name, t in props]), count, header_bytes
+
+
+# ちょうど nbytes を読み込む（途中で切れたらエラー）
+def _read_exact(stream: BinaryIO, nbytes: int, prefix: bytes) -> bytearray:
+    data = bytearray(nbytes)
+    view = memoryview(data)
+    n = min(len(prefix), nbytes)
+    view[:n] = prefix[:n]
+    while n < nbytes:
+        chunk = stream.read(min(nbytes - n, _READ_CHUNK))
+        if not chunk:
+            raise ValueError(f"truncated ply body: expected {nbytes} bytes, got {n}")
+        view[n:n + len(chunk)] = chunk
+        n += len(chunk)
+    return data
+
+
+def _columns(vertices: np.ndarray, names: Tuple[str, str, str]):
+    fields = vertices.dtype.names
+    if not all(n in fields for n in names):
+        return None
+    return np.stack([vertices[n] for n in names], axis=1)
+
+
+# ストリームから PLY を読み込み {"points", "colors", "normals"} の float64 配列を返す（無い属性は含めない）
+def read_ply(stream: BinaryIO) -> Dict[str, np.ndarray]:
+    fmt, count, props, rest = _read_header(stream)
+    order = _BYTE_ORDER[fmt]
+    dtype = np.dtype([(name, order + t) for name, t in props])
+
+    if fmt == "ascii":
+        body = rest + b"".join(iter(lambda: stream.read(_READ_CHUNK), b""))
+        ncols = len(props)
+        tokens = body.split(maxsplit=count * ncols)[:count * ncols]
+        if len(tokens) < count * ncols:
+            raise ValueError("truncated ascii ply body")
+        table = np.array(tokens, dtype=np.float64).reshape(count, ncols)
+        vertices = np.empty(count, dtype=dtype)
+        for i, (name, _) in enumerate(props):
+            vertices[name] = table[:, i]
+    else:
+        data = _read_exact(stream, count * dtype.itemsize, rest)
+        vertices = np.frombuffer(data, dtype=dtype, count=count)
+
+    arrays: Dict[str, np.ndarray] = {}
+    points = _columns(vertices, ("x", "y", "z"))
+    if points is None:
+        raise ValueError("ply vertex element has no x/y/z")
+    arrays["points"] = np.ascontiguousarray(points, dtype=np.float64)
+
+    colors = _columns(vertices, ("red", "green", "blue"))
+    if colors is not None:
+        if np.issubdtype(colors.dtype, np.integer):
+            colors = colors.astype(np.float64) / np.iinfo(colors.dtype).max
+        arrays["colors"] = np.ascontiguousarray(colors, dtype=np.float64)
+
+    normals = _columns(vertices, ("nx", "ny", "nz"))
+    if normals is not None:
+        arrays["normals"] = np.ascontiguousarray(normals, dtype=np.float64)
+    return arrays
+
+
+# NumPy 配列から Open3D の PointCloud を組み立てる
+def to_point_cloud(arrays: Dict[str, np.ndarray]) -> o3d.geometry.PointCloud:
+    pc = o3d.geometry.PointCloud()
+    if "points" not in arrays:
+        return pc
+    pc.points = o3d.utility.Vector3dVector(arrays["points"])
+    if "colors" in arrays:
+        pc.colors = o3d.utility.Vector3dVector(arrays["colors"])
+    if "normals" in arrays:
+        pc.normals = o3d.utility.Vector3dVector(arrays["normals"])
+    return pc
+
+
+# Open3D の PointCloud から {"points", "colors", "normals"} の配列を取り出す
+def from_point_cloud(pc: o3d.geometry.PointCloud) -> Dict[str, np.ndarray]:
+    arrays = {"points": np.asarray(pc.points)}
+    if pc.has_colors():
+        arrays["colors"] = np.asarray(pc.colors)
+    if pc.has_normals():
+        arrays["normals"] = np.asarray(pc.normals)
+    return arrays
+
+
+# 書き出し用の vertex dtype（常に binary little endian。座標は double、色は uchar、法線は float）
+def write_dtype(arrays: Dict[str, np.ndarray]) -> np.dtype:
+    fields = [("x", "<f8"), ("y", "<f8"), ("z", "<f8")]
+    if "normals" in arrays:
+        fields += [("nx", "<f4"), ("ny", "<f4"), ("nz", "<f4")]
+    if "colors" in arrays:
+        fields += [("red", "u1"), ("green", "u1"), ("blue", "u1")]
+    return np.dtype(fields)
+
+
+_PROPERTY_NAMES = {
+    "|i1": "char", "|u1": "uchar", "<i2": "short", "<u2": "ushort",
+    "<i4": "int", "<u4": "uint", "<f4": "float", "<f8": "double",
+}
+
+
+def ply_header(count: int, dtype: np.dtype) -> bytes:
+    lines = ["ply", "format binary_little_endian 1.0", f"element vertex {count}"]
+    for name in dtype.names:
+        lines.append(f"property {_PROPERTY_NAMES[dtype[name].str]} {name}")
+    lines.append("end_header")
+    return ("\n".join(lines) + "\n").encode("ascii")
+
+
+# dtype の各 property を埋める配列名と成分（x,y,z / nx,ny,nz / red,green,blue）
+_FIELD_SOURCES = {
+    "x": ("points", 0), "y": ("points", 1), "z": ("points", 2),
+    "nx": ("normals", 0), "ny": ("normals", 1), "nz": ("normals", 2),
+    "red": ("colors", 0), "green": ("colors", 1), "blue": ("colors", 2),
+}
+
+
+# arrays を dtype（既存の PLY の vertex 形式）で書き出せるか（dtype の property をすべて arrays から埋められるか）
+def can_encode_as(arrays: Dict[str, np.ndarray], dtype: np.dtype) -> bool:
+    return all(name in _FIELD_SOURCES and _FIELD_SOURCES[name][0] in arrays for name in dtype.names)
+
+
+def _fill_block(block: np.ndarray, arrays: Dict[str, np.ndarray], start: int, end: int):
+    for name in block.dtype.names:
+        src, col = _FIELD_SOURCES[name]
+        values = arrays[src][start:end, col]
+        if src == "colors" and np.issubdtype(block.dtype[name], np.integer):
+            values = np.rint(np.clip(values, 0.0, 1.0) * np.iinfo(block.dtype[name]).max)
+        block[name] = values
+
+
+# ヘッダ＋本体を WRITE_CHUNK_POINTS 点ずつのバイト列として順に返す（dtype を省略すると write_dtype の形式）
+def iter_ply_chunks(arrays: Dict[str, np.ndarray], chunk_points: int = WRITE_CHUNK_POINTS, dtype: Optional[np.dtype] = None) -> Iterator[bytes]:
+    dtype = dtype or write_dtype(arrays)
+    count = len(arrays["points"])
+    yield ply_header(count, dtype)
+    for start in range(0, count, chunk_points):
+        end = min(start + chunk_points, count)
+        block = np.empty(end - start, dtype=dtype)
+        _fill_block(block, arrays, start, end)
+        yield block.tobytes()
+
+
+def encoded_size(arrays: Dict[str, np.ndarray], dtype: Optional[np.dtype] = None) -> int:
+    dtype = dtype or write_dtype(arrays)
+    count = len(arrays["points"])
+    return len(ply_header(count, dtype)) + count * dtype.itemsize
+
+
+class PlyStream:
+    """チャンクのジェネレータを read() できるファイルライクにする（Minio.put_object 用）"""
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._buf = b""
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            data = self._buf + b"".join(self._chunks)
+            self._buf = b""
+            return data
+        while len(self._buf) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buf += chunk
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+
+# 配列を binary PLY にエンコードし、(ファイルライク, バイト長) を返す
+#   dtype を渡すとその vertex 形式で書く（既存の PLY の後ろに本体だけをつなげるため。can_encode_as で確かめてから使う）
+def encode_ply(arrays: Dict[str, np.ndarray], dtype: Optional[np.dtype] = None) -> Tuple[PlyStream, int]:
+    return PlyStream(iter_ply_chunks(arrays, dtype=dtype)), encoded_size(arrays, dtype)
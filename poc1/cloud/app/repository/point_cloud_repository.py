@@ -1,17 +1,51 @@
 from minio import Minio
 from minio.commonconfig import CopySource
 from minio.error import S3Error
+from datetime import datetime
+from typing import Dict, List, Optional
+from repository import ply_codec, quantized_codec
+from repository.async_s3 import AsyncS3
+import io, json, posixpath
+import numpy as np
+
+NOT_FOUND_CODES = ("NoSuchKey", "NoSuchObject", "NotFound")
+
+
+def point_cloud_key(geohash: str) -> str:
+  return f"{geohash}/{geohash}.ply"
+
+
+# 差分同期で届いた差分は {geohash}/deltas/ に別オブジェクトとして置き、manifest に base と並べて記録する
+#   GET /pointcloud は base の本体に差分の本体をつなげた1つの PLY を返す（stream_usecase）
+def delta_manifest_key(geohash: str) -> str:
+  return f"{geohash}/deltas/manifest.json"
+
+
+def delta_key(geohash: str, name: str) -> str:
+  return f"{geohash}/deltas/{name}"
+
+# {geohash}/mesh/manifest.json の内容から lod のオブジェクトキーを選ぶ（lod=None は最も粗いレベル。無ければ None）
+def mesh_key_for_lod(geohash: str, manifest: Optional[dict], lod: Optional[int]) -> Optional[str]:
+  if manifest is None:
+    return None
+  levels = {lv["lod"]: lv for lv in manifest.get("levels", [])}
+  if not levels:
+    return None
+  level = levels.get(max(levels) if lod is None else lod)
+  return f"{geohash}/mesh/{level['name']}" if level else None
 
 class PointCloudRepository:
-  def __init__(self, mc: Minio):
+  # s3: MinIO への非同期アダプタ（webhook の取り込みのコピー・差分の片付けをイベントループ上で行う。None なら a* の操作は使えない）
+  def __init__(self, mc: Minio, s3: Optional[AsyncS3] = None):
     self.mc = mc
+    self.s3 = s3
     
   # bucket+key の場所に点群データが存在するか確認する
   def check_folder_exists(self, bucket: str, key: str):
     try:
         return self.mc.stat_object(bucket, key)
     except S3Error as e:
-        if e.code in ("NoSuchKey", "NoSuchObject", "NotFound"):
+        if e.code in NOT_FOUND_CODES:
             return None
         raise
   
@@ -21,4 +55,158 @@ class PointCloudRepository:
         bucket_name=bucket,
         object_name=dst_key,
         source=CopySource(bucket, src_key),
-    )
\ No newline at end of file
+    )
+
+  # copy_to_latest の非同期版（スレッドを使わずにイベントループ上でコピーする）
+  async def acopy_to_latest(self, bucket: str, src_key: str, dst_key: str):
+    await self.s3.copy_object(
+        bucket_name=bucket,
+        object_name=dst_key,
+        source=CopySource(bucket, src_key),
+    )
+
+  # エッジから届いた量子化点群(.pcq)を PLY に戻して bucket+dst_key に保存する
+  def decode_pcq_to_ply(self, bucket: str, src_key: str, dst_key: str):
+    resp = self.mc.get_object(bucket, src_key)
+    try:
+        data = resp.read()
+    finally:
+        resp.close()
+        resp.release_conn()
+    body, length = ply_codec.encode_ply(quantized_codec.decode(data))
+    self.mc.put_object(bucket, dst_key, body, length, content_type="application/octet-stream")
+
+  def _read_arrays(self, bucket: str, key: str):
+    resp = self.mc.get_object(bucket, key)
+    try:
+        data = resp.read()
+    finally:
+        resp.close()
+        resp.release_conn()
+    if key.endswith(".pcq"):
+        return quantized_codec.decode(data)
+    return ply_codec.read_ply(io.BytesIO(data))
+
+  def _read_delta_manifest(self, bucket: str, geohash: str) -> Optional[dict]:
+    try:
+        resp = self.mc.get_object(bucket, delta_manifest_key(geohash))
+    except S3Error as e:
+        if e.code in NOT_FOUND_CODES:
+            return None
+        raise
+    try:
+        return json.loads(resp.read())
+    finally:
+        resp.close()
+        resp.release_conn()
+
+  # base の PLY のヘッダだけを読み、差分をつなげる manifest の初期状態を作る（つなげられない形式なら None）
+  def _new_delta_manifest(self, bucket: str, base) -> Optional[dict]:
+    resp = self.mc.get_object(bucket, base.object_name, offset=0, length=min(base.size, 64 * 1024))
+    try:
+        dtype, count, header_bytes = ply_codec.read_header_info(resp)
+    finally:
+        resp.close()
+        resp.release_conn()
+    if dtype is None or base.size != header_bytes + count * dtype.itemsize:
+        return None
+    return {
+        "base": {"key": base.object_name, "etag": base.etag, "points": count, "bytes": base.size, "header_bytes": header_bytes},
+        "properties": [[name, dtype[name].str] for name in dtype.names],
+        "deltas": [],
+    }
+
+  # エッジから届いた差分(src_key)を {geohash}/deltas/ に置き、manifest に足す（base は書き換えない）
+  #   base が無い・base の形式に合わせて書けない差分のときだけ、base と差分を連結して書き直す（間引きはしない）
+  def apply_delta(self, bucket: str, src_key: str, geohash: str):
+    arrays = self._read_arrays(bucket, src_key)
+    if len(arrays["points"]) == 0:
+        return
+    base = self.check_folder_exists(bucket, point_cloud_key(geohash))
+    manifest = None
+    if base is not None:
+        manifest = self._read_delta_manifest(bucket, geohash)
+        if manifest is None or manifest["base"]["etag"] != base.etag:
+            # base がフルスナップショットで置き換わっていれば、前の差分はそこに含まれている
+            manifest = self._new_delta_manifest(bucket, base)
+    dtype = np.dtype([tuple(p) for p in manifest["properties"]]) if manifest is not None else None
+    if dtype is None or not ply_codec.can_encode_as(arrays, dtype):
+        if base is not None:
+            print(f"MEMO: delta for {geohash} cannot be appended; compacting into the base")
+        self.compact(bucket, geohash, arrays)
+        return
+
+    # 同じ差分（同じ id の範囲）が二重に届いても、同じキーを上書きするだけで点は増えない
+    name = posixpath.splitext(posixpath.basename(src_key))[0] + ".ply"
+    key = delta_key(geohash, name)
+    body, length = ply_codec.encode_ply(arrays, dtype)
+    result = self.mc.put_object(bucket, key, body, length, content_type="application/octet-stream")
+    deltas = [d for d in manifest["deltas"] if d["key"] != key]
+    deltas.append({
+        "key": key,
+        "etag": result.etag,
+        "points": len(arrays["points"]),
+        "bytes": length,
+        "header_bytes": len(ply_codec.ply_header(len(arrays["points"]), dtype)),
+    })
+    manifest["deltas"] = deltas
+    manifest["updated_at"] = datetime.now().astimezone().isoformat()
+    data = json.dumps(manifest).encode("utf-8")
+    self.mc.put_object(bucket, delta_manifest_key(geohash), io.BytesIO(data), len(data), content_type="application/json")
+
+  # base と manifest の差分（＋extra）を連結して base に書き直し、差分を消す
+  def compact(self, bucket: str, geohash: str, extra: Optional[Dict[str, np.ndarray]] = None):
+    parts = []
+    manifest = self._read_delta_manifest(bucket, geohash)
+    base = self.check_folder_exists(bucket, point_cloud_key(geohash))
+    if base is not None:
+        parts.append(self._read_arrays(bucket, base.object_name))
+        if manifest is not None and manifest["base"]["etag"] == base.etag:
+            parts += [self._read_arrays(bucket, d["key"]) for d in manifest["deltas"]]
+    if extra is not None:
+        parts.append(extra)
+    # すべての点群が持っている属性だけを残す（Open3D の + と同じ挙動）
+    names = set.intersection(*(set(a) for a in parts))
+    arrays = {n: np.concatenate([a[n] for a in parts]) for n in names}
+    body, length = ply_codec.encode_ply(arrays)
+    self.mc.put_object(bucket, point_cloud_key(geohash), body, length, content_type="application/octet-stream")
+    self.drop_deltas(bucket, geohash, manifest)
+
+  # フルスナップショットで base を置き換えたあとに呼ぶ（差分はスナップショットに含まれている）
+  #   manifest を先に消すので、読み込み中の GET は base だけを返すか、base の ETag の食い違いで差分を無視する
+  def drop_deltas(self, bucket: str, geohash: str, manifest: Optional[dict] = None):
+    manifest = manifest or self._read_delta_manifest(bucket, geohash)
+    if manifest is None:
+        return
+    self.mc.remove_object(bucket, delta_manifest_key(geohash))
+    for d in manifest["deltas"]:
+        try:
+            self.mc.remove_object(bucket, d["key"])
+        except S3Error as e:
+            print(f"MEMO: failed to remove delta {d['key']}: {e.code}")
+
+  # drop_deltas の非同期版（フルスナップショットの取り込みでイベントループ上から呼ぶ）
+  async def adrop_deltas(self, bucket: str, geohash: str):
+    try:
+        resp = await self.s3.get_object(bucket, delta_manifest_key(geohash))
+        try:
+            manifest = json.loads(await resp.aread())
+        finally:
+            await resp.aclose()
+    except S3Error as e:
+        if e.code in NOT_FOUND_CODES:
+            return
+        raise
+    await self.s3.remove_object(bucket, delta_manifest_key(geohash))
+    for d in manifest["deltas"]:
+        try:
+            await self.s3.remove_object(bucket, d["key"])
+        except S3Error as e:
+            print(f"MEMO: failed to remove delta {d['key']}: {e.code}")
+
+  # バケット直下の geohash プレフィックスの一覧（tmp/ を除く。負のキャッシュの Bloom filter に使う）
+  def list_geohashes(self, bucket: str) -> List[str]:
+    return [
+        o.object_name.rstrip("/") for o in self.mc.list_objects(bucket)
+        if o.is_dir and o.object_name != "tmp/"
+    ]
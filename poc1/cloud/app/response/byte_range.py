@@ -0,0 +1,108 @@
+# HTTP Range（RFC 9110 14章）の解釈と 206 Partial Content 応答の組み立て
+#   obj は stream_range(start, end, amt) で [start, end] を読めるもの（ObjectStream / TiledLatestObject）
+#   か、その非同期版の astream_range を持つもの（AsyncObjectStream）
+import os, secrets
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+
+# 1リクエストで受け付ける範囲の数。超えたら Range を無視して全体を返す
+MAX_RANGES = int(os.getenv("MAX_RANGES", "16"))
+
+Ranges = List[Tuple[int, int]]
+
+
+# Range ヘッダを [(start, end)]（end を含む）にする
+# 無い・解釈できない場合は None（全体を 200 で返す）、満たせる範囲が1つも無ければ 416
+def parse_range(header: Optional[str], size: int) -> Optional[Ranges]:
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+    ranges = []
+    for part in spec.split(","):
+        first, sep, last = part.strip().partition("-")
+        if not sep or not (first or last):
+            return None
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            # bytes=-N は末尾 N バイト
+            n = int(last)
+            if n == 0:
+                continue
+            start, end = max(size - n, 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if last and int(last) < start:
+                return None
+        if start < size:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+    if not ranges:
+        raise HTTPException(status_code=416, detail="range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return ranges
+
+
+def content_range(start: int, end: int, size: int) -> str:
+    return f"bytes {start}-{end}/{size}"
+
+
+def _range_iter(obj, start: int, end: int, chunk: int):
+    if hasattr(obj, "astream_range"):
+        return obj.astream_range(start, end, chunk)
+    return obj.stream_range(start, end, chunk)
+
+
+# 206 応答（範囲が1つなら本体そのまま、複数なら multipart/byteranges）
+def range_response(obj, ranges: Ranges, size: int, headers: dict, chunk: int, background=None) -> StreamingResponse:
+    headers = {k: v for k, v in headers.items() if k != "Content-Length"}
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = content_range(start, end, size)
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(
+            _range_iter(obj, start, end, chunk),
+            status_code=206,
+            media_type="application/octet-stream",
+            headers=headers,
+            background=background,
+        )
+
+    boundary = secrets.token_hex(16)
+    part_heads = [
+        (
+            f"--{boundary}\r\nContent-Type: application/octet-stream\r\n"
+            f"Content-Range: {content_range(start, end, size)}\r\n\r\n"
+        ).encode("ascii")
+        for start, end in ranges
+    ]
+    tail = f"--{boundary}--\r\n".encode("ascii")
+    length = sum(len(h) + (end - start + 1) + 2 for h, (start, end) in zip(part_heads, ranges)) + len(tail)
+
+    def body() -> Iterator[bytes]:
+        for head, (start, end) in zip(part_heads, ranges):
+            yield head
+            yield from obj.stream_range(start, end, chunk)
+            yield b"\r\n"
+        yield tail
+
+    async def abody() -> AsyncIterator[bytes]:
+        for head, (start, end) in zip(part_heads, ranges):
+            yield head
+            async for data in obj.astream_range(start, end, chunk):
+                yield data
+            yield b"\r\n"
+        yield tail
+
+    headers["Content-Length"] = str(length)
+    return StreamingResponse(
+        abody() if hasattr(obj, "astream_range") else body(),
+        status_code=206,
+        media_type=f"multipart/byteranges; boundary={boundary}",
+        headers=headers,
+        background=background,
+    )
@@ -1,36 +1,97 @@
 # [/Users/tadanoyousei/laboratory/poc1/cloud/app/usecase/point_cloud_usecase.py]
 from minio import Minio
-from repository.point_cloud_repository import PointCloudRepository
-import os, re
+from repository.point_cloud_repository import PointCloudRepository, delta_manifest_key, point_cloud_key
+from repository.negative_cache import NegativeCache
+from repository.async_s3 import AsyncS3
+from starlette.concurrency import run_in_threadpool
+from typing import Optional
+import asyncio, os, re
 
 BUCKET = "cloud-point-cloud"
 
 _mesh_pat = re.compile(r"^tmp/mesh/(?P<gh>.+)-mesh\.ply$")
+# LOD ピラミッド（tmp/mesh/{geohash}/lod{n}.ply, tmp/mesh/{geohash}/manifest.json）
+_mesh_lod_pat = re.compile(r"^tmp/mesh/(?P<gh>[^/]+)/(?P<name>lod\d+\.ply|manifest\.json)$")
 _pc_pat   = re.compile(r"^tmp/(?P<gh>.+)\.ply$")
+# 量子化＋zstd の点群（SYNC_WIRE_FORMAT=pcq）
+_pcq_pat  = re.compile(r"^tmp/(?P<gh>[^/]+)\.pcq$")
+# 差分同期（SYNC_DELTA=true）。tmp/delta/{geohash}/{first_id}-{last_id}.(ply|pcq)
+_delta_pat = re.compile(r"^tmp/delta/(?P<gh>[^/]+)/[^/]+\.(ply|pcq)$")
+
+# {geohash}/{geohash}.ply と差分の manifest を読み書きする処理は geohash ごとに直列化する（manifest の更新は read-modify-write のため）
+#   取り込みはすべてイベントループ上から呼ばれるので asyncio.Lock で待つ（待っている間もスレッドを使わない）
+_geohash_locks = {}
+
+
+def _geohash_lock(geohash: str) -> asyncio.Lock:
+  return _geohash_locks.setdefault(geohash, asyncio.Lock())
 
 class PointCloudUsecase:
-  def __init__(self, mc: Minio, s3: any):
+  # negative_cache: 点群を書いた geohash を「存在しない」扱いから外す
+  # async_s3: MinIO への非同期アダプタ（サーバサイドコピー・差分の片付けはイベントループ上で行い、
+  #   点群のデコード・エンコードを伴う処理だけをスレッドプールで minio-py から行う）
+  def __init__(self, mc: Minio, s3: any, negative_cache: Optional[NegativeCache] = None, async_s3: Optional[AsyncS3] = None):
     self.mc = mc
     self.s3 = s3
-    self.point_cloud_repository = PointCloudRepository(mc)
+    self.negative_cache = negative_cache
+    self.point_cloud_repository = PointCloudRepository(mc, async_s3)
   
-  def save(self, key: str):
+  async def save(self, key: str):
+    repo = self.point_cloud_repository
     # mesh or point-cloud で保存先を切り替え
+    m = _mesh_lod_pat.match(key)
+    if m:
+      geohash = m.group("gh")
+      dst_key = f"{geohash}/mesh/{m.group('name')}"
+      await repo.acopy_to_latest(BUCKET, key, dst_key)
+      # print(f"MEMO: copied mesh lod to s3://{BUCKET}/{dst_key}")
+      return
+
     m = _mesh_pat.match(key)
     if m:
       geohash = m.group("gh")
       dst_key = f"{geohash}/mesh/{geohash}-mesh.ply"
-      self.point_cloud_repository.copy_to_latest(BUCKET, key, dst_key)
+      await repo.acopy_to_latest(BUCKET, key, dst_key)
       # print(f"MEMO: copied mesh to s3://{BUCKET}/{dst_key}")
       return
 
+    m = _delta_pat.match(key)
+    if m:
+      geohash = m.group("gh")
+      async with _geohash_lock(geohash):
+        await run_in_threadpool(repo.apply_delta, BUCKET, key, geohash)
+      # print(f"MEMO: applied delta to s3://{BUCKET}/{delta_manifest_key(geohash)}")
+      self._invalidate_negative(geohash)
+      return
+
+    m = _pcq_pat.match(key)
+    if m:
+      geohash = m.group("gh")
+      # 受け取った形式のままも残し、GET /pointcloud 用に PLY へ戻す
+      await repo.acopy_to_latest(BUCKET, key, f"{geohash}/{geohash}.pcq")
+      dst_key = point_cloud_key(geohash)
+      async with _geohash_lock(geohash):
+        await run_in_threadpool(repo.decode_pcq_to_ply, BUCKET, key, dst_key)
+        # フルスナップショットに差分は含まれているので、ここで差分を片付ける
+        await repo.adrop_deltas(BUCKET, geohash)
+      # print(f"MEMO: decoded pointcloud to s3://{BUCKET}/{dst_key}")
+      self._invalidate_negative(geohash)
+      return
+
     m = _pc_pat.match(key)
     if m:
       geohash = m.group("gh")
-      dst_key = f"{geohash}/{geohash}.ply"
-      self.point_cloud_repository.copy_to_latest(BUCKET, key, dst_key)
+      dst_key = point_cloud_key(geohash)
+      async with _geohash_lock(geohash):
+        await repo.acopy_to_latest(BUCKET, key, dst_key)
+        await repo.adrop_deltas(BUCKET, geohash)
       # print(f"MEMO: copied pointcloud to s3://{BUCKET}/{dst_key}")
+      self._invalidate_negative(geohash)
       return
 
     # 想定外のキーは無視（必要ならログのみ）
     print(f"WARN: ignore object key (not mesh/pc tmp path): {key}")
+
+  def _invalidate_negative(self, geohash: str):
+    if self.negative_cache is not None:
+      self.negative_cache.invalidate(geohash)
@@ -1,24 +1,63 @@
-from minio import Minio
 from minio.error import S3Error
 from fastapi import HTTPException
+from repository.async_s3 import AsyncConcatStream, AsyncObjectStream, AsyncS3, ObjectStat
+from repository import ply_codec
+from datetime import datetime
+import hashlib, json
+from typing import Optional
+import numpy as np
 
 CLOUD_BUCKET = "cloud-point-cloud"
 
+NOT_FOUND_CODES = ("NoSuchKey", "NoSuchObject", "NotFound", "NoSuchBucket")
+
 class StreamUsecase:
-  def __init__(self, mc: Minio, key: str):
-    self.mc = mc
+  # s3: MinIO への非同期アダプタ（stat も本体もイベントループ上で読むので、転送中にスレッドを使わない）
+  def __init__(self, s3: AsyncS3, key: str):
+    self.s3 = s3
     self.key = key
-  def stream(self):
+
+  # delta_manifest_key: 差分同期の manifest。self.key（base）と同じ ETag の差分があれば base につなげて1つの PLY として返す
+  async def stream(self, delta_manifest_key: Optional[str] = None):
     try:
-      st = self.mc.stat_object(CLOUD_BUCKET, self.key)
+      st = await self.s3.stat_object(CLOUD_BUCKET, self.key)
     except S3Error as e:
-      if e.code in ("NoSuchKey", "NoSuchObject", "NotFound", "NoSuchBucket"):
+      if e.code in NOT_FOUND_CODES:
           raise HTTPException(status_code=404, detail="point cloud not found")
       raise
+
+    if delta_manifest_key is not None:
+      manifest = await StreamUsecase(self.s3, delta_manifest_key).read_json()
+      # base がフルスナップショットで置き換わっていれば、manifest の差分はもう base に含まれている
+      if manifest is not None and manifest["deltas"] and manifest["base"]["etag"] == st.etag:
+        return self._concat(manifest, st)
     
+    # 本体は読み出すとき（Range があればその範囲だけ）に get_object する
+    obj = AsyncObjectStream(self.s3, CLOUD_BUCKET, self.key, st.size)
+
+    return obj, st
+
+  # base と差分の本体をつなげる（各差分のヘッダは読み飛ばし、点数を合計したヘッダを先頭に付ける）
+  def _concat(self, manifest: dict, st: ObjectStat):
+    base, deltas = manifest["base"], manifest["deltas"]
+    dtype = np.dtype([tuple(p) for p in manifest["properties"]])
+    header = ply_codec.ply_header(base["points"] + sum(d["points"] for d in deltas), dtype)
+    parts = [(p["key"], p["header_bytes"], p["bytes"] - p["header_bytes"]) for p in [base, *deltas]]
+    obj = AsyncConcatStream(self.s3, CLOUD_BUCKET, header, parts)
+    # ETag は base と各差分の ETag から作る（差分が増えれば変わる）
+    etag = hashlib.md5("|".join([st.etag] + [d["etag"] for d in deltas]).encode("utf-8")).hexdigest()
+    last_modified = datetime.fromisoformat(manifest["updated_at"])
+    return obj, ObjectStat(CLOUD_BUCKET, self.key, etag, obj.size, last_modified, st.content_type)
+
+  # 小さな JSON（mesh の manifest など）を読む。無ければ None
+  async def read_json(self):
     try:
-        obj = self.mc.get_object(CLOUD_BUCKET, self.key)
+      resp = await self.s3.get_object(CLOUD_BUCKET, self.key)
     except S3Error as e:
-        raise HTTPException(status_code=502, detail=f"failed to read object: {e.code}")
-
-    return obj, st
\ No newline at end of file
+      if e.code in NOT_FOUND_CODES:
+          return None
+      raise
+    try:
+      return json.loads(await resp.aread())
+    finally:
+      await resp.aclose()
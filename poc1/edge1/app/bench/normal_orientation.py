@@ -0,0 +1,86 @@
+# 法線の向き揃え方法ごとの処理時間と Poisson メッシュの品質を比べる
+#
+#   docker compose exec edge1-api python -m bench.normal_orientation /data/a.ply /data/b.ply
+#
+# 入力は BatchRepository と同じ VOXEL でダウンサンプル・法線推定してから各方法で向きを揃える。
+# 品質は次で見る:
+#   to_mesh  : 入力点 → メッシュ表面の距離（小さいほど点群に沿っている）
+#   to_points: メッシュ頂点 → 入力点の距離（大きいと法線の向き違いで面が膨らんでいる）
+#   agree    : mst と法線の向きが一致した割合
+import argparse, time
+import numpy as np
+import open3d as o3d
+from repository.batch_repository import VOXEL
+from repository.normal_orientation import ORIENTATION_METHODS, MESH_NORMAL_VIEWPOINT, orient_normals
+
+
+def prepare(path: str) -> o3d.geometry.PointCloud:
+    pcd = o3d.io.read_point_cloud(path).voxel_down_sample(VOXEL)
+    pcd.estimate_normals(
+        search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=max(VOXEL*2, 0.05), max_nn=30)
+    )
+    return pcd
+
+
+def poisson(pcd: o3d.geometry.PointCloud, depth: int) -> o3d.geometry.TriangleMesh:
+    mesh, densities = o3d.geometry.TriangleMesh.create_from_point_cloud_poisson(pcd, depth=depth)
+    densities = np.asarray(densities)
+    mesh.remove_vertices_by_mask(densities < np.quantile(densities, 0.02))
+    return mesh
+
+
+def surface_distance(mesh: o3d.geometry.TriangleMesh, pcd: o3d.geometry.PointCloud) -> np.ndarray:
+    scene = o3d.t.geometry.RaycastingScene()
+    scene.add_triangles(o3d.t.geometry.TriangleMesh.from_legacy(mesh))
+    query = o3d.core.Tensor(np.asarray(pcd.points), dtype=o3d.core.Dtype.Float32)
+    return scene.compute_distance(query).numpy()
+
+
+def run(path: str, methods, depth: int, viewpoint):
+    base = prepare(path)
+    print(f"# {path}: {len(base.points)} points after voxel {VOXEL}")
+    print("method     orient[s]  poisson[s]  triangles  to_mesh(mean/p95)  to_points(mean/p95)  agree")
+    reference = None
+    for method in methods:
+        pcd = o3d.geometry.PointCloud(base)
+        start = time.perf_counter()
+        orient_normals(pcd, method, viewpoint)
+        orient_sec = time.perf_counter() - start
+        normals = np.asarray(pcd.normals)
+        if method == "mst":
+            reference = normals.copy()
+        agree = np.mean(np.einsum("ij,ij->i", normals, reference) > 0) if reference is not None else float("nan")
+
+        start = time.perf_counter()
+        mesh = poisson(pcd, depth)
+        poisson_sec = time.perf_counter() - start
+
+        to_mesh = surface_distance(mesh, base)
+        mesh_pc = o3d.geometry.PointCloud(mesh.vertices)
+        to_points = np.asarray(mesh_pc.compute_point_cloud_distance(base))
+        print(
+            f"{method:<10} {orient_sec:9.3f}  {poisson_sec:10.3f}  {len(mesh.triangles):9d}"
+            f"  {to_mesh.mean():.4f}/{np.quantile(to_mesh, 0.95):.4f}"
+            f"      {to_points.mean():.4f}/{np.quantile(to_points, 0.95):.4f}"
+            f"        {agree:.3f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+", help="PLY files (e.g. a downloaded latest.ply)")
+    parser.add_argument("--methods", default=",".join(ORIENTATION_METHODS))
+    parser.add_argument("--depth", type=int, default=9)
+    parser.add_argument("--viewpoint", default=",".join(str(v) for v in MESH_NORMAL_VIEWPOINT))
+    args = parser.parse_args()
+    methods = args.methods.split(",")
+    # agree は mst を基準にするので先頭に回す
+    if "mst" in methods:
+        methods = ["mst"] + [m for m in methods if m != "mst"]
+    viewpoint = tuple(float(v) for v in args.viewpoint.split(","))
+    for path in args.paths:
+        run(path, methods, args.depth, viewpoint)
+
+
+if __name__ == "__main__":
+    main()
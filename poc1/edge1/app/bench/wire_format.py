@@ -0,0 +1,76 @@
+# エッジ→クラウド転送の点群形式ごとのサイズとエンコード・デコード速度を比べる
+#
+#   docker compose exec edge1-api python -m bench.wire_format /data/a.ply --precision 0.001,0.005
+#
+# 入力は同期と同じ VOXEL でダウンサンプルしてから比べる。
+#   ply      : ply_codec の binary PLY（座標 double）
+#   o3d      : o3d.io.write_point_cloud(write_ascii=False)（現在の同期の形式）
+#   pcq@<p>  : quantized_codec（量子化幅 p[m]、zstd）
+import argparse, io, os, tempfile, time
+import numpy as np
+import open3d as o3d
+from repository import ply_codec, quantized_codec
+from repository.batch_repository import VOXEL, SYNC_ZSTD_LEVEL
+
+
+def timed(fn, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return out, best
+
+
+def o3d_roundtrip(pcd: o3d.geometry.PointCloud):
+    with tempfile.NamedTemporaryFile(suffix=".ply", delete=False) as tf:
+        path = tf.name
+    try:
+        _, enc = timed(lambda: o3d.io.write_point_cloud(path, pcd, write_ascii=False), 3)
+        size = os.path.getsize(path)
+        _, dec = timed(lambda: o3d.io.read_point_cloud(path), 3)
+        return size, enc, dec
+    finally:
+        os.remove(path)
+
+
+def run(path: str, precisions, level: int):
+    pcd = o3d.io.read_point_cloud(path).voxel_down_sample(VOXEL)
+    arrays = ply_codec.from_point_cloud(pcd)
+    n = len(arrays["points"])
+    raw = sum(a.nbytes for a in arrays.values())
+    print(f"# {path}: {n} points after voxel {VOXEL} ({raw / 1e6:.2f} MB as float64 arrays)")
+    print("format         bytes        ratio   encode[MB/s]  decode[MB/s]  max_err[m]")
+
+    def row(name, size, enc, dec, err=0.0):
+        print(f"{name:<13} {size:>10d}  {raw / size:7.2f}  {raw / enc / 1e6:12.1f}  {raw / dec / 1e6:12.1f}  {err:.5f}")
+
+    data, enc = timed(lambda: b"".join(ply_codec.iter_ply_chunks(arrays)), 3)
+    _, dec = timed(lambda: ply_codec.read_ply(io.BytesIO(data)), 3)
+    row("ply", len(data), enc, dec)
+
+    row("o3d", *o3d_roundtrip(pcd))
+
+    for p in precisions:
+        data, enc = timed(lambda: quantized_codec.encode(arrays, p, level), 3)
+        back, dec = timed(lambda: quantized_codec.decode(data), 3)
+        # pcq は点の順序を並べ替えるので、最近傍で誤差を見る
+        src = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(arrays["points"]))
+        dst = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(back["points"]))
+        err = float(np.max(np.asarray(src.compute_point_cloud_distance(dst)))) if n else 0.0
+        row(f"pcq@{p}", len(data), enc, dec, err)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+", help="PLY files (e.g. a downloaded latest.ply)")
+    parser.add_argument("--precision", default="0.001,0.005,0.01")
+    parser.add_argument("--level", type=int, default=SYNC_ZSTD_LEVEL)
+    args = parser.parse_args()
+    precisions = [float(p) for p in args.precision.split(",")]
+    for path in args.paths:
+        run(path, precisions, args.level)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# Open3D の位置合わせ・合成と PLY のデコード・エンコードを API・マージのスレッドから切り離して実行するプロセスプール
+import io, os
+import numpy as np
+import open3d as o3d
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+from typing import Dict, List, Optional, Tuple
+from repository import ply_codec
+from usecase import registration
+
+# ワーカープロセス数（0 ならプロセスプールを使わず呼び出し元スレッドで実行）
+COMPUTE_WORKERS = int(os.getenv("COMPUTE_WORKERS", "1"))
+
+# {配列名: (共有メモリ名, shape, dtype)}
+ArraySpec = Dict[str, Tuple[str, Tuple[int, ...], str]]
+
+
+# 各配列を共有メモリへコピーし、受け渡し用の spec を返す（ブロックの解放は呼び出し側）
+def share_arrays(arrays: Dict[str, np.ndarray]) -> Tuple[ArraySpec, List[shared_memory.SharedMemory]]:
+    spec: ArraySpec = {}
+    blocks = []
+    for name, arr in arrays.items():
+        arr = np.asarray(arr)
+        if arr.size == 0:
+            continue
+        shm = shared_memory.SharedMemory(create=True, size=arr.nbytes)
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+        spec[name] = (shm.name, arr.shape, arr.dtype.str)
+        blocks.append(shm)
+    return spec, blocks
+
+
+# spec の共有メモリから配列を取り出す（コピーを取ってすぐ close する）
+def attach_arrays(spec: ArraySpec) -> Dict[str, np.ndarray]:
+    arrays = {}
+    for name, (shm_name, shape, dtype) in spec.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf).copy()
+        finally:
+            shm.close()
+    return arrays
+
+
+def release_spec(spec: ArraySpec):
+    for shm_name, _, _ in spec.values():
+        try:
+            shm = shared_memory.SharedMemory(name=shm_name)
+        except FileNotFoundError:
+            continue
+        shm.close()
+        shm.unlink()
+
+
+# ワーカー起動時に Open3D を温めておく（初回呼び出しの遅延をリクエストに乗せない）
+def _init_worker():
+    o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Error)
+    warm = o3d.geometry.PointCloud()
+    warm.points = o3d.utility.Vector3dVector(np.random.rand(256, 3))
+    p = registration.preprocess(warm)
+    registration.compute_fpfh(p)
+
+
+# 結果を共有メモリに書き出して spec を返す（ブロックは親プロセスが読み取り後に unlink する）
+def _publish(arrays: Dict[str, np.ndarray]) -> ArraySpec:
+    spec, blocks = share_arrays(arrays)
+    for shm in blocks:
+        shm.close()
+    return spec
+
+
+def _decode_task(spec: ArraySpec) -> ArraySpec:
+    data = attach_arrays(spec)["data"]
+    return _publish(ply_codec.read_ply(io.BytesIO(data)))
+
+
+def _encode_task(spec: ArraySpec) -> ArraySpec:
+    body, _ = ply_codec.encode_ply(attach_arrays(spec))
+    return _publish({"data": np.frombuffer(body.read(), dtype=np.uint8)})
+
+
+def _align_and_merge_task(base_spec: ArraySpec, merge_specs: List[ArraySpec], target_spec: Optional[ArraySpec], inits):
+    base_pc = ply_codec.to_point_cloud(attach_arrays(base_spec))
+    merge_pcs = [ply_codec.to_point_cloud(attach_arrays(s)) for s in merge_specs]
+    target = registration.RegistrationTarget.from_arrays(attach_arrays(target_spec)) if target_spec else None
+    merged, new_target, stats = registration.align_and_merge(base_pc, merge_pcs, target, inits)
+    out_spec = _publish(ply_codec.from_point_cloud(merged))
+    target_out_spec = _publish(new_target.to_arrays()) if new_target is not None else None
+    return out_spec, target_out_spec, stats
+
+
+class ComputePool:
+    def __init__(self, workers: int = COMPUTE_WORKERS):
+        self.workers = workers
+        self._executor = None
+        if workers > 0:
+            self._executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=get_context("spawn"),
+                initializer=_init_worker,
+            )
+
+    # arrays を共有メモリで fn に渡し、結果の配列を受け取る
+    def _run(self, fn, arrays: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        spec, blocks = share_arrays(arrays)
+        try:
+            out_spec = self._executor.submit(fn, spec).result()
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+        try:
+            return attach_arrays(out_spec)
+        finally:
+            release_spec(out_spec)
+
+    # PLY のバイト列を配列にデコードする
+    def decode_ply(self, data: bytes) -> Dict[str, np.ndarray]:
+        if self._executor is None or not data:
+            return ply_codec.read_ply(io.BytesIO(data))
+        return self._run(_decode_task, {"data": np.frombuffer(data, dtype=np.uint8)})
+
+    # 配列を binary PLY にエンコードし、(ファイルライク, バイト長) を返す（ply_codec.encode_ply と同じ形）
+    def encode_ply(self, arrays: Dict[str, np.ndarray]):
+        if self._executor is None or len(arrays["points"]) == 0:
+            return ply_codec.encode_ply(arrays)
+        data = self._run(_encode_task, arrays)["data"]
+        return io.BytesIO(data.tobytes()), len(data)
+
+    # 位置合わせ・合成を実行し、(合成結果, 合成結果の位置合わせ用 target 配列, アップロードごとの計測値) を返す
+    # target_arrays は base_pc に対応する保存済み target（無ければ内部で計算する）
+    # inits は merge_pcs ごとの初期姿勢（4x4。小さいのでそのまま pickle で渡す）
+    def align_and_merge(
+        self,
+        base_pc: o3d.geometry.PointCloud,
+        merge_pcs: List[o3d.geometry.PointCloud],
+        target_arrays: Optional[Dict[str, np.ndarray]] = None,
+        inits: Optional[List[Optional[np.ndarray]]] = None,
+    ) -> Tuple[o3d.geometry.PointCloud, Optional[Dict[str, np.ndarray]], List[dict]]:
+        # 位置合わせの有無に関わらずプールで実行する（呼び出し元スレッドで実行するのは COMPUTE_WORKERS=0 のときだけ）
+        if self._executor is None:
+            target = registration.RegistrationTarget.from_arrays(target_arrays) if target_arrays else None
+            merged, new_target, stats = registration.align_and_merge(base_pc, merge_pcs, target, inits)
+            return merged, (new_target.to_arrays() if new_target is not None else None), stats
+
+        blocks = []
+        try:
+            base_spec, b = share_arrays(ply_codec.from_point_cloud(base_pc))
+            blocks += b
+            merge_specs = []
+            for pc in merge_pcs:
+                spec, b = share_arrays(ply_codec.from_point_cloud(pc))
+                blocks += b
+                merge_specs.append(spec)
+            target_spec = None
+            if target_arrays:
+                target_spec, b = share_arrays(target_arrays)
+                blocks += b
+            out_spec, target_out_spec, stats = self._executor.submit(
+                _align_and_merge_task, base_spec, merge_specs, target_spec, inits
+            ).result()
+            try:
+                merged = ply_codec.to_point_cloud(attach_arrays(out_spec))
+                new_target = attach_arrays(target_out_spec) if target_out_spec else None
+                return merged, new_target, stats
+            finally:
+                release_spec(out_spec)
+                if target_out_spec:
+                    release_spec(target_out_spec)
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
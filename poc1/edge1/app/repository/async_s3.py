@@ -0,0 +1,264 @@
+# MinIO（S3 互換）への非同期アダプタ。httpx の接続プールの上で SigV4 署名したリクエストを送る
+#   GET の配信に使う読み取り（stat_object / get_object）と、webhook の取り込みで使う書き込み（copy_object）を
+#   minio-py と同じ名前で async で提供する（Open3D で点群を組み立てる書き込みはワーカーから minio-py で行う）
+#   失敗は S3Error のサブクラス（code は NoSuchKey など）にするので、呼び出し側の例外処理はそのまま使える
+import hashlib, hmac, os
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote
+import httpx
+from minio.commonconfig import CopySource
+from minio.error import S3Error
+
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+# 1ワーカーで張る MinIO への接続数の上限（同時ダウンロード数の上限になる）と、アイドルのまま残す接続数
+S3_HTTP_MAX_CONNECTIONS = int(os.getenv("S3_HTTP_MAX_CONNECTIONS", "1024"))
+S3_HTTP_MAX_KEEPALIVE = int(os.getenv("S3_HTTP_MAX_KEEPALIVE", "128"))
+S3_HTTP_CONNECT_TIMEOUT_SEC = float(os.getenv("S3_HTTP_CONNECT_TIMEOUT_SEC", "5"))
+S3_HTTP_READ_TIMEOUT_SEC = float(os.getenv("S3_HTTP_READ_TIMEOUT_SEC", "60"))
+
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+
+
+@dataclass
+class ObjectStat:
+    """stat_object の結果（minio-py の Object と同じ属性名）"""
+
+    bucket_name: str
+    object_name: str
+    etag: str
+    size: int
+    last_modified: datetime
+    content_type: Optional[str]
+
+
+@dataclass
+class ObjectWriteResult:
+    """copy_object の結果（minio-py の ObjectWriteResult と同じ属性名）"""
+
+    bucket_name: str
+    object_name: str
+    etag: str
+
+
+class AsyncObjectStream:
+    """ObjectStream の非同期版。StreamingResponse へそのまま渡せる（Range があればその範囲だけを ranged get する）"""
+
+    def __init__(self, s3: "AsyncS3", bucket: str, key: str, size: int):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self._resp: Optional[httpx.Response] = None
+
+    async def _astream(self, amt: int, **kwargs):
+        self._resp = await self.s3.get_object(self.bucket, self.key, **kwargs)
+        try:
+            async for chunk in self._resp.aiter_raw(amt):
+                yield chunk
+        finally:
+            await self.aclose()
+
+    def astream(self, amt: int = 32 * 1024):
+        return self._astream(amt)
+
+    # [start, end]（end を含む）を流す
+    def astream_range(self, start: int, end: int, amt: int = 32 * 1024):
+        return self._astream(amt, offset=start, length=end - start + 1)
+
+    async def aclose(self):
+        if self._resp is not None:
+            await self._resp.aclose()
+            self._resp = None
+
+
+class AsyncConcatStream:
+    """header の後ろに複数オブジェクトの [offset, offset+length) をつないで1つの本体として流す（AsyncObjectStream と同じ使い方）"""
+
+    # parts: (key, offset, length) のリスト
+    def __init__(self, s3: "AsyncS3", bucket: str, header: bytes, parts: List[Tuple[str, int, int]]):
+        self.s3 = s3
+        self.bucket = bucket
+        self.header = header
+        self.parts = parts
+        self.size = len(header) + sum(length for _, _, length in parts)
+        self._resp: Optional[httpx.Response] = None
+
+    def astream(self, amt: int = 32 * 1024):
+        return self.astream_range(0, self.size - 1, amt)
+
+    # [start, end]（end を含む）を、重なるオブジェクトだけ ranged get して流す
+    async def astream_range(self, start: int, end: int, amt: int = 32 * 1024):
+        if start < len(self.header):
+            yield self.header[start:end + 1]
+        pos = len(self.header)
+        for key, offset, length in self.parts:
+            if pos > end:
+                break
+            lo, hi = max(start, pos), min(end, pos + length - 1)
+            pos += length
+            if lo > hi:
+                continue
+            self._resp = await self.s3.get_object(self.bucket, key, offset=offset + lo - (pos - length), length=hi - lo + 1)
+            try:
+                async for chunk in self._resp.aiter_raw(amt):
+                    yield chunk
+            finally:
+                await self.aclose()
+
+    async def aclose(self):
+        if self._resp is not None:
+            await self._resp.aclose()
+            self._resp = None
+
+
+class AsyncS3Error(S3Error):
+    """minio-py の S3Error として捕まえられるエラー（S3Error のコンストラクタの引数は minio のバージョンで違うので呼ばない）"""
+
+    def __init__(self, code: str, message: Optional[str], resource: str, response: httpx.Response):
+        Exception.__init__(self, f"S3 operation failed; code: {code}, message: {message}, resource: {resource}")
+        self._code = code
+        self._message = message
+        self._resource = resource
+        self._response = response
+
+    @property
+    def code(self) -> str:
+        return self._code
+
+    @property
+    def message(self) -> Optional[str]:
+        return self._message
+
+    @property
+    def response(self) -> httpx.Response:
+        return self._response
+
+
+def _hmac(key: bytes, msg: str) -> bytes:
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+
+class AsyncS3:
+    def __init__(
+        self,
+        endpoint: str,
+        access_key: str,
+        secret_key: str,
+        secure: bool = False,
+        region: str = S3_REGION,
+        max_connections: int = S3_HTTP_MAX_CONNECTIONS,
+        max_keepalive: int = S3_HTTP_MAX_KEEPALIVE,
+    ):
+        self.host = endpoint
+        self.base_url = f"{'https' if secure else 'http'}://{endpoint}"
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        self.timeout = httpx.Timeout(S3_HTTP_READ_TIMEOUT_SEC, connect=S3_HTTP_CONNECT_TIMEOUT_SEC)
+        self._client: Optional[httpx.AsyncClient] = None
+
+    # イベントループ上で最初に使うときに作る
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    # AWS Signature Version 4（path-style。署名するのは host と x-amz-* だけ）
+    def _sign(self, method: str, path: str, headers: Dict[str, str], payload_hash: str) -> Dict[str, str]:
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        datestamp = now.strftime("%Y%m%d")
+        headers = {k.lower(): str(v) for k, v in headers.items()}
+        headers.update({"host": self.host, "x-amz-date": amz_date, "x-amz-content-sha256": payload_hash})
+        signed = sorted(k for k in headers if k == "host" or k.startswith("x-amz-"))
+        canonical_request = "\n".join([
+            method,
+            path,
+            "",  # クエリ文字列は使わない
+            "".join(f"{k}:{headers[k].strip()}\n" for k in signed),
+            ";".join(signed),
+            payload_hash,
+        ])
+        scope = f"{datestamp}/{self.region}/s3/aws4_request"
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+        ])
+        key = _hmac(("AWS4" + self.secret_key).encode("utf-8"), datestamp)
+        for part in (self.region, "s3", "aws4_request"):
+            key = _hmac(key, part)
+        signature = hmac.new(key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+        headers["authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+            f"SignedHeaders={';'.join(signed)}, Signature={signature}"
+        )
+        return headers
+
+    async def _request(
+        self,
+        method: str,
+        bucket: str,
+        key: str,
+        headers: Optional[Dict[str, str]] = None,
+        stream: bool = False,
+    ) -> httpx.Response:
+        path = quote(f"/{bucket}/{key}", safe="/")
+        # 本文を送る操作は無い（コピーは x-amz-copy-source ヘッダだけ）ので本文は常に空
+        request = self.client.build_request(
+            method, self.base_url + path, headers=self._sign(method, path, headers or {}, EMPTY_SHA256)
+        )
+        resp = await self.client.send(request, stream=stream)
+        if resp.status_code >= 300:
+            await resp.aread()
+            await resp.aclose()
+            raise self._error(resp, bucket, key)
+        return resp
+
+    def _error(self, resp: httpx.Response, bucket: str, key: str) -> AsyncS3Error:
+        code, message = None, resp.reason_phrase
+        if resp.content:
+            try:
+                root = ET.fromstring(resp.content)
+                code, message = root.findtext("Code"), root.findtext("Message") or message
+            except ET.ParseError:
+                pass
+        if code is None:
+            # HEAD の応答には本文が無いので、minio-py と同じくステータスから決める
+            code = {404: "NoSuchKey", 403: "AccessDenied", 412: "PreconditionFailed"}.get(resp.status_code, "ResponseCodeError")
+        return AsyncS3Error(code, message, f"/{bucket}/{key}", resp)
+
+    async def stat_object(self, bucket: str, key: str) -> ObjectStat:
+        resp = await self._request("HEAD", bucket, key)
+        h = resp.headers
+        return ObjectStat(
+            bucket, key, h.get("ETag", "").strip('"'), int(h.get("Content-Length", "0")),
+            parsedate_to_datetime(h["Last-Modified"]), h.get("Content-Type"),
+        )
+
+    # 本体を読まずに応答ヘッダまで受け取る（aiter_raw / aread で読み、aclose で接続をプールへ返す）
+    async def get_object(self, bucket: str, key: str, offset: int = 0, length: int = 0) -> httpx.Response:
+        headers = {}
+        if offset or length:
+            headers["Range"] = f"bytes={offset}-{offset + length - 1}" if length else f"bytes={offset}-"
+        return await self._request("GET", bucket, key, headers, stream=True)
+
+    # サーバサイドコピー（本体はクライアントを通らない）
+    async def copy_object(self, bucket_name: str, object_name: str, source: CopySource) -> ObjectWriteResult:
+        headers = {"x-amz-copy-source": quote(f"/{source.bucket_name}/{source.object_name}", safe="/")}
+        resp = await self._request("PUT", bucket_name, object_name, headers)
+        # コピーは 200 のまま本文にエラーが入ることがある
+        root = ET.fromstring(resp.content)
+        if root.tag.endswith("Error"):
+            raise AsyncS3Error(root.findtext("Code"), root.findtext("Message"), f"/{bucket_name}/{object_name}", resp)
+        etag = next((el.text for el in root.iter() if el.tag.endswith("ETag")), "") or ""
+        return ObjectWriteResult(bucket_name, object_name, etag.strip('"'))
@@ -0,0 +1,219 @@
+# クラウドからフォールバック取得した点群・メッシュをエッジのディスクに残す read-through キャッシュ（合計サイズ上限つき LRU）
+#   本体は {CLOUD_CACHE_DIR}/{sha1(url)}.bin、ETag などのメタ情報は同名の .json に置く
+import hashlib, json, os, threading, time, uuid
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Mapping, Optional
+from prometheus_client import Counter, Gauge
+
+CLOUD_CACHE_DIR = os.getenv("CLOUD_CACHE_DIR", "/tmp/cloud-cache")
+# キャッシュに置く本体の合計バイト数の上限（0 ならキャッシュしない）
+CLOUD_CACHE_MAX_BYTES = int(os.getenv("CLOUD_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+# この秒数以内に確認したエントリはクラウドへ問い合わせずに返す（過ぎたら If-None-Match で再検証）
+CLOUD_CACHE_FRESH_SEC = float(os.getenv("CLOUD_CACHE_FRESH_SEC", "30"))
+
+# hit: そのまま返した / revalidated: 304 で確認して返した / stale: クラウドに届かず古いまま返した
+# miss: クラウドから取りつつ保存した / bypass: 保存できない応答（Range・304 など）をそのまま返した
+CLOUD_CACHE_REQUESTS = Counter("cloud_cache_requests_total", "cloud fallback requests by cache result", ["result"])
+CLOUD_CACHE_EVICTIONS = Counter("cloud_cache_evictions_total", "cloud fallback cache evictions")
+CLOUD_CACHE_BYTES = Gauge("cloud_cache_bytes", "bytes held by the cloud fallback cache")
+
+
+@dataclass
+class CacheEntry:
+    """_stream_response からは MinIO の stat と同じに扱える（etag / size / last_modified）"""
+
+    url: str
+    etag: str
+    last_modified: datetime
+    size: int
+    validated_at: float
+
+
+class CachedObject:
+    """キャッシュした本体のファイルを流す（Range は seek して読む）"""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self._f = None
+
+    def astream(self, amt: int = 32 * 1024):
+        return self.astream_range(0, self.size - 1, amt)
+
+    # チャンク単位の読み込みはページキャッシュから返るだけなので、TeeStream の書き込みと同じくイベントループ上で行う
+    async def astream_range(self, start: int, end: int, amt: int = 32 * 1024):
+        # open 済みのファイルは evict で消されても最後まで読める
+        self._f = open(self.path, "rb")
+        try:
+            self._f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = self._f.read(min(amt, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        finally:
+            await self.aclose()
+
+    async def aclose(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+class TeeStream:
+    """クラウドの応答（HttpBody）をクライアントへ流しながら一時ファイルへ書き、最後まで届いたらキャッシュに入れる"""
+
+    def __init__(self, raw, cache: "CloudCache", entry: CacheEntry):
+        self.raw = raw
+        self.cache = cache
+        self.entry = entry
+        self.tmp_path = os.path.join(cache.dir, f".{uuid.uuid4().hex}.part")
+
+    async def astream(self, amt: int = 32 * 1024):
+        written = 0
+        try:
+            # チャンク単位の書き込みはページキャッシュに載るだけなのでイベントループ上で行う
+            with open(self.tmp_path, "wb") as f:
+                async for chunk in self.raw.astream(amt):
+                    f.write(chunk)
+                    written += len(chunk)
+                    yield chunk
+            if written == self.entry.size:
+                self.cache.commit(self.tmp_path, self.entry)
+        finally:
+            # 途中で切れた（またはサイズが合わなかった）ものは捨てる
+            self._discard()
+
+    async def aclose(self):
+        await self.raw.aclose()
+        self._discard()
+
+    def _discard(self):
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class CloudCache:
+    def __init__(self, cache_dir: str = CLOUD_CACHE_DIR, max_bytes: int = CLOUD_CACHE_MAX_BYTES, fresh_sec: float = CLOUD_CACHE_FRESH_SEC):
+        self.dir = cache_dir
+        self.max_bytes = max_bytes
+        self.fresh_sec = fresh_sec
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._bytes = 0
+        if max_bytes > 0:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _name(self, url: str) -> str:
+        return os.path.join(self.dir, hashlib.sha1(url.encode("utf-8")).hexdigest())
+
+    def path(self, entry: CacheEntry) -> str:
+        return self._name(entry.url) + ".bin"
+
+    # 再起動しても前回のキャッシュを使う（古い順に並べ直す）
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.dir):
+            path = os.path.join(self.dir, name)
+            if name.startswith(".") and name.endswith(".part"):
+                os.remove(path)
+                continue
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(path) as f:
+                    meta = json.load(f)
+                meta["last_modified"] = datetime.fromisoformat(meta["last_modified"])
+                entry = CacheEntry(**meta)
+            except (ValueError, TypeError, KeyError):
+                continue
+            if os.path.exists(self.path(entry)):
+                entries.append(entry)
+        for entry in sorted(entries, key=lambda e: e.validated_at):
+            self._entries[entry.url] = entry
+            self._bytes += entry.size
+        CLOUD_CACHE_BYTES.set(self._bytes)
+        self._evict()
+
+    def _write_meta(self, entry: CacheEntry):
+        meta = {**asdict(entry), "last_modified": entry.last_modified.isoformat()}
+        tmp = self._name(entry.url) + ".json.tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._name(entry.url) + ".json")
+
+    def get(self, url: str) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        return time.time() - entry.validated_at < self.fresh_sec
+
+    # クラウドが 304 を返した（まだ最新）
+    def touch(self, entry: CacheEntry):
+        entry.validated_at = time.time()
+        self._write_meta(entry)
+
+    def open(self, entry: CacheEntry) -> CachedObject:
+        return CachedObject(self.path(entry), entry.size)
+
+    # 200 応答をキャッシュしながら流す TeeStream を返す（保存できない応答なら None）
+    def tee(self, url: str, raw, headers: Mapping[str, str]) -> Optional[TeeStream]:
+        etag = headers.get("ETag")
+        length = headers.get("Content-Length")
+        if not etag or not length or not length.isdigit() or int(length) > self.max_bytes:
+            return None
+        try:
+            lm = parsedate_to_datetime(headers.get("Last-Modified", ""))
+        except (TypeError, ValueError):
+            lm = datetime.now(timezone.utc)
+        entry = CacheEntry(url, etag.strip('"'), lm, int(length), time.time())
+        return TeeStream(raw, self, entry)
+
+    def commit(self, tmp_path: str, entry: CacheEntry):
+        with self._lock:
+            # 同じ URL を同時に取りに行った場合は後から届いたほうで置き換える
+            os.replace(tmp_path, self.path(entry))
+            self._write_meta(entry)
+            old = self._entries.pop(entry.url, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[entry.url] = entry
+            self._bytes += entry.size
+            CLOUD_CACHE_BYTES.set(self._bytes)
+            self._evict()
+
+    def invalidate(self, url: str):
+        with self._lock:
+            if url in self._entries:
+                self._remove(url)
+
+    def _evict(self):
+        while self._entries and self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            CLOUD_CACHE_EVICTIONS.inc()
+
+    def _remove(self, url: str):
+        entry = self._entries.pop(url)
+        self._bytes -= entry.size
+        CLOUD_CACHE_BYTES.set(self._bytes)
+        for ext in (".bin", ".json"):
+            try:
+                os.remove(self._name(url) + ext)
+            except FileNotFoundError:
+                pass
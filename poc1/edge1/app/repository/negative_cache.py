@@ -0,0 +1,134 @@
+# 存在しない geohash への GET /pointcloud を早く 404 にするための負のキャッシュ
+#   TTL: 直近 404 だった geohash を NEGATIVE_CACHE_TTL_SEC の間覚えておく
+#   Bloom filter（NEGATIVE_BLOOM=true）: 既知の geohash の集合。入っていなければ確実に存在しない
+import hashlib, math, os, threading, time
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional, Set
+from prometheus_client import Counter
+
+NEGATIVE_CACHE_TTL_SEC = float(os.getenv("NEGATIVE_CACHE_TTL_SEC", "10"))
+NEGATIVE_CACHE_MAX_ENTRIES = int(os.getenv("NEGATIVE_CACHE_MAX_ENTRIES", "100000"))
+NEGATIVE_BLOOM = os.getenv("NEGATIVE_BLOOM", "false").lower() == "true"
+# Bloom filter を作り直す間隔[秒]と偽陽性率
+NEGATIVE_BLOOM_REFRESH_SEC = float(os.getenv("NEGATIVE_BLOOM_REFRESH_SEC", "60"))
+NEGATIVE_BLOOM_FP_RATE = float(os.getenv("NEGATIVE_BLOOM_FP_RATE", "0.01"))
+
+NEGATIVE_CACHE_HITS = Counter("negative_cache_hits_total", "lookups answered as absent without storage access", ["reason"])
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, fp_rate: float = NEGATIVE_BLOOM_FP_RATE):
+        capacity = max(capacity, 1)
+        self.bits = max(int(-capacity * math.log(fp_rate) / (math.log(2) ** 2)), 64)
+        self.hashes = max(int(round(self.bits / capacity * math.log(2))), 1)
+        self._array = bytearray((self.bits + 7) // 8)
+
+    # double hashing（h1 + i*h2）で k 個の位置を作る
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, key: str):
+        for p in self._positions(key):
+            self._array[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._array[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+
+class NegativeCache:
+    """load_known: 既知の geohash を列挙する関数（NEGATIVE_BLOOM=true のときに Bloom filter の元にする）"""
+
+    def __init__(
+        self,
+        load_known: Optional[Callable[[], Iterable[str]]] = None,
+        ttl_sec: float = NEGATIVE_CACHE_TTL_SEC,
+        max_entries: int = NEGATIVE_CACHE_MAX_ENTRIES,
+        bloom: bool = NEGATIVE_BLOOM,
+        refresh_sec: float = NEGATIVE_BLOOM_REFRESH_SEC,
+    ):
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self.load_known = load_known if bloom else None
+        self.refresh_sec = refresh_sec
+        self._lock = threading.Lock()
+        self._absent: "OrderedDict[str, float]" = OrderedDict()
+        self._bloom: Optional[BloomFilter] = None
+        self._built_at = 0.0
+        self._refreshing = False
+        # 作り直しの最中に取り込まれた geohash（新しい Bloom filter にも入れる）
+        self._added: Set[str] = set()
+
+    # 直近 404 だった（TTL 内）なら True
+    def is_absent(self, geohash: str) -> bool:
+        if self.ttl_sec <= 0:
+            return False
+        with self._lock:
+            expires = self._absent.get(geohash)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._absent[geohash]
+                return False
+        NEGATIVE_CACHE_HITS.labels("ttl").inc()
+        return True
+
+    # Bloom filter に照らして存在しうるなら True（Bloom filter が無い・未構築なら常に True）
+    def may_exist(self, geohash: str) -> bool:
+        if self.load_known is None:
+            return True
+        self._maybe_refresh()
+        bloom = self._bloom
+        if bloom is None or geohash in bloom:
+            return True
+        NEGATIVE_CACHE_HITS.labels("bloom").inc()
+        return False
+
+    def add(self, geohash: str):
+        if self.ttl_sec <= 0:
+            return
+        with self._lock:
+            self._absent[geohash] = time.monotonic() + self.ttl_sec
+            self._absent.move_to_end(geohash)
+            while len(self._absent) > self.max_entries:
+                self._absent.popitem(last=False)
+
+    # 取り込みで geohash が存在するようになった
+    def invalidate(self, geohash: str):
+        with self._lock:
+            self._absent.pop(geohash, None)
+            if self._bloom is not None:
+                self._bloom.add(geohash)
+            self._added.add(geohash)
+
+    def _maybe_refresh(self):
+        with self._lock:
+            if self._refreshing or time.monotonic() - self._built_at < self.refresh_sec:
+                return
+            self._refreshing = True
+        # 作り直しはリクエストを待たせないよう別スレッドで行う（その間は古い Bloom filter を使う）
+        threading.Thread(target=self._rebuild, name="negative-cache-bloom", daemon=True).start()
+
+    def _rebuild(self):
+        try:
+            with self._lock:
+                self._added.clear()
+            known = list(self.load_known())
+            bloom = BloomFilter(max(len(known) * 2, 1024))
+            for geohash in known:
+                bloom.add(geohash)
+            with self._lock:
+                for geohash in self._added:
+                    bloom.add(geohash)
+                self._bloom = bloom
+                self._built_at = time.monotonic()
+        except Exception as e:
+            # 作れなかったときは古い Bloom filter のまま（未構築なら素通し）にして、次の間隔で再試行
+            print(f"MEMO: failed to rebuild geohash bloom filter: {e}")
+            with self._lock:
+                self._built_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._refreshing = False
@@ -0,0 +1,60 @@
+# latest に対応する位置合わせ用の前処理結果（ダウンサンプル済み base・法線・FPFH）を MinIO に .npz で保存する
+import io
+import numpy as np
+from minio import Minio
+from minio.error import S3Error
+from typing import Dict, Optional
+
+NOT_FOUND_CODES = ("NoSuchKey", "NoSuchObject", "NotFound", "NoSuchBucket")
+# 対応する latest の ETag を入れるユーザーメタデータ（stat だけで古いかどうかを判定する）
+LATEST_ETAG_META = "latest-etag"
+
+
+class RegistrationArtifactRepository:
+    def __init__(self, mc: Minio):
+        self.mc = mc
+
+    # latest.ply の隣に置く
+    def artifact_key(self, geohash: str) -> str:
+        return f"{geohash}/latest/registration.npz"
+
+    # 保存済みの artifact が latest_etag に対応していれば配列を返す（無い・古い場合は None）
+    #   先に stat のメタデータで ETag を比べ、一致したときだけ本体を取得する
+    def load(self, bucket: str, geohash: str, latest_etag: str) -> Optional[Dict[str, np.ndarray]]:
+        key = self.artifact_key(geohash)
+        try:
+            st = self.mc.stat_object(bucket, key)
+            if (st.metadata or {}).get(f"x-amz-meta-{LATEST_ETAG_META}") != latest_etag:
+                # メタデータの無い古い形式もここで作り直しになる
+                return None
+            resp = self.mc.get_object(bucket, key)
+        except S3Error as e:
+            if e.code in NOT_FOUND_CODES:
+                return None
+            raise
+        try:
+            data = resp.read()
+        finally:
+            resp.close()
+            resp.release_conn()
+        with np.load(io.BytesIO(data), allow_pickle=False) as npz:
+            # stat と取得の間に書き換えられた場合に備えて本体側でも確かめる
+            if str(npz["latest_etag"]) != latest_etag:
+                return None
+            return {name: npz[name] for name in ("points", "normals", "fpfh")}
+
+    def save(self, bucket: str, geohash: str, latest_etag: str, arrays: Dict[str, np.ndarray]):
+        buf = io.BytesIO()
+        np.savez_compressed(
+            buf,
+            latest_etag=np.array(latest_etag),
+            points=np.asarray(arrays["points"], dtype=np.float64),
+            normals=np.asarray(arrays["normals"], dtype=np.float32),
+            fpfh=np.asarray(arrays["fpfh"], dtype=np.float32),
+        )
+        length = buf.tell()
+        buf.seek(0)
+        self.mc.put_object(
+            bucket, self.artifact_key(geohash), buf, length,
+            content_type="application/octet-stream", metadata={LATEST_ETAG_META: latest_etag},
+        )
@@ -1,5 +1,6 @@
 from sqlalchemy.orm import Session
 from sqlalchemy import text
+from typing import Optional, Tuple
 
 
 class UploadReservationRepository:
@@ -44,3 +45,20 @@ class UploadReservationRepository:
             ),
             {"user_id": user_id, "object_key": upload_object_key},
         ).scalar_one()
+
+    def find_location_by_object_key(self, db: Session, object_key: str) -> Optional[Tuple[float, float]]:
+        """予約時に記録した (latitude, longitude) を返す。予約が無ければ None。"""
+        row = db.execute(
+            text(
+                """
+                SELECT latitude, longitude FROM upload_reservations
+                WHERE object_key = :object_key
+                ORDER BY id DESC
+                LIMIT 1
+                """
+            ),
+            {"object_key": object_key},
+        ).first()
+        if row is None:
+            return None
+        return float(row[0]), float(row[1])
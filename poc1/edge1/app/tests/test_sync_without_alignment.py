@@ -0,0 +1,119 @@
+# ALIGN_ENABLED=false でも、合成したアップロードが差分同期でクラウドへ送られることを確かめる
+#   app ディレクトリで `python -m pytest -q tests` として実行する
+import io
+import json
+from types import SimpleNamespace
+
+import numpy as np
+import open3d as o3d
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+from repository import batch_repository, ply_codec
+from repository.batch_repository import BatchRepository
+from repository.sync_watermark_repository import SyncWatermarkRepository
+from usecase import registration
+
+GEOHASH = "xn1vqhzy"
+
+
+def _point_cloud(points) -> o3d.geometry.PointCloud:
+    return ply_codec.to_point_cloud({"points": np.asarray(points, dtype=np.float64)})
+
+
+class InMemoryMinio:
+    """テスト用に BatchRepository が使う分だけの Minio の振る舞いを持つ"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def bucket_exists(self, bucket):
+        return True
+
+    def make_bucket(self, bucket):
+        pass
+
+    def put_object(self, bucket, key, data, length, content_type=None, **kwargs):
+        body = data.read(length)
+        self.objects[(bucket, key)] = body
+        return SimpleNamespace(etag=str(hash(body)))
+
+    def stat_object(self, bucket, key):
+        if (bucket, key) not in self.objects:
+            from minio.error import S3Error
+            raise S3Error("NoSuchKey", "not found", key, None, None, None)
+        body = self.objects[(bucket, key)]
+        return SimpleNamespace(etag=str(hash(body)), size=len(body), last_modified=None)
+
+    def get_object(self, bucket, key, **kwargs):
+        resp = io.BytesIO(self.objects[(bucket, key)])
+        resp.release_conn = lambda: None
+        return resp
+
+
+@pytest.fixture
+def alignment_disabled(monkeypatch):
+    monkeypatch.setattr(registration, "ALIGN_ENABLED", False)
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE pc_uploaded_history (id INTEGER PRIMARY KEY, area_id INTEGER, object_key TEXT, transform TEXT)"
+        ))
+    with Session(engine) as session:
+        yield session
+
+
+def test_align_and_merge_records_identity_transform(alignment_disabled):
+    base = _point_cloud([[0.0, 0.0, 0.0]])
+    upload = _point_cloud([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]])
+
+    merged, new_target, stats = registration.align_and_merge(base, [upload])
+
+    assert len(merged.points) == 3
+    assert new_target is None
+    assert np.allclose(stats[0]["transform"], np.eye(4))
+    # Prometheus へは位置合わせした分だけ記録する
+    registration.observe_stats(stats)
+
+
+def test_list_merged_uploads_includes_rows_without_transform(db):
+    db.execute(text(
+        "INSERT INTO pc_uploaded_history (id, area_id, object_key, transform) VALUES"
+        " (1, 1, 'a.ply', NULL), (2, 1, 'b.ply', :t), (3, 2, 'c.ply', NULL)"
+    ), {"t": "[[1,0,0,5],[0,1,0,0],[0,0,1,0],[0,0,0,1]]"})
+
+    uploads = SyncWatermarkRepository().list_merged_uploads(db, 1, 0)
+
+    assert [u.id for u in uploads] == [1, 2]
+    assert np.allclose(uploads[0].transform, np.eye(4))
+    assert uploads[1].transform[0][3] == 5
+
+
+def test_delta_sync_sends_uploads_merged_without_alignment(alignment_disabled, db):
+    mc, mc_cloud = InMemoryMinio(), InMemoryMinio()
+    repository = BatchRepository(mc, mc_cloud)
+    points = [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]]
+
+    # アップロードを位置合わせせずに latest へ合成し、その変換を履歴に残す（AlignmentUsecase と同じ流れ）
+    upload = _point_cloud(points)
+    merged, _, stats = registration.align_and_merge(_point_cloud([[0.0, 0.0, 0.0]]), [upload])
+    repository.latest_repository.save(batch_repository.LOCAL_BUCKET, GEOHASH, merged)
+    body, length = ply_codec.encode_ply(ply_codec.from_point_cloud(upload))
+    mc.put_object(batch_repository.LOCAL_BUCKET, f"uploads/{GEOHASH}/b.ply", body, length)
+    db.execute(
+        text("INSERT INTO pc_uploaded_history (id, area_id, object_key, transform) VALUES (7, 1, :key, :t)"),
+        {"key": f"uploads/{GEOHASH}/b.ply", "t": json.dumps(stats[0]["transform"])},
+    )
+
+    uploads = SyncWatermarkRepository().list_merged_uploads(db, 1, 0)
+    etag = repository.upload_delta_for_geohash(GEOHASH, "previous-etag", uploads)
+
+    assert etag is not None
+    delta_key = repository.cloud_tmp_delta_key(GEOHASH, 7, 7)
+    sent = ply_codec.read_ply(io.BytesIO(mc_cloud.objects[(batch_repository.CLOUD_BUCKET, delta_key)]))
+    assert np.allclose(np.sort(sent["points"], axis=0), points)
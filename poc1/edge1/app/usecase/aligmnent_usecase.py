@@ -1,34 +1,39 @@
 from minio import Minio
-import open3d as o3d
+import numpy as np
 import os
 import pygeohash
 import re
+from typing import Optional
 from datetime import datetime, timezone, timedelta
+from repository import ply_codec
 from repository.alignment_repository import AlignmentRepository
+from repository.async_s3 import AsyncS3
+from repository.latest_cache import LatestCache
+from repository.latest_repository import LatestRepository
+from repository.registration_artifact_repository import RegistrationArtifactRepository
+from repository.upload_reservation_repository import UploadReservationRepository
+from usecase import registration, voxel_map
+from compute_pool import ComputePool
 from db import SessionLocal      
 from logging_utils import log_duration
 
 BUCKET = "edge1-point-cloud"
-VOXEL = 0.1
-DIST_RANSAC = VOXEL * 1.0
-DIST_ICP    = VOXEL * 0.5
 
 
 def utc_ts():
     return datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
 
 class AligmentUsecase:
-    def __init__(self, merge_pc: o3d.geometry.PointCloud, mc: Minio, s3: any):
-        self.merge_pc = merge_pc
+    # s3: MinIO への非同期アダプタ（あれば webhook の取り込みで uploads/ へのコピーをイベントループ上で行う）
+    def __init__(self, mc: Minio, compute_pool: ComputePool, latest_cache: LatestCache, s3: Optional[AsyncS3] = None):
         self.mc = mc
-        self.s3 = s3
-        self.alignment_repository = AlignmentRepository(mc)
-        
-    # 前処理（ダウンサンプリング＋法線推定）
-    def preprocess(self, pc: o3d.geometry.PointCloud) -> o3d.geometry.PointCloud:
-        p = pc.voxel_down_sample(VOXEL)
-        p.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=VOXEL*2, max_nn=30))
-        return p
+        self.compute_pool = compute_pool
+        self.latest_cache = latest_cache
+        self.alignment_repository = AlignmentRepository(mc, s3)
+        self.artifact_repository = RegistrationArtifactRepository(mc)
+        # latest の PLY のデコード・エンコードもプロセスプールで行う
+        self.latest_repository = LatestRepository(mc, codec=compute_pool)
+        self.upload_reservation_repository = UploadReservationRepository()
 
     # key（フルパス）からファイル名を取り出して geohash を算出
     def calc_geohash(self, key: str) -> str:
@@ -56,134 +61,180 @@ class AligmentUsecase:
         upload_key  = f"{base_prefix}/uploads/{token}/{ts_ms}-{os.path.basename(src_key)}"
         return base_prefix, latest_key, upload_key
 
-    def execute(self, src_key: str, request_id: str, start_time: int):
-        with log_duration("alignment.calc_geohash"):
-            geohash = self.calc_geohash(src_key)
-        base_prefix, latest_key, upload_key = self._paths(geohash, src_key)
-
-        # 履歴にオリジナルをまず保存
+    # webhook の取り込み: オリジナルを uploads/ へ履歴としてコピーし、コピー先を job に記録する
+    #   非同期アダプタがあればイベントループ上で行い、無ければドレイン側（execute_batch）でコピーする
+    async def ingest(self, geohash: str, job):
+        if self.alignment_repository.s3 is None:
+            return
+        _, _, upload_key = self._paths(geohash, job.src_key)
         with log_duration("alignment.copy_to_uploads"):
-            self.alignment_repository.copy_to_uploads(BUCKET, src_key, upload_key)
-
-        # latest が無ければ初期化（マージなし）
-        if self.alignment_repository.check_folder_exists(BUCKET, latest_key) is None:
-            with log_duration("alignment.initialize_latest_upload"):
-                self.alignment_repository.upload_ply(BUCKET, latest_key, self.merge_pc)
-            with log_duration("alignment.initialize_save_metadata"):
-                db = SessionLocal()
-                try:
-                    self.alignment_repository.save_pc_metadata(
-                        db,
-                        geohash,
-                        len(geohash),
-                        os.path.basename(upload_key),
-                        upload_key,
-                        self.s3.get("object", {}).get("size"),
-                        "application/octet-stream",
-                    )
-                finally:
-                    db.close()
+            await self.alignment_repository.acopy_to_uploads(BUCKET, job.src_key, upload_key)
+        job.upload_key = upload_key
+
+    # アップロード1件分のメタデータを保存
+    def _save_metadata(self, geohash: str, upload_key: str, s3: dict, transform=None):
+        db = SessionLocal()
+        try:
+            self.alignment_repository.save_pc_metadata(
+                db,
+                geohash,
+                len(geohash),
+                os.path.basename(upload_key),
+                upload_key,
+                s3.get("object", {}).get("size"),
+                "application/octet-stream",
+                transform,
+            )
+        finally:
+            db.close()
+
+    # 予約（upload_reservations）に記録された撮影位置から初期姿勢を作る（予約が無いものは None）
+    def _geo_prior_inits(self, geohash: str, jobs: list) -> list:
+        db = SessionLocal()
+        try:
+            inits = []
+            for job in jobs:
+                loc = self.upload_reservation_repository.find_location_by_object_key(db, job.src_key)
+                inits.append(registration.geo_prior_transform(geohash, *loc) if loc else None)
+            return inits
+        finally:
+            db.close()
+
+    # 各アップロードが latest の座標系で占めそうな範囲（初期姿勢があれば移した後の範囲）を MERGE_VOXEL_SIZE だけ広げて返す
+    def _upload_bounds(self, merge_pcs: list, inits) -> list:
+        pad = voxel_map.MERGE_VOXEL_SIZE
+        bounds = []
+        for pc, init in zip(merge_pcs, inits or [None] * len(merge_pcs)):
+            pts = np.asarray(pc.points)
+            if len(pts) == 0:
+                continue
+            lo, hi = pts.min(axis=0), pts.max(axis=0)
+            if init is not None:
+                corners = np.array([[x, y, z, 1.0] for x in (lo[0], hi[0]) for y in (lo[1], hi[1]) for z in (lo[2], hi[2])])
+                moved = corners @ np.asarray(init).T
+                lo, hi = moved[:, :3].min(axis=0), moved[:, :3].max(axis=0)
+            bounds.append(((lo - pad).tolist(), (hi + pad).tolist()))
+        return bounds
+
+    # 同じ geohash に溜まったアップロードをまとめて処理し、latest の DL/合成/UP を1回で済ませる
+    def execute_batch(self, geohash: str, jobs: list):
+        latest_key = self.latest_repository.key(geohash)
+
+        # 各アップロードを読み込み、履歴にオリジナルを保存
+        merge_pcs = []
+        upload_keys = []
+        for job in jobs:
+            with log_duration("webhook.download_object"):
+                data = self.alignment_repository.download_bytes(job.bucket, job.src_key)
+            with log_duration("alignment.decode_upload"):
+                pc = ply_codec.to_point_cloud(self.compute_pool.decode_ply(data))
+            upload_key = job.upload_key
+            if upload_key is None:
+                _, _, upload_key = self._paths(geohash, job.src_key)
+                with log_duration("alignment.copy_to_uploads"):
+                    self.alignment_repository.copy_to_uploads(BUCKET, job.src_key, upload_key)
+            merge_pcs.append(pc)
+            upload_keys.append(upload_key)
+
+        # latest が無ければ先頭のアップロードで初期化し、残りをマージする
+        # 既存の latest はプロセス内キャッシュを優先（stat の ETag が一致すれば DL/パースを省略）
+        st = self.latest_repository.stat(BUCKET, geohash)
+
+        # geo_prior: 予約時の座標から各アップロードの初期姿勢を作る（latest はセル南西角を原点とする ENU 座標で持つ）
+        inits = None
+        if registration.ALIGN_ENABLED and registration.REGISTRATION_MODE == "geo_prior":
+            with log_duration("alignment.geo_prior"):
+                inits = self._geo_prior_inits(geohash, jobs)
+
+        init_transform = None
+        if st is None:
+            self.latest_cache.invalidate(geohash)
+            merged = merge_pcs.pop(0)
+            init_transform = np.eye(4)
+            if inits is not None:
+                # 後続の初期姿勢と同じ座標系になるよう、先頭のアップロードも自分の初期姿勢でセル原点基準へ移す
+                if inits[0] is not None:
+                    init_transform = inits[0]
+                    merged.transform(init_transform)
+                else:
+                    print("MEMO: no reservation for the initializing upload; latest stays in its capture frame")
+                inits = inits[1:]
             print("MEMO: latest not found, initialized")
-            print(f"initialized latest at s3://{BUCKET}/{latest_key}")
-            return
 
-        # latest 読み込み
-        with log_duration("alignment.download_latest"):
-            base_pc = self.alignment_repository.download_ply(BUCKET, latest_key)
-        
-        # 前処理
-        # with log_duration("alignment.preprocess_base"):
-        #     base_pc_preprocessed  = self.preprocess(base_pc)
-        # with log_duration("alignment.preprocess_merge"):
-        #     merge_pc_preprocessed = self.preprocess(self.merge_pc)
-
-        # 特徴量計算
-        # with log_duration("alignment.compute_fpfh_base"):
-        #     fpfh1 = o3d.pipelines.registration.compute_fpfh_feature(
-        #         base_pc_preprocessed,
-        #         o3d.geometry.KDTreeSearchParamHybrid(radius=VOXEL*5, max_nn=100)
-        #     )
-        # with log_duration("alignment.compute_fpfh_merge"):
-        #     fpfh2 = o3d.pipelines.registration.compute_fpfh_feature(
-        #         merge_pc_preprocessed,
-        #         o3d.geometry.KDTreeSearchParamHybrid(radius=VOXEL*5, max_nn=100)
-        #     )
-
-        # RANSAC
-        # with log_duration("alignment.ransac"):
-        #     result_ransac = o3d.pipelines.registration.registration_ransac_based_on_feature_matching(
-        #         merge_pc_preprocessed,                  # source
-        #         base_pc_preprocessed,                   # target
-        #         fpfh2, fpfh1,                           # source_feature, target_feature
-        #         mutual_filter=True,
-        #         max_correspondence_distance=DIST_RANSAC,
-        #         estimation_method=o3d.pipelines.registration.TransformationEstimationPointToPoint(False),
-        #         ransac_n=4,
-        #         checkers=[
-        #             o3d.pipelines.registration.CorrespondenceCheckerBasedOnEdgeLength(0.9),
-        #             o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(DIST_RANSAC)
-        #         ],
-        #         criteria=o3d.pipelines.registration.RANSACConvergenceCriteria(1000000, 1000)
-        #     )
-        # print("RANSAC fitness:", result_ransac.fitness)
-
-        # ICP
-        # with log_duration("alignment.icp"):
-        #     result_icp = o3d.pipelines.registration.registration_icp(
-        #         merge_pc_preprocessed,                  # source
-        #         base_pc_preprocessed,                   # target
-        #         max_correspondence_distance=DIST_ICP,
-        #         init=result_ransac.transformation,
-        #         estimation_method=o3d.pipelines.registration.TransformationEstimationPointToPlane()
-        #     )
-        # print("ICP fitness   :", result_icp.fitness)
-        # print("RMSE          :", result_icp.inlier_rmse)
-        
-        # 座標変換
-        # with log_duration("alignment.transform_full_resolution"):
-        #     T = result_icp.transformation
-        #     merge_aligned = o3d.geometry.PointCloud(self.merge_pc)  # フル解像を変換
-        #     merge_aligned.transform(T)
-
-        # 新規分を真っ赤に（動作確認のため）
-        # n = len(merge_aligned.points)
-        # if n > 0:
-        #     merge_aligned.colors = o3d.utility.Vector3dVector(
-        #         np.tile([1.0, 0.0, 0.0], (n, 1))
-        #     )
-
-        # 合成
-        # with log_duration("alignment.merge_point_clouds"):
-        # merge結果をベース点群として書き換え（同じデータサイズで実験を進めるため）
-        merged = base_pc
-
-        # 保存
+        # キャッシュに無い tiled の latest は、アップロードの範囲に重なるタイルだけを読む（loaded はその範囲）
+        loaded = None
+        if st is not None:
+            merged = self.latest_cache.get(geohash, st.etag)
+            if merged is None:
+                if self.latest_repository.layout == "tiled":
+                    loaded = self._upload_bounds(merge_pcs, inits)
+                with log_duration("alignment.download_latest"):
+                    merged = self.latest_repository.load(BUCKET, geohash, loaded)
+                if loaded is not None and not merged.has_points() and registration.ALIGN_ENABLED:
+                    # 推定した範囲に既存の点が無い（位置合わせの相手がいない）ので全体を読む
+                    loaded = None
+                    with log_duration("alignment.download_latest"):
+                        merged = self.latest_repository.load(BUCKET, geohash)
+                if loaded is None:
+                    self.latest_cache.put(geohash, st.etag, merged)
+
+        # 既存 latest の位置合わせ用 artifact（前処理・FPFH 済み）があれば再利用する
+        target_arrays = None
+        if merge_pcs and st is not None and registration.ALIGN_ENABLED:
+            with log_duration("alignment.load_registration_artifact"):
+                target_arrays = self.artifact_repository.load(BUCKET, geohash, st.etag)
+
+        # 位置合わせ・合成はプロセスプール側で実行（API のスレッドプールを塞がない）
+        base = merged
+        new_target = None
+        stats = []
+        if merge_pcs:
+            with log_duration("alignment.align_and_merge"):
+                merged, new_target, stats = self.compute_pool.align_and_merge(base, merge_pcs, target_arrays, inits)
+
+        # 保存（latest の書き換えはまとめて1回。tiled では合成で変化した範囲のタイルだけ）
+        bounds = None if st is None else self.latest_repository.bounds_of(stats)
+        if loaded is not None and not self.latest_repository.covers(loaded, bounds):
+            # 位置合わせで読んでいないタイルまで動いたので、全体を読み直して合成し直す
+            print("MEMO: aligned uploads reach tiles that were not loaded; reloading the whole latest")
+            with log_duration("alignment.download_latest"):
+                base = self.latest_repository.load(BUCKET, geohash)
+            loaded = None
+            with log_duration("alignment.align_and_merge"):
+                merged, new_target, stats = self.compute_pool.align_and_merge(base, merge_pcs, target_arrays, inits)
+            bounds = self.latest_repository.bounds_of(stats)
+        registration.observe_stats(stats)
+
         with log_duration("alignment.upload_latest"):
-            self.alignment_repository.upload_ply(BUCKET, latest_key, merged)
+            etag = self.latest_repository.save(BUCKET, geohash, merged, bounds, loaded)
+        if loaded is not None:
+            # 一部のタイルだけの点群なので、キャッシュにも artifact にも残さない
+            self.latest_cache.invalidate(geohash)
+            new_target = None
+        else:
+            self.latest_cache.put(geohash, etag, merged)
+        if new_target is not None:
+            with log_duration("alignment.save_registration_artifact"):
+                self.artifact_repository.save(BUCKET, geohash, etag, new_target)
+        # 各アップロードを latest の座標系へ移した変換（差分同期で使う。合成していないものは None）
+        transforms = [None] * len(jobs)
+        n_init = len(jobs) - len(merge_pcs)
+        if n_init:
+            transforms[0] = np.asarray(init_transform).tolist()
+        for i, s in enumerate(stats):
+            transforms[n_init + i] = s.get("transform")
         with log_duration("alignment.save_metadata"):
-            db = SessionLocal()
-            try:
-                self.alignment_repository.save_pc_metadata(
-                    db,
-                    geohash,
-                    len(geohash),
-                    os.path.basename(upload_key),
-                    upload_key,
-                    self.s3.get("object", {}).get("size"),
-                    "application/octet-stream",
-                )
-            finally:
-                db.close()
-        # print("[debug] base points:", len(base_pc.points), "colors:", base_pc.has_colors(), "normals:", base_pc.has_normals())
-        # print("[debug] merge points:", len(self.merge_pc.points), "colors:", self.merge_pc.has_colors(), "normals:", self.merge_pc.has_normals())
+            for job, upload_key, transform in zip(jobs, upload_keys, transforms):
+                self._save_metadata(geohash, upload_key, job.s3, transform)
         # print("[debug] merged points:", len(merged.points), "colors:", merged.has_colors(), "normals:", merged.has_normals())
-        
-        print(f"request_{request_id}: end")
-        
+        print(f"MEMO: merged {len(jobs)} uploads into s3://{BUCKET}/{latest_key}")
+
         # 現在時刻を取得
         JST = timezone(timedelta(hours=9))
         now_jst = datetime.now(JST)
         unix_time = int(now_jst.timestamp())
         print(unix_time)
         end_time = int(now_jst.timestamp() * 1000)
-        print(f"total_processed_time: {end_time-start_time}")
+        for job in jobs:
+            print(f"request_{job.request_id}: end")
+            print(f"total_processed_time: {end_time-job.start_time}")
@@ -0,0 +1,103 @@
+from minio import Minio
+from collections import deque
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, Optional, Set
+import os, threading
+from usecase.aligmnent_usecase import AligmentUsecase
+from compute_pool import ComputePool
+from repository.latest_cache import LatestCache
+from repository.negative_cache import NegativeCache
+from repository.async_s3 import AsyncS3
+from logging_utils import log_duration, logger
+
+# 1回のドレインでまとめるアップロード数の上限
+MERGE_MAX_BATCH = int(os.getenv("MERGE_MAX_BATCH", "64"))
+# ドレインを実行するスレッド数の上限（geohash がいくつ来てもこれ以上スレッドを作らない）
+MERGE_WORKERS = int(os.getenv("MERGE_WORKERS", "4"))
+
+
+@dataclass
+class MergeJob:
+    bucket: str
+    src_key: str
+    request_id: str
+    start_time: int
+    s3: dict = field(default_factory=dict)
+    # 取り込み時に uploads/ へコピー済みならそのキー（None ならドレイン側でコピーする）
+    upload_key: Optional[str] = None
+
+
+class MergeScheduler:
+    """geohash ごとにキューを持ち、溜まったアップロードを latest の1回の書き換えにまとめる。
+
+    同じ geohash のドレインは常に1つだけが実行中（_draining）なので、latest への書き込みが競合しない。
+    ドレインは上限つきのスレッドプールで動かし、1バッチごとにプールへ戻して他の geohash にも順番を回す。
+    """
+
+    # negative_cache: latest を書き換えた geohash を「存在しない」扱いから外す
+    # s3: MinIO への非同期アダプタ（取り込みの uploads/ へのコピーに使う）
+    def __init__(self, mc: Minio, compute_pool: ComputePool, latest_cache: LatestCache, negative_cache: Optional[NegativeCache] = None, s3: Optional[AsyncS3] = None):
+        self.mc = mc
+        self.negative_cache = negative_cache
+        self.alignment_usecase = AligmentUsecase(mc, compute_pool, latest_cache, s3)
+        self._lock = threading.Lock()
+        self._queues: Dict[str, Deque[MergeJob]] = {}
+        self._draining: Set[str] = set()
+        self._executor = ThreadPoolExecutor(max_workers=MERGE_WORKERS, thread_name_prefix="merge")
+        self._closed = False
+
+    # 取り込み（uploads/ へのコピー）をイベントループ上で済ませてからキューへ積む
+    async def ingest_and_submit(self, job: MergeJob) -> str:
+        geohash = self.alignment_usecase.calc_geohash(job.src_key)
+        await self.alignment_usecase.ingest(geohash, job)
+        return self.submit(job, geohash)
+
+    def submit(self, job: MergeJob, geohash: Optional[str] = None) -> str:
+        geohash = geohash or self.alignment_usecase.calc_geohash(job.src_key)
+        with self._lock:
+            self._queues.setdefault(geohash, deque()).append(job)
+            if geohash in self._draining:
+                # 実行中のドレインが次のバッチで拾う
+                return geohash
+            self._draining.add(geohash)
+        self._executor.submit(self._drain, geohash)
+        return geohash
+
+    def pending(self, geohash: str) -> int:
+        with self._lock:
+            return len(self._queues.get(geohash, ()))
+
+    # キューから1バッチ取り出して処理し、残りがあればプールの末尾へ積み直す
+    def _drain(self, geohash: str):
+        with self._lock:
+            q = self._queues.get(geohash)
+            if not q or self._closed:
+                self._queues.pop(geohash, None)
+                self._draining.discard(geohash)
+                return
+            batch = [q.popleft() for _ in range(min(len(q), MERGE_MAX_BATCH))]
+        try:
+            with log_duration("merge.drain"):
+                self.alignment_usecase.execute_batch(geohash, batch)
+        except Exception:
+            # uploads/ へのコピーまで済んで latest/メタデータが更新されていない場合があるので、再投入できるよう元のキーを残す
+            logger.exception(
+                "merge drain failed: geohash=%s jobs=%d src_keys=%s",
+                geohash, len(batch), [job.src_key for job in batch],
+            )
+        finally:
+            # 失敗しても latest だけは書けている場合があるので常に外す（Bloom filter の偽陽性は stat 1回分で済む）
+            if self.negative_cache is not None:
+                self.negative_cache.invalidate(geohash)
+        with self._lock:
+            if self._closed:
+                self._draining.discard(geohash)
+                return
+            self._executor.submit(self._drain, geohash)
+
+    # 実行中のバッチだけ終わらせて止める（キューに残ったアップロードは処理しない）
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+        self._executor.shutdown(wait=True)
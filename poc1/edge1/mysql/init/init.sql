@@ -29,6 +29,7 @@ CREATE TABLE IF NOT EXISTS pc_uploaded_history (
   object_key    VARCHAR(512)    NOT NULL,
   size_bytes    BIGINT UNSIGNED NULL,
   content_type  VARCHAR(64)     NULL,
+  transform     JSON            NULL,  -- latest へ合成したときの 4x4 変換行列（NULL は未合成）
   uploaded_at   TIMESTAMP(6)    NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
   PRIMARY KEY (id),
   KEY idx_pu_area_time (area_id, uploaded_at, id),
@@ -42,6 +43,22 @@ CREATE TABLE IF NOT EXISTS pc_uploaded_history (
 
 INSERT INTO pc_uploaded_history (area_id, file_name, object_key, size_bytes, content_type) VALUES (1, 'latest.ply', 'xn1vghzy/latest/latest.ply', 2800, 'application/octet-stream');
 
+-- sync_watermarks: クラウドへ同期済みの latest（ETag と同期時点の areas.updated_at）
+DROP TABLE IF EXISTS sync_watermarks;
+CREATE TABLE IF NOT EXISTS sync_watermarks (
+  area_id          BIGINT UNSIGNED NOT NULL,
+  latest_etag      VARCHAR(128)    NOT NULL,
+  area_updated_at  TIMESTAMP(6)    NOT NULL,
+  last_upload_id   BIGINT UNSIGNED NOT NULL DEFAULT 0,  -- クラウドへ送った pc_uploaded_history.id の最大
+  deltas_since_full INT UNSIGNED   NOT NULL DEFAULT 0,  -- 最後のフルスナップショット以降に送った差分の数
+  synced_at        TIMESTAMP(6)    NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+  PRIMARY KEY (area_id),
+  CONSTRAINT fk_sw_area
+    FOREIGN KEY (area_id) REFERENCES areas(id)
+    ON DELETE CASCADE
+    ON UPDATE RESTRICT
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
 -- upload_reservations: アップロード予約
 DROP TABLE IF EXISTS upload_reservations;
 CREATE TABLE IF NOT EXISTS upload_reservations (
@@ -55,5 +72,6 @@ CREATE TABLE IF NOT EXISTS upload_reservations (
   reserved_at     TIMESTAMP(6)    NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
   PRIMARY KEY (id),
   KEY idx_upload_reservations_user (user_id),
-  KEY idx_upload_reservations_geohash (geohash, reserved_at)
+  KEY idx_upload_reservations_geohash (geohash, reserved_at),
+  KEY idx_upload_reservations_object_key (object_key)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,72 @@
+# エッジ→クラウド API のフォールバック取得に使う非同期 HTTP クライアント
+#   プロセスで1つの httpx.AsyncClient を共有し、クラウドへの接続を keep-alive で使い回す（上限つきの接続プール）
+import os
+from typing import Mapping, Optional
+import httpx
+
+# 同時に張るクラウドへの接続数の上限と、アイドルのまま残しておく接続数
+CLOUD_HTTP_MAX_CONNECTIONS = int(os.getenv("CLOUD_HTTP_MAX_CONNECTIONS", "64"))
+CLOUD_HTTP_MAX_KEEPALIVE = int(os.getenv("CLOUD_HTTP_MAX_KEEPALIVE", "16"))
+CLOUD_HTTP_KEEPALIVE_EXPIRY_SEC = float(os.getenv("CLOUD_HTTP_KEEPALIVE_EXPIRY_SEC", "30"))
+# connect: 接続確立 / read: チャンク間の無通信 / pool: プールの空きを待つ時間[秒]
+CLOUD_HTTP_CONNECT_TIMEOUT_SEC = float(os.getenv("CLOUD_HTTP_CONNECT_TIMEOUT_SEC", "5"))
+CLOUD_HTTP_READ_TIMEOUT_SEC = float(os.getenv("CLOUD_HTTP_READ_TIMEOUT_SEC", "30"))
+CLOUD_HTTP_POOL_TIMEOUT_SEC = float(os.getenv("CLOUD_HTTP_POOL_TIMEOUT_SEC", "10"))
+# true なら HTTP/2（1本の接続に複数の取得を多重化する。クラウド側が h2c に対応している必要がある）
+CLOUD_HTTP2 = os.getenv("CLOUD_HTTP2", "false").lower() == "true"
+
+
+class HttpBody:
+    """httpx のストリーミング応答を _stream_response から本体として扱う（status はクラウドの応答コード）"""
+
+    def __init__(self, resp: httpx.Response):
+        self.resp = resp
+        self.status = resp.status_code
+
+    async def astream(self, amt: int = 32 * 1024):
+        # Content-Length と合うよう、受け取ったバイト列をそのまま流す
+        async for chunk in self.resp.aiter_raw(amt):
+            yield chunk
+
+    async def aclose(self):
+        # 読み切っていれば接続はプールへ戻る
+        await self.resp.aclose()
+
+
+class CloudHttpClient:
+    def __init__(
+        self,
+        max_connections: int = CLOUD_HTTP_MAX_CONNECTIONS,
+        max_keepalive: int = CLOUD_HTTP_MAX_KEEPALIVE,
+        http2: bool = CLOUD_HTTP2,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=CLOUD_HTTP_KEEPALIVE_EXPIRY_SEC,
+        )
+        self.timeout = httpx.Timeout(
+            connect=CLOUD_HTTP_CONNECT_TIMEOUT_SEC,
+            read=CLOUD_HTTP_READ_TIMEOUT_SEC,
+            write=CLOUD_HTTP_CONNECT_TIMEOUT_SEC,
+            pool=CLOUD_HTTP_POOL_TIMEOUT_SEC,
+        )
+        self.http2 = http2
+        self._client: Optional[httpx.AsyncClient] = None
+
+    # イベントループ上で最初に使うときに作る
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout, http2=self.http2)
+        return self._client
+
+    # 本体は読まずに応答ヘッダまで受け取る（本体は HttpBody で流し、aclose で接続を返す）
+    async def get(self, url: str, headers: Optional[Mapping[str, str]] = None) -> httpx.Response:
+        request = self.client.build_request("GET", url, headers=headers)
+        return await self.client.send(request, stream=True)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,89 @@
+# メッシュの LOD ピラミッド（{geohash}/mesh/lod{n}.ply ＋ manifest.json）の生成と読み出し
+import json, os
+import open3d as o3d
+from datetime import datetime
+from minio import Minio
+from minio.error import S3Error
+from typing import List, Optional
+
+# 各 LOD の三角形数（lod0 に対する比率）。lod0 が最も細かく、番号が大きいほど粗い
+MESH_LOD_RATIOS = [float(r) for r in os.getenv("MESH_LOD_RATIOS", "1.0,0.25,0.05").split(",")]
+MANIFEST_NAME = "manifest.json"
+
+NOT_FOUND_CODES = ("NoSuchKey", "NoSuchObject", "NotFound", "NoSuchBucket")
+
+
+def lod_name(level: int) -> str:
+    return f"lod{level}.ply"
+
+
+def mesh_key(geohash: str, name: str) -> str:
+    return f"{geohash}/mesh/{name}"
+
+
+# 1回の Poisson 再構成結果から、quadric decimation で粗い LOD を順に作る
+def build_lod_pyramid(mesh: o3d.geometry.TriangleMesh, ratios: List[float] = MESH_LOD_RATIOS) -> List[o3d.geometry.TriangleMesh]:
+    base_triangles = len(mesh.triangles)
+    levels = []
+    prev = mesh
+    for ratio in ratios:
+        target = max(int(base_triangles * ratio), 4)
+        if target >= len(prev.triangles):
+            lod = prev
+        else:
+            # 直前の LOD から削ると、元メッシュから毎回削るより速い
+            lod = prev.simplify_quadric_decimation(target_number_of_triangles=target)
+            lod = lod.remove_unreferenced_vertices()
+        levels.append(lod)
+        prev = lod
+    return levels
+
+
+def build_manifest(geohash: str, levels: List[o3d.geometry.TriangleMesh], sizes: List[int]) -> dict:
+    return {
+        "geohash": geohash,
+        "updated_at": datetime.now().astimezone().isoformat(),
+        "levels": [
+            {
+                "lod": i,
+                "name": lod_name(i),
+                "triangles": len(m.triangles),
+                "vertices": len(m.vertices),
+                "bytes": size,
+            }
+            for i, (m, size) in enumerate(zip(levels, sizes))
+        ],
+    }
+
+
+# manifest から lod のオブジェクトキーを選ぶ（lod=None は最も粗いレベル。無ければ None）
+def resolve_key(geohash: str, manifest: Optional[dict], lod: Optional[int]) -> Optional[str]:
+    if manifest is None or not manifest["levels"]:
+        return None
+    levels = {lv["lod"]: lv for lv in manifest["levels"]}
+    level = levels.get(max(levels) if lod is None else lod)
+    if level is None:
+        return None
+    return mesh_key(geohash, level["name"])
+
+
+class MeshRepository:
+    def __init__(self, mc: Minio):
+        self.mc = mc
+
+    def load_manifest(self, bucket: str, geohash: str) -> Optional[dict]:
+        try:
+            resp = self.mc.get_object(bucket, mesh_key(geohash, MANIFEST_NAME))
+        except S3Error as e:
+            if e.code in NOT_FOUND_CODES:
+                return None
+            raise
+        try:
+            return json.loads(resp.read())
+        finally:
+            resp.close()
+            resp.release_conn()
+
+    # lod に対応するオブジェクトキーを返す（lod=None は最も粗いレベル。無ければ None）
+    def resolve(self, bucket: str, geohash: str, lod: Optional[int]) -> Optional[str]:
+        return resolve_key(geohash, self.load_manifest(bucket, geohash), lod)
@@ -0,0 +1,33 @@
+# MinIO の1オブジェクトを、読み出すときに get_object（全体 or offset/length 指定）で取りに行くファイルライク
+from minio import Minio
+
+
+class ObjectStream:
+    """GET /pointcloud・/mesh 用。Range があればその範囲だけを ranged get する"""
+
+    def __init__(self, mc: Minio, bucket: str, key: str, size: int):
+        self.mc = mc
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self._resp = None
+
+    def _stream(self, amt: int, **kwargs):
+        self._resp = self.mc.get_object(self.bucket, self.key, **kwargs)
+        try:
+            yield from self._resp.stream(amt)
+        finally:
+            self.close()
+
+    def stream(self, amt: int = 32 * 1024):
+        return self._stream(amt)
+
+    # [start, end]（end を含む）を流す
+    def stream_range(self, start: int, end: int, amt: int = 32 * 1024):
+        return self._stream(amt, offset=start, length=end - start + 1)
+
+    def close(self):
+        if self._resp is not None:
+            self._resp.close()
+            self._resp.release_conn()
+            self._resp = None
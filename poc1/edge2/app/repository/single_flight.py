@@ -0,0 +1,164 @@
+# 同じオブジェクトへの同時の取得を1本の上流ストリームにまとめ、読み込んだチャンクを全員に配る（single-flight）
+#   チャンクは全員が読み終えたところから捨てる。まだ1つも捨てていない間に来たリクエストは先頭から相乗りでき、
+#   捨て始めた後に来たリクエストは自分で上流を開く。取得が終わったらまとめは解散する
+#   本体は非同期（astream / aclose）で、まとめはイベントループ上で動く（上流は別タスクで読む）
+import asyncio, os
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from prometheus_client import Counter
+
+# これより大きい（またはサイズ不明の）本体はまとめずに各自で取得する（遅い読み手がいると最大でこの大きさをメモリに持つ）
+SINGLE_FLIGHT_MAX_BYTES = int(os.getenv("SINGLE_FLIGHT_MAX_BYTES", str(64 * 1024 * 1024)))
+
+SINGLE_FLIGHT_REQUESTS = Counter(
+    "single_flight_requests_total", "downloads by single-flight role (leader fetches, follower shares)", ["role"]
+)
+
+# opener: async () -> (astream(amt) と aclose() を持つ本体, 応答メタ情報, 本体のバイト数 or None)
+Opener = Callable[[], Awaitable[Tuple[object, object, Optional[int]]]]
+
+
+class _Flight:
+    def __init__(self):
+        self.ready = asyncio.Event()
+        self.cond = asyncio.Condition()
+        # chunks[0] は先頭から数えて base 番目のチャンク（それより前は全員が読み終えて捨てた）
+        self.chunks = []
+        self.base = 0
+        # 読み手ごとの次に読むチャンクの番号
+        self.positions: Dict[int, int] = {}
+        self._next_reader = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.open_error: Optional[BaseException] = None
+        self.meta = None
+        self.shared = False
+
+    # 途中から来たリクエストが先頭から読めるか
+    def joinable(self) -> bool:
+        return self.shared and self.base == 0
+
+    def add_reader(self) -> int:
+        reader = self._next_reader
+        self._next_reader += 1
+        self.positions[reader] = self.base
+        return reader
+
+    def remove_reader(self, reader: int):
+        if self.positions.pop(reader, None) is not None:
+            self.trim()
+
+    # 全員が読み終えたチャンクを捨てる（読み手がいなければすべて）
+    def trim(self):
+        end = self.base + len(self.chunks)
+        drop = min(self.positions.values(), default=end) - self.base
+        if drop > 0:
+            del self.chunks[:drop]
+            self.base += drop
+
+
+class FanoutReader:
+    """_Flight のチャンクを先頭から順に読む（aclose しても上流の取得は止めない）
+
+    作った時点で読み手として登録し、読み進めた位置までのチャンクを捨てられるようにする。
+    """
+
+    def __init__(self, flight: _Flight):
+        self.flight = flight
+        self.reader = flight.add_reader()
+
+    async def astream(self, amt: int = 32 * 1024):
+        f = self.flight
+        try:
+            while True:
+                async with f.cond:
+                    i = f.positions[self.reader]
+                    await f.cond.wait_for(lambda: i < f.base + len(f.chunks) or f.done)
+                    batch = f.chunks[i - f.base:]
+                    if not batch:
+                        if f.error is not None:
+                            raise f.error
+                        return
+                # 渡す分は手元に持ったので、全員が読み終えていれば flight からは捨てる
+                f.positions[self.reader] = i + len(batch)
+                f.trim()
+                for chunk in batch:
+                    yield chunk
+        finally:
+            f.remove_reader(self.reader)
+
+    async def aclose(self):
+        self.flight.remove_reader(self.reader)
+
+
+class SingleFlight:
+    def __init__(self, max_bytes: int = SINGLE_FLIGHT_MAX_BYTES, chunk: int = 32 * 1024):
+        self.max_bytes = max_bytes
+        self.chunk = chunk
+        self._flights: Dict[str, _Flight] = {}
+        # 最初のクライアントが切断しても取得を続けるタスク（GC されないよう参照を持つ）
+        self._pumps = set()
+
+    # key の取得に相乗りして (本体, 応答メタ情報) を返す。最初のリクエストだけが opener で上流を開く
+    async def open(self, key: str, opener: Opener):
+        # 同じイベントループ上なので、ここから await までの間に他のリクエストは割り込まない
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = self._flights[key] = _Flight()
+
+        if not leader:
+            SINGLE_FLIGHT_REQUESTS.labels("follower").inc()
+            await flight.ready.wait()
+            if flight.open_error is not None:
+                raise flight.open_error
+            if flight.joinable():
+                return FanoutReader(flight), flight.meta
+            # まとめられない大きさか、先頭のチャンクをもう捨てていたので自分で取りに行く
+            obj, meta, _ = await opener()
+            return obj, meta
+
+        SINGLE_FLIGHT_REQUESTS.labels("leader").inc()
+        try:
+            obj, meta, size = await opener()
+        except BaseException as e:
+            # 404 などは待っていたリクエストにも同じ結果を返す
+            flight.open_error = e
+            self._forget(key, flight)
+            flight.ready.set()
+            raise
+        flight.meta = meta
+        flight.shared = size is not None and size <= self.max_bytes
+        if not flight.shared:
+            self._forget(key, flight)
+            flight.ready.set()
+            return obj, meta
+        # 最初のクライアントが切断しても他のリクエストへ配り続けられるよう、上流は別タスクで読む
+        task = asyncio.ensure_future(self._pump(key, flight, obj))
+        self._pumps.add(task)
+        task.add_done_callback(self._pumps.discard)
+        flight.ready.set()
+        return FanoutReader(flight), meta
+
+    async def _pump(self, key: str, flight: _Flight, obj):
+        try:
+            async for chunk in obj.astream(self.chunk):
+                async with flight.cond:
+                    flight.chunks.append(chunk)
+                    # 読み手が全員切断していれば溜めない
+                    flight.trim()
+                    flight.cond.notify_all()
+        except BaseException as e:
+            flight.error = e
+        finally:
+            try:
+                await obj.aclose()
+            except Exception:
+                pass
+            self._forget(key, flight)
+            async with flight.cond:
+                flight.done = True
+                flight.cond.notify_all()
+
+    def _forget(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
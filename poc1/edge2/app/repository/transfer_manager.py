@@ -0,0 +1,160 @@
+# クラウド MinIO へのマルチパートアップロード（パートを並列に送り、途中で切れたら次の同期で続きから送る）
+#
+# アップロード ID と送り終えたパート（番号 → ETag）を SYNC_TRANSFER_STATE_DIR に JSON で残し、
+# 次回は同じ中身（MD5 = パートの ETag）のパートを送らずに CompleteMultipartUpload だけ行う。
+# minio-py の非公開メソッド（_create_multipart_upload / _upload_part / _complete_multipart_upload）を使うので、
+# requirements.txt で minio のバージョンを固定している（上げるときはシグネチャを確認する）。
+import hashlib, json, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from minio import Minio
+from minio.datatypes import Part
+from minio.error import S3Error
+from prometheus_client import Counter, Histogram
+from typing import Dict, List
+
+# パートサイズ[byte]（S3 の下限は最後のパートを除き 5MiB）。これ以下のファイルは1回の PUT で送る
+SYNC_PART_SIZE = max(int(os.getenv("SYNC_PART_SIZE", str(16 * 1024 * 1024))), 5 * 1024 * 1024)
+# 同時に送るパート数
+SYNC_PART_PARALLEL = int(os.getenv("SYNC_PART_PARALLEL", "4"))
+# 1パートあたりの再送回数（WAN の瞬断を吸収する）
+SYNC_PART_RETRIES = int(os.getenv("SYNC_PART_RETRIES", "3"))
+SYNC_TRANSFER_STATE_DIR = os.getenv("SYNC_TRANSFER_STATE_DIR", "/tmp/sync-transfers")
+
+# 再開できないアップロード（期限切れで消えた等）を表すエラーコード
+RESTART_CODES = ("NoSuchUpload", "InvalidPart", "InvalidPartOrder")
+
+TRANSFER_BYTES = Counter("sync_transfer_bytes_total", "bytes of objects synced to cloud MinIO", ["kind"])
+TRANSFER_SECONDS = Histogram(
+    "sync_transfer_seconds", "per-object upload time to cloud MinIO",
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300),
+)
+TRANSFER_THROUGHPUT = Histogram(
+    "sync_transfer_throughput_bytes_per_second", "per-object upload throughput to cloud MinIO",
+    buckets=(1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8, 5e8),
+)
+TRANSFER_PART_RETRIES = Counter("sync_transfer_part_retries_total", "multipart part uploads retried")
+
+
+class TransferManager:
+  def __init__(
+      self,
+      client: Minio,
+      part_size: int = SYNC_PART_SIZE,
+      parallel: int = SYNC_PART_PARALLEL,
+      retries: int = SYNC_PART_RETRIES,
+      state_dir: str = SYNC_TRANSFER_STATE_DIR,
+  ):
+    self.client = client
+    self.part_size = part_size
+    self.parallel = max(parallel, 1)
+    self.retries = retries
+    self.state_dir = state_dir
+    # 親プロセスで observe_stats するまで溜めておく計測値
+    self._stats: List[dict] = []
+
+  def _state_path(self, bucket: str, key: str) -> str:
+    name = hashlib.sha1(f"{bucket}/{key}".encode("utf-8")).hexdigest()
+    return os.path.join(self.state_dir, f"{name}.json")
+
+  def _load_state(self, bucket: str, key: str):
+    try:
+        with open(self._state_path(bucket, key)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+  def _save_state(self, bucket: str, key: str, state: dict):
+    os.makedirs(self.state_dir, exist_ok=True)
+    path = self._state_path(bucket, key)
+    # 書きかけの JSON を読まないよう、別名で書いてから置き換える
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+  def _drop_state(self, bucket: str, key: str):
+    try:
+        os.remove(self._state_path(bucket, key))
+    except FileNotFoundError:
+        pass
+
+  def _read_part(self, path: str, number: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek((number - 1) * self.part_size)
+        return f.read(self.part_size)
+
+  def _upload_part(self, bucket: str, key: str, upload_id: str, number: int, data: bytes) -> str:
+    for attempt in range(self.retries + 1):
+        try:
+            return self.client._upload_part(bucket, key, data, None, upload_id, number)
+        except S3Error as e:
+            if e.code in RESTART_CODES or attempt == self.retries:
+                raise
+        except Exception:
+            if attempt == self.retries:
+                raise
+        TRANSFER_PART_RETRIES.inc()
+        time.sleep(0.5 * 2 ** attempt)
+
+  def _multipart(self, bucket: str, key: str, path: str, size: int, content_type: str) -> int:
+    state = self._load_state(bucket, key)
+    if state is None:
+        upload_id = self.client._create_multipart_upload(bucket, key, {"Content-Type": content_type})
+        state = {"upload_id": upload_id, "parts": {}}
+        self._save_state(bucket, key, state)
+    upload_id = state["upload_id"]
+    done: Dict[str, str] = dict(state["parts"])
+    lock = threading.Lock()
+    sent = [0]
+
+    def send(number: int) -> Part:
+        data = self._read_part(path, number)
+        # 前回送った同じ中身のパートはそのまま使う
+        if done.get(str(number)) == hashlib.md5(data).hexdigest():
+            return Part(number, done[str(number)])
+        etag = self._upload_part(bucket, key, upload_id, number, data)
+        with lock:
+            done[str(number)] = etag
+            sent[0] += len(data)
+            self._save_state(bucket, key, {"upload_id": upload_id, "parts": done})
+        return Part(number, etag)
+
+    count = (size + self.part_size - 1) // self.part_size
+    with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+        parts = list(pool.map(send, range(1, count + 1)))
+    self.client._complete_multipart_upload(bucket, key, upload_id, parts)
+    self._drop_state(bucket, key)
+    return sent[0]
+
+  # path のファイルを bucket+key に送る（part_size を超えるものはマルチパート）
+  def upload_file(self, bucket: str, key: str, path: str, content_type: str = "application/octet-stream"):
+    size = os.path.getsize(path)
+    start = time.perf_counter()
+    if size <= self.part_size:
+        self.client.fput_object(bucket, key, path, content_type=content_type)
+        sent = size
+    else:
+        try:
+            sent = self._multipart(bucket, key, path, size, content_type)
+        except S3Error as e:
+            if e.code not in RESTART_CODES:
+                raise
+            # アップロード ID が使えなくなっていたら最初から送り直す
+            print(f"MEMO: restart multipart upload of {key}: {e.code}")
+            self._drop_state(bucket, key)
+            sent = self._multipart(bucket, key, path, size, content_type)
+    self._stats.append({"bytes": size, "sent": sent, "seconds": time.perf_counter() - start})
+
+  # 溜めた計測値を取り出す（ワーカープロセスから親へ返す）
+  def drain_stats(self) -> List[dict]:
+    stats, self._stats = self._stats, []
+    return stats
+
+
+# upload_file の計測値を Prometheus に記録する（ワーカープロセスではなく /metrics を持つ親プロセスで呼ぶ）
+def observe_stats(stats: List[dict]):
+  for st in stats:
+    TRANSFER_BYTES.labels("sent").inc(st["sent"])
+    TRANSFER_BYTES.labels("resumed").inc(st["bytes"] - st["sent"])
+    TRANSFER_SECONDS.observe(st["seconds"])
+    if st["seconds"] > 0:
+        TRANSFER_THROUGHPUT.observe(st["sent"] / st["seconds"])
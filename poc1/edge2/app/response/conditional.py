@@ -0,0 +1,41 @@
+# 条件付き GET（If-None-Match / If-Modified-Since → 304 Not Modified）
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+# MinIO の ETag（引用符なし）を HTTP の強い ETag にする
+def strong_etag(etag: str) -> str:
+    return '"' + etag.strip('"') + '"'
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match は弱い比較（W/ を無視して比べる）
+    if if_none_match.strip() == "*":
+        return True
+    tags = [t.strip() for t in if_none_match.split(",")]
+    bare = etag[2:] if etag.startswith("W/") else etag
+    return any((t[2:] if t.startswith("W/") else t) == bare for t in tags)
+
+
+# 304 を返してよいなら True（If-None-Match があれば If-Modified-Since は見ない）
+def not_modified(
+    etag: Optional[str],
+    last_modified: Optional[datetime],
+    if_none_match: Optional[str],
+    if_modified_since: Optional[str],
+) -> bool:
+    if if_none_match:
+        return etag is not None and _etag_matches(if_none_match, etag)
+    if not if_modified_since or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    # HTTP の日付は秒単位
+    return last_modified.replace(microsecond=0) <= since
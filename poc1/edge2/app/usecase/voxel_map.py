@@ -0,0 +1,103 @@
+# latest をボクセルハッシュの地図として保持し、1ボクセルあたりの点数に上限を設けて合成する
+import os
+import numpy as np
+import open3d as o3d
+from typing import Dict, List
+from repository import ply_codec
+
+# concat: 従来どおり base + merge を連結 / voxel: ボクセルごとに点数を制限して統合
+MERGE_MODE = os.getenv("MERGE_MODE", "voxel")
+# ボクセル一辺[m]と1ボクセルに残す点数の上限（新しい観測を優先して残す）
+MERGE_VOXEL_SIZE = float(os.getenv("MERGE_VOXEL_SIZE", "0.05"))
+MERGE_MAX_POINTS_PER_VOXEL = int(os.getenv("MERGE_MAX_POINTS_PER_VOXEL", "4"))
+# true なら残した点の色をボクセル内の全観測の平均色にする
+MERGE_AVERAGE_COLORS = os.getenv("MERGE_AVERAGE_COLORS", "true").lower() == "true"
+
+# ボクセル座標を 21bit ずつ 1 つの int64 に詰める（±2^20 ボクセルまで）
+_KEY_BITS = 21
+_KEY_OFFSET = 1 << (_KEY_BITS - 1)
+_KEY_MASK = (1 << _KEY_BITS) - 1
+
+
+def voxel_keys(points: np.ndarray, voxel: float) -> np.ndarray:
+    idx = np.floor(points / voxel).astype(np.int64) + _KEY_OFFSET
+    if idx.size and (idx.min() < 0 or idx.max() > _KEY_MASK):
+        raise ValueError(f"point cloud extent too large for voxel size {voxel}")
+    return (idx[:, 0] << (2 * _KEY_BITS)) | (idx[:, 1] << _KEY_BITS) | idx[:, 2]
+
+
+def _concat(arrays_list: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    # すべての点群が持っている属性だけを残す（Open3D の + と同じ挙動）
+    arrays_list = [a for a in arrays_list if "points" in a and len(a["points"]) > 0]
+    if not arrays_list:
+        return {"points": np.empty((0, 3))}
+    names = set.intersection(*(set(a) for a in arrays_list))
+    return {n: np.concatenate([a[n] for a in arrays_list]) for n in names}
+
+
+# arrays_list を古い順（先頭が base）に受け取り、新しい点が入ったボクセルだけを統合し直す
+#   新しい点の入らないボクセルの base の点はそのまま残す（tiled の latest で書き換えないタイルと内容を一致させるため）
+def integrate(
+    arrays_list: List[Dict[str, np.ndarray]],
+    voxel: float = MERGE_VOXEL_SIZE,
+    max_points: int = MERGE_MAX_POINTS_PER_VOXEL,
+    average_colors: bool = MERGE_AVERAGE_COLORS,
+) -> Dict[str, np.ndarray]:
+    base, updates = arrays_list[0], _concat(arrays_list[1:])
+    if len(updates["points"]) == 0:
+        return base
+    if "points" not in base or len(base["points"]) == 0:
+        return _reduce(updates, voxel, max_points, average_colors)
+
+    dirty = np.isin(voxel_keys(base["points"], voxel), voxel_keys(updates["points"], voxel))
+    names = set(base) & set(updates)
+    untouched = {n: base[n][~dirty] for n in names}
+    touched = _reduce(
+        _concat([{n: base[n][dirty] for n in names}, updates]), voxel, max_points, average_colors
+    )
+    return _concat([untouched, touched])
+
+
+# ボクセルごとに新しい方から max_points 点だけ残す（merged は古い順に並んでいる前提）
+def _reduce(
+    merged: Dict[str, np.ndarray], voxel: float, max_points: int, average_colors: bool
+) -> Dict[str, np.ndarray]:
+    n = len(merged["points"])
+    if n == 0:
+        return merged
+
+    keys = voxel_keys(merged["points"], voxel)
+    # 安定ソートなのでボクセル内では入力順（古い→新しい）が保たれる
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    counts = np.diff(np.r_[starts, n])
+    group = np.repeat(np.arange(len(starts)), counts)
+    # ボクセル内で後ろから数えた順位（0 が最新）
+    rank_from_end = np.repeat(starts + counts, counts) - 1 - np.arange(n)
+    keep = rank_from_end < max_points
+    kept = order[keep]
+
+    out = {name: a[kept] for name, a in merged.items()}
+    if average_colors and "colors" in merged:
+        colors = merged["colors"][order]
+        means = np.stack(
+            [np.bincount(group, weights=colors[:, c], minlength=len(starts)) for c in range(3)], axis=1
+        ) / counts[:, None]
+        out["colors"] = means[group[keep]]
+    return out
+
+
+# base に aligned（位置合わせ済みの新規点群、古い順）を合成する
+def merge_point_clouds(
+    base_pc: o3d.geometry.PointCloud, aligned_pcs: List[o3d.geometry.PointCloud]
+) -> o3d.geometry.PointCloud:
+    if MERGE_MODE == "concat":
+        merged = base_pc
+        for pc in aligned_pcs:
+            merged = merged + pc
+        return merged
+    if MERGE_MODE != "voxel":
+        raise ValueError(f"unknown MERGE_MODE: {MERGE_MODE} (choose from concat, voxel)")
+    arrays = [ply_codec.from_point_cloud(pc) for pc in [base_pc, *aligned_pcs]]
+    return ply_codec.to_point_cloud(integrate(arrays))
@@ -1,16 +1,25 @@
-from fastapi import FastAPI, Request, status, BackgroundTasks, HTTPException, Response, APIRouter
+from fastapi import FastAPI, Request, status, BackgroundTasks, HTTPException, Response, APIRouter, Query
 from fastapi.responses import StreamingResponse
 from starlette.background import BackgroundTask as StarletteBackgroundTask
 from urllib.parse import unquote
 from minio import Minio
-from usecase.aligmnent_usecase import AligmentUsecase
-import open3d as o3d
-import os, asyncio, tempfile, secrets
+from usecase.merge_scheduler import MergeScheduler, MergeJob
+from compute_pool import ComputePool
+from repository.latest_cache import LatestCache
+from repository.cloud_cache import CloudCache
+from repository.single_flight import SingleFlight
+from repository.cloud_http import CloudHttpClient
+from repository.async_s3 import AsyncS3
+from repository.negative_cache import NegativeCache
+from repository.alignment_repository import AlignmentRepository
+from response import byte_range, conditional
+import os, secrets
 from usecase.batch_usecase import BatchUsecase
 from usecase.stream_usecase import StreamUsecase
 from datetime import timezone, datetime
 from email.utils import parsedate_to_datetime
 from pydantic import BaseModel, Field
+from typing import Mapping, Optional
 import pygeohash
 from decimal import Decimal
 from db import SessionLocal
@@ -82,6 +91,45 @@ mc_cloud = Minio(CLOUD_MINIO_ENDPOINT, CLOUD_MINIO_ACCESS_KEY, CLOUD_MINIO_SECRE
 LOCAL_BUCKET = "edge3-point-cloud"
 CLOUD_BUCKET = "cloud-point-cloud"
 
+# 位置合わせ・合成を実行するプロセスプール（COMPUTE_WORKERS で上限を指定）
+compute_pool = ComputePool()
+
+# デコード済み latest のキャッシュ（LATEST_CACHE_MAX_BYTES で上限を指定、/metrics にヒット率を出す）
+latest_cache = LatestCache()
+# クラウドへフォールバックした GET /pointcloud・/mesh の本体を残すキャッシュ
+cloud_cache = CloudCache()
+# 同じ geohash への同時のフォールバックはクラウドへの取得を1本にまとめる
+single_flight = SingleFlight()
+# クラウド API へのフォールバックは keep-alive の接続プールを共有する（CLOUD_HTTP_* で上限・タイムアウトを指定）
+cloud_http = CloudHttpClient()
+# GET /pointcloud・/mesh はエッジ MinIO も非同期アダプタで stat・取得する（S3_HTTP_* で接続数・タイムアウトを指定）
+async_s3 = AsyncS3(MINIO_ENDPOINT, MINIO_ACCESS_KEY, MINIO_SECRET_KEY, secure=MINIO_SECURE)
+
+
+def _known_geohashes():
+    db = SessionLocal()
+    try:
+        return AlignmentRepository(mc).list_geohashes(db)
+    finally:
+        db.close()
+
+
+# エッジにもクラウドにも無い geohash への GET /pointcloud を問い合わせずに 404 にする
+# （NEGATIVE_BLOOM=true なら areas に無い geohash はエッジの stat を省いてクラウドへ）
+negative_cache = NegativeCache(_known_geohashes)
+
+# geohash 単位でアップロードをまとめて latest へ反映するスケジューラ
+# （uploads/ への履歴コピーは webhook の取り込みで非同期アダプタから行う）
+merge_scheduler = MergeScheduler(mc, compute_pool, latest_cache, negative_cache, s3=async_s3)
+
+# エッジ→クラウド同期（専用スレッド＋SYNC_WORKERS 個のワーカープロセス。ワーカー側で MinIO クライアントを作り直す）
+sync_scheduler = BatchUsecase(
+    mc,
+    mc_cloud,
+    dict(endpoint=MINIO_ENDPOINT, access_key=MINIO_ACCESS_KEY, secret_key=MINIO_SECRET_KEY, secure=MINIO_SECURE),
+    dict(endpoint=CLOUD_MINIO_ENDPOINT, access_key=CLOUD_MINIO_ACCESS_KEY, secret_key=CLOUD_MINIO_SECRET_KEY, secure=CLOUD_MINIO_SECURE),
+)
+
 class  PyroscopeRoute ( APIRoute ): 
     def  get_route_handler ( self ): 
         original_handler = super ().get_route_handler() 
@@ -98,20 +146,20 @@ api_router = APIRouter(prefix= "" , route_class=PyroscopeRoute)
 
 @app.on_event("startup")
 async def _start_sync():
-    app.state.sync_task = asyncio.create_task(BatchUsecase(mc, mc_cloud).periodic_sync_loop())
+    # 同期はイベントループの外で回す（Poisson 再構成や MinIO 転送で /minio/webhook・/pointcloud を止めない）
+    sync_scheduler.start()
 
 @app.on_event("shutdown")
 async def _stop_sync():
-    task = getattr(app.state, "sync_task", None)
-    if task:
-        task.cancel()
-        try:
-            await task
-        except asyncio.CancelledError:
-            pass
+    sync_scheduler.stop()
+    merge_scheduler.shutdown()
+    compute_pool.shutdown()
+    await cloud_http.aclose()
+    await async_s3.aclose()
         
-def handle_record_sync(rec, mc: Minio, request_id: str, start_time: int):
-    with pyroscope.tag_wrapper({"endpoint": "POST:/minio/webhook", "job": "handle_record_sync"}):
+# BackgroundTasks からイベントループ上で実行する（MinIO へのコピーは非同期アダプタで待つのでスレッドを使わない）
+async def handle_record(rec, request_id: str, start_time: int):
+    with pyroscope.tag_wrapper({"endpoint": "POST:/minio/webhook", "job": "handle_record"}):
         s3 = rec.get("s3", {})
         bucket = s3.get("bucket", {}).get("name")
         key = s3.get("object", {}).get("key")
@@ -127,21 +175,10 @@ def handle_record_sync(rec, mc: Minio, request_id: str, start_time: int):
             logger.info("webhook.skipped_event: 0.000s")
             return
         
-        # 一時DL → Open3D で読み込み（整列・マージはフル解像で）
-        with tempfile.NamedTemporaryFile(suffix=".ply", delete=False) as tf:
-            tmp = tf.name
-        try:
-            with log_duration("webhook.download_object"):
-                mc.fget_object(bucket, key, tmp)
-            with log_duration("webhook.read_point_cloud"):
-                pc = o3d.io.read_point_cloud(tmp)
-        finally:
-            try: os.remove(tmp)
-            except FileNotFoundError: pass
-
+        # geohash ごとのキューへ積み、latest の書き換えはドレイン側でまとめて行う
         print("MEMO: bucket:", bucket)
         print("MEMO: object key:", key)
-        AligmentUsecase(pc, mc, s3).execute(key, request_id, start_time)
+        await merge_scheduler.ingest_and_submit(MergeJob(bucket, key, request_id, start_time, s3))
 
 
 @api_router.post("/minio/webhook")
@@ -164,19 +201,23 @@ async def PCLocalAlignmentHandler(request: Request, background: BackgroundTasks)
 
     records = body.get("Records", [body]) if isinstance(body, dict) else []
     for rec in records:
-        background.add_task(handle_record_sync, rec, mc, request_id, start_time)
+        background.add_task(handle_record, rec, request_id, start_time)
 
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
-@api_router.get("/pointcloud/{geohash}")
-def get_city_model(geohash: str):
-    # ユースケース：まずエッジMinIOを探し、無ければクラウドAPI(HTTP)へフォールバック
-    # obj: 本体(ファイルライク/HTTPストリーム), st: メタ情報(MinIO Stat or HTTPヘッダdict)
-    # source/bucket/key: デバッグ・トレース用メタ
-    obj, st, source, bucket, key = StreamUsecase(mc, mc_cloud, geohash).stream()
-
+# StreamUsecase の結果を StreamingResponse にする
+# obj: 本体(ファイルライク/HTTPストリーム), st: メタ情報(MinIO Stat or HTTPヘッダdict)
+# source/bucket/key: デバッグ・トレース用メタ
+# request_headers: クライアントのリクエストヘッダ
+#   エッジの実体なら Range / If-None-Match / If-Modified-Since を自分で評価し、
+#   クラウド経由ならクラウドが返した 206 / 304 をそのまま返す
+def _stream_response(obj, st, source: str, bucket: str, key: str, filename: str, request_headers: Optional[Mapping[str, str]] = None):
+    request_headers = request_headers or {}
+    # httpx の応答ヘッダは dict ではない（httpx.Headers）ので Mapping で判定する
+    from_http = isinstance(st, Mapping)
+    upstream_status = getattr(obj, "status", 200) if from_http else 200
     # --- Last-Modified を統一して取り出す（MinIO属性 or HTTPヘッダ） ---
-    lm = getattr(st, "last_modified", None) or (st.get("Last-Modified") if isinstance(st, dict) else None)
+    lm = getattr(st, "last_modified", None) or (st.get("Last-Modified") if from_http else None)
     # 文字列（HTTPヘッダ）の場合は datetime へパース
     if isinstance(lm, str):
         try:
@@ -191,28 +232,65 @@ def get_city_model(geohash: str):
 
     # --- Content-Length を統一して取り出す（MinIO属性 or HTTPヘッダ） ---
     size_val = getattr(st, "size", None)
-    if size_val is None and isinstance(st, dict):
+    if size_val is None and from_http:
         cl = st.get("Content-Length")
         size_val = int(cl) if cl and cl.isdigit() else None  # 数値にできない場合は未設定（チャンク配信）
 
+    # --- ETag（MinIO の ETag を強い ETag に。クラウド経由はクラウドの ETag） ---
+    etag = st.get("ETag") if from_http else conditional.strong_etag(st.etag)
+
     # --- 応答ヘッダを組み立て（取得元をカスタムヘッダで可視化） ---
-    headers = {
-        **({"Content-Length": str(size_val)} if isinstance(size_val, int) else {}),  # 分かるときだけ付与
+    validators = {
+        **({"ETag": etag} if etag else {}),
         "Last-Modified": lm.strftime("%a, %d %b %Y %H:%M:%S GMT"),  # RFC1123
-        "Content-Disposition": f'attachment; filename="{geohash}.ply"',  # ダウンロード名
-        "X-Pointcloud-Source": source,  # edge / cloud-http
+    }
+    trace_headers = {
+        "X-Pointcloud-Source": source,  # edge / edge-cache（キャッシュヒット） / cloud-http（キャッシュミス）
         "X-Pointcloud-Bucket": bucket,
         "X-Pointcloud-Key": key,
     }
+    # クラウドからの非同期の本体は aclose で接続をプールへ返す
+    close_task = StarletteBackgroundTask(getattr(obj, "aclose", None) or getattr(obj, "close", lambda: None))
 
-    # --- 本体のストリームを最小分岐で生成（メモリに載せず転送） ---
+    # --- 条件付き GET（変わっていなければ本体を読まずに 304） ---
+    if upstream_status == 304 or (not from_http and conditional.not_modified(
+        etag, lm, request_headers.get("If-None-Match"), request_headers.get("If-Modified-Since"),
+    )):
+        return Response(status_code=304, headers={**validators, **trace_headers}, background=close_task)
+
+    headers = {
+        **({"Content-Length": str(size_val)} if isinstance(size_val, int) else {}),  # 分かるときだけ付与
+        **validators,
+        "Content-Disposition": f'attachment; filename="{filename}"',  # ダウンロード名
+        **trace_headers,
+    }
     chunk = 32 * 1024  # 32KB チャンク
-    if hasattr(obj, "stream"):
+
+    # --- Range（エッジの実体は ranged get で 206、クラウド経由はクラウドの応答をそのまま） ---
+    status_code = 200
+    media_type = "application/octet-stream"
+    if hasattr(obj, "stream_range") or hasattr(obj, "astream_range"):
+        headers["Accept-Ranges"] = "bytes"
+        ranges = byte_range.parse_range(request_headers.get("Range"), size_val)
+        if ranges is not None:
+            return byte_range.range_response(obj, ranges, size_val, headers, chunk, close_task)
+    elif from_http:
+        if "Accept-Ranges" in st:
+            headers["Accept-Ranges"] = st["Accept-Ranges"]
+        if upstream_status == 206:
+            status_code = 206
+            media_type = st.get("Content-Type", media_type)
+            # 複数範囲（multipart/byteranges）のときは各パートが Content-Range を持つ
+            if "Content-Range" in st:
+                headers["Content-Range"] = st["Content-Range"]
+
+    # --- 本体のストリームを最小分岐で生成（メモリに載せず転送） ---
+    if hasattr(obj, "astream"):
+        # エッジ MinIO・クラウド API からの非同期ストリーム（イベントループ上で読むのでスレッドを使わない）
+        body_iter = obj.astream(chunk)
+    elif hasattr(obj, "stream"):
         # MinIOオブジェクト（.stream が提供される）
         body_iter = obj.stream(chunk)
-    elif hasattr(obj, "iter_content"):
-        # requests.Response（HTTP経由）
-        body_iter = obj.iter_content(chunk_size=chunk)
     elif hasattr(obj, "read"):
         # urllib3 の raw など read() しかない場合
         body_iter = iter(lambda: obj.read(chunk), b"")
@@ -223,12 +301,29 @@ def get_city_model(geohash: str):
     # --- StreamingResponse で逐次返却。送信完了後に close（あれば）を実行 ---
     return StreamingResponse(
         body_iter,
-        media_type="application/octet-stream",
+        status_code=status_code,
+        media_type=media_type,
         headers=headers,
-        background=StarletteBackgroundTask(getattr(obj, "close", lambda: None)),
+        background=close_task,
     )
 
 
+# フォールバックの転送中もスレッドプールのスレッドを占有しないよう async で受ける
+@api_router.get("/pointcloud/{geohash}")
+async def get_city_model(geohash: str, request: Request):
+    # ユースケース：まずエッジMinIOを探し、無ければクラウドAPI(HTTP)へフォールバック
+    obj, st, source, bucket, key = await StreamUsecase(mc, mc_cloud, geohash, request_headers=request.headers, cloud_cache=cloud_cache, flights=single_flight, negative_cache=negative_cache, cloud_http=cloud_http, s3=async_s3).stream()
+    return _stream_response(obj, st, source, bucket, key, f"{geohash}.ply", request.headers)
+
+
+@api_router.get("/mesh/{geohash}")
+async def get_city_mesh(geohash: str, request: Request, lod: Optional[int] = Query(None, ge=0)):
+    # 同期時に作った LOD ピラミッドから1レベルを返す（lod 省略時は最も粗いレベル）
+    obj, st, source, bucket, key = await StreamUsecase(mc, mc_cloud, geohash, request_headers=request.headers, cloud_cache=cloud_cache, flights=single_flight, cloud_http=cloud_http, s3=async_s3).stream_mesh(lod)
+    name = f"{geohash}-mesh.ply" if lod is None else f"{geohash}-mesh-lod{lod}.ply"
+    return _stream_response(obj, st, source, bucket, key, name, request.headers)
+
+
     
 class UploadPrepareRequest(BaseModel):
     user_id: int = Field(..., ge=1)
@@ -1,13 +1,23 @@
 # [/Users/tadanoyousei/laboratory/poc1/edge/app/repository/batch_repository.py]
 from minio import Minio
 from minio.error import S3Error
-from db import SessionLocal
-from sqlalchemy import text
-import os, tempfile
+from typing import List, Optional
+import io, json, os, tempfile
 import open3d as o3d
 import numpy as np
+from repository.latest_repository import LatestRepository
+from repository.normal_orientation import orient_normals
+from repository import mesh_repository, ply_codec, quantized_codec
+from repository.sync_watermark_repository import MergedUpload
+from repository.transfer_manager import TransferManager
+from logging_utils import log_duration
 
 CLOUD_OBJECT_EXT = os.getenv("CLOUD_OBJECT_EXT", ".ply")
+# クラウドへ送る点群の形式（ply: binary PLY / pcq: 量子化＋zstd。クラウド側で PLY に戻す）
+SYNC_WIRE_FORMAT = os.getenv("SYNC_WIRE_FORMAT", "ply")
+# pcq の座標の量子化幅[m]と zstd の圧縮レベル
+SYNC_QUANT_PRECISION = float(os.getenv("SYNC_QUANT_PRECISION", "0.001"))
+SYNC_ZSTD_LEVEL = int(os.getenv("SYNC_ZSTD_LEVEL", "3"))
 LOCAL_BUCKET = "edge3-point-cloud"
 CLOUD_BUCKET = "cloud-point-cloud"
 VOXEL = 0.15
@@ -16,16 +26,31 @@ class BatchRepository:
   def __init__(self, mc: Minio, mc_cloud: Minio):
     self.mc = mc
     self.mc_cloud = mc_cloud
-  
-  def local_latest_key(self, geohash: str) -> str:
-    return f"{geohash}/latest/latest.ply"
+    self.latest_repository = LatestRepository(mc)
+    # クラウドへの大きなオブジェクト（点群・メッシュ）はマルチパートで送る
+    self.transfer_manager = TransferManager(mc_cloud)
   
   def cloud_tmp_key(self, geohash: str) -> str:
-    return f"tmp/{geohash}{CLOUD_OBJECT_EXT}"
+    ext = ".pcq" if SYNC_WIRE_FORMAT == "pcq" else CLOUD_OBJECT_EXT
+    return f"tmp/{geohash}{ext}"
 
-  def cloud_tmp_mesh_key(self, geohash: str) -> str:
-    return f"tmp/mesh/{geohash}-mesh{CLOUD_OBJECT_EXT}"
+  # LOD ピラミッド（lod{n}.ply / manifest.json）の受け渡し先。クラウド側で {geohash}/mesh/ へコピーされる
+  def cloud_tmp_mesh_key(self, geohash: str, name: str) -> str:
+    return f"tmp/mesh/{geohash}/{name}"
   
+  # 差分（first_id〜last_id のアップロード分）の受け渡し先。クラウド側で {geohash}/deltas/ に置かれ、GET /pointcloud で base につなげて返される
+  def cloud_tmp_delta_key(self, geohash: str, first_id: int, last_id: int) -> str:
+    ext = ".pcq" if SYNC_WIRE_FORMAT == "pcq" else ".ply"
+    return f"tmp/delta/{geohash}/{first_id:012d}-{last_id:012d}{ext}"
+
+  def _encode_for_cloud(self, pcd: o3d.geometry.PointCloud):
+    arrays = ply_codec.from_point_cloud(pcd)
+    if SYNC_WIRE_FORMAT == "pcq":
+      payload = quantized_codec.encode(arrays, SYNC_QUANT_PRECISION, SYNC_ZSTD_LEVEL)
+      return io.BytesIO(payload), len(payload), quantized_codec.CONTENT_TYPE
+    body, length = ply_codec.encode_ply(arrays)
+    return body, length, "application/octet-stream"
+
   def ensure_bucket(self, client: Minio, bucket: str):
     try:
         if not client.bucket_exists(bucket):
@@ -41,55 +66,50 @@ class BatchRepository:
             return None
         raise
       
-  def list_all_geohashes_from_db(self):
-    db = SessionLocal()
-    try:
-        rows = db.execute(text("SELECT geohash FROM areas")).all()
-        return [r[0] for r in rows]
-    finally:
-        db.close()
-
-  def upload_latest_for_geohash(self, geohash: str):
+  # 同期した latest の ETag を返す（latest が無い・synced_etag から変化していない場合は None）
+  def upload_latest_for_geohash(self, geohash: str, synced_etag: Optional[str] = None) -> Optional[str]:
       # local latestが無ければスキップ
-      src_key = self.local_latest_key(geohash)
-      if self.stat_or_none(self.mc, LOCAL_BUCKET, src_key) is None:
-          return False
+      st = self.latest_repository.stat(LOCAL_BUCKET, geohash)
+      if st is None:
+          return None
+      # 前回同期した latest から変わっていなければ、ダウンロード・メッシュ化・アップロードを丸ごと省略
+      if synced_etag is not None and st.etag == synced_etag:
+          return None
       
-      # 一時DL
-      with tempfile.NamedTemporaryFile(suffix=".ply", delete=False) as tf_in:
-        src_tmp = tf_in.name
       # ダウンサンプリング後（点群）書き出し先
       with tempfile.NamedTemporaryFile(suffix=CLOUD_OBJECT_EXT, delete=False) as tf_out:
         dst_tmp = tf_out.name
-      # メッシュ書き出し先
-      with tempfile.NamedTemporaryFile(suffix=CLOUD_OBJECT_EXT, delete=False) as tf_mesh:
-        mesh_tmp = tf_mesh.name
+      # メッシュ（LOD ごと）の書き出し先
+      mesh_tmps = []
         
       try:
-          # MinIO から取得
-          self.mc.fget_object(LOCAL_BUCKET, src_key, src_tmp)
-          
-          # Open3Dで読み込み & ダウンサンプリング
-          pcd = o3d.io.read_point_cloud(src_tmp)
+          # MinIO からストリームで取得し、そのまま読み込み（tiled なら全タイルを結合）
+          pcd = self.latest_repository.load(LOCAL_BUCKET, geohash)
           if pcd.is_empty():
-            # print(f"[sync] skip empty point cloud: {src_key}")
-            return False
+            # print(f"[sync] skip empty point cloud: {geohash}")
+            return None
           
           # ダウンサンプリング
           pcd_ds = pcd.voxel_down_sample(VOXEL)
 
           # ===== 点群(PLY)を書き出し =====
-          write_ok = o3d.io.write_point_cloud(dst_tmp, pcd_ds, write_ascii=False)
-          if not write_ok:
-            # 失敗時はオリジナルを送る
-            dst_tmp = src_tmp
+          if SYNC_WIRE_FORMAT == "pcq":
+            with log_duration("sync.encode_pcq"):
+              payload = quantized_codec.encode(ply_codec.from_point_cloud(pcd_ds), SYNC_QUANT_PRECISION, SYNC_ZSTD_LEVEL)
+            with open(dst_tmp, "wb") as f:
+              f.write(payload)
+          else:
+            write_ok = o3d.io.write_point_cloud(dst_tmp, pcd_ds, write_ascii=False)
+            if not write_ok:
+              raise RuntimeError(f"failed to write downsampled point cloud for {geohash}")
           
           # ===== メッシュ生成 & 書き出し =====
-          # 法線推定 → 一貫方向へ
+          # 法線推定 → 一貫方向へ（MESH_NORMAL_ORIENTATION で方法を選ぶ）
           pcd_ds.estimate_normals(
               search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=max(VOXEL*2, 0.05), max_nn=30)
           )
-          pcd_ds.orient_normals_consistent_tangent_plane(k=30)
+          with log_duration("sync.orient_normals"):
+            orient_normals(pcd_ds)
 
           # Poisson再構成
           mesh, densities = o3d.geometry.TriangleMesh.create_from_point_cloud_poisson(
@@ -109,12 +129,20 @@ class BatchRepository:
           # お好みで調整可
           mesh = mesh.simplify_vertex_clustering(voxel_size=max(VOXEL*0.15, 0.02))
 
+          # 1回の再構成から LOD ピラミッドを作る（lod0 = 上のメッシュ）
+          with log_duration("sync.mesh_lod"):
+            levels = mesh_repository.build_lod_pyramid(mesh)
+
           # メッシュを書き出し（PLY）
           # ※ TriangleMesh用の関数を使用
-          mesh_ok = o3d.io.write_triangle_mesh(mesh_tmp, mesh, write_ascii=False)
-          if not mesh_ok:
-            # print(f"[sync] WARN: failed to write mesh for {geohash} (skip mesh upload)")
-            mesh_tmp = None
+          mesh_ok = True
+          for lod in levels:
+            with tempfile.NamedTemporaryFile(suffix=".ply", delete=False) as tf_mesh:
+              mesh_tmps.append(tf_mesh.name)
+            if not o3d.io.write_triangle_mesh(mesh_tmps[-1], lod, write_ascii=False):
+              # print(f"[sync] WARN: failed to write mesh for {geohash} (skip mesh upload)")
+              mesh_ok = False
+              break
 
           # ===== アップロード =====
           self.ensure_bucket(self.mc_cloud, CLOUD_BUCKET)
@@ -122,22 +150,68 @@ class BatchRepository:
           # 点群
           dst_key = self.cloud_tmp_key(geohash)
           ct = "model/ply" if CLOUD_OBJECT_EXT.lower() == ".ply" else "application/octet-stream"
-          self.mc_cloud.fput_object(CLOUD_BUCKET, dst_key, dst_tmp, content_type=ct)
+          pc_ct = quantized_codec.CONTENT_TYPE if SYNC_WIRE_FORMAT == "pcq" else ct
+          with log_duration("sync.transfer"):
+            self.transfer_manager.upload_file(CLOUD_BUCKET, dst_key, dst_tmp, content_type=pc_ct)
           # print(f"[sync] uploaded (pc) s3://{CLOUD_BUCKET}/{dst_key}")
 
-          # メッシュ
-          if mesh_tmp:
-            dst_key_mesh = self.cloud_tmp_mesh_key(geohash)
-            self.mc_cloud.fput_object(CLOUD_BUCKET, dst_key_mesh, mesh_tmp, content_type=ct)
-            # print(f"[sync] uploaded (mesh) s3://{CLOUD_BUCKET}/{dst_key_mesh}")
+          # メッシュ（エッジにも置いて GET /mesh で返す。manifest は各 LOD の後に書く）
+          if mesh_ok:
+            sizes = [os.path.getsize(p) for p in mesh_tmps]
+            manifest = json.dumps(mesh_repository.build_manifest(geohash, levels, sizes)).encode("utf-8")
+            for i, path in enumerate(mesh_tmps):
+              name = mesh_repository.lod_name(i)
+              self.mc.fput_object(LOCAL_BUCKET, mesh_repository.mesh_key(geohash, name), path, content_type=ct)
+              self.transfer_manager.upload_file(CLOUD_BUCKET, self.cloud_tmp_mesh_key(geohash, name), path, content_type=ct)
+            name = mesh_repository.MANIFEST_NAME
+            self.mc.put_object(
+                LOCAL_BUCKET, mesh_repository.mesh_key(geohash, name), io.BytesIO(manifest), len(manifest),
+                content_type="application/json",
+            )
+            self.mc_cloud.put_object(
+                CLOUD_BUCKET, self.cloud_tmp_mesh_key(geohash, name), io.BytesIO(manifest), len(manifest),
+                content_type="application/json",
+            )
+            # print(f"[sync] uploaded (mesh) s3://{CLOUD_BUCKET}/{self.cloud_tmp_mesh_key(geohash, name)}")
 
-          return True
+          return st.etag
 
       finally:
           # 後片付け
-          for p in (src_tmp, dst_tmp, mesh_tmp):
+          for p in (dst_tmp, *mesh_tmps):
               try:
                   if p:
                       os.remove(p)
               except FileNotFoundError:
                   pass
+
+  # 前回の同期以降に latest へ合成されたアップロードだけを latest の座標系へ移し、差分として送る
+  # 同期した latest の ETag を返す（latest が無い・synced_etag から変化していない場合は None）
+  def upload_delta_for_geohash(self, geohash: str, synced_etag: Optional[str], uploads: List[MergedUpload]) -> Optional[str]:
+      st = self.latest_repository.stat(LOCAL_BUCKET, geohash)
+      if st is None:
+          return None
+      if synced_etag is not None and st.etag == synced_etag:
+          return None
+      # latest は変わったが前回の同期以降に合成されたアップロードが無い
+      if not uploads:
+          return st.etag
+
+      delta = o3d.geometry.PointCloud()
+      for u in uploads:
+          resp = self.mc.get_object(LOCAL_BUCKET, u.object_key)
+          try:
+              pc = ply_codec.to_point_cloud(ply_codec.read_ply(resp))
+          finally:
+              resp.close()
+              resp.release_conn()
+          pc.transform(np.asarray(u.transform))
+          delta += pc
+      delta = delta.voxel_down_sample(VOXEL)
+
+      self.ensure_bucket(self.mc_cloud, CLOUD_BUCKET)
+      dst_key = self.cloud_tmp_delta_key(geohash, uploads[0].id, uploads[-1].id)
+      body, length, ct = self._encode_for_cloud(delta)
+      self.mc_cloud.put_object(CLOUD_BUCKET, dst_key, body, length, content_type=ct)
+      # print(f"[sync] uploaded (delta) s3://{CLOUD_BUCKET}/{dst_key}")
+      return st.etag
@@ -0,0 +1,67 @@
+# geohash → デコード済み latest 点群 の LRU キャッシュ（ETag で有効性を確認する）
+import os, threading
+import numpy as np
+import open3d as o3d
+from collections import OrderedDict
+from typing import Optional, Tuple
+from prometheus_client import Counter, Gauge
+
+# キャッシュに保持する点群の合計バイト数の上限
+LATEST_CACHE_MAX_BYTES = int(os.getenv("LATEST_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+LATEST_CACHE_HITS = Counter("latest_cache_hits_total", "latest point cloud cache hits")
+LATEST_CACHE_MISSES = Counter("latest_cache_misses_total", "latest point cloud cache misses (absent or stale etag)")
+LATEST_CACHE_EVICTIONS = Counter("latest_cache_evictions_total", "latest point cloud cache evictions")
+LATEST_CACHE_BYTES = Gauge("latest_cache_bytes", "bytes held by the latest point cloud cache")
+
+
+def _nbytes(pc: o3d.geometry.PointCloud) -> int:
+    return sum(np.asarray(a).nbytes for a in (pc.points, pc.colors, pc.normals))
+
+
+class LatestCache:
+    """キャッシュした PointCloud は呼び出し側で破壊的に変更しないこと。"""
+
+    def __init__(self, max_bytes: int = LATEST_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[str, o3d.geometry.PointCloud, int]]" = OrderedDict()
+        self._bytes = 0
+
+    # etag が一致するときだけ返す（不一致なら古いエントリを捨てる）
+    def get(self, geohash: str, etag: str) -> Optional[o3d.geometry.PointCloud]:
+        with self._lock:
+            entry = self._entries.get(geohash)
+            if entry is None or entry[0] != etag:
+                if entry is not None:
+                    self._remove(geohash)
+                LATEST_CACHE_MISSES.inc()
+                return None
+            self._entries.move_to_end(geohash)
+            LATEST_CACHE_HITS.inc()
+            return entry[1]
+
+    def put(self, geohash: str, etag: str, pc: o3d.geometry.PointCloud):
+        size = _nbytes(pc)
+        with self._lock:
+            if geohash in self._entries:
+                self._remove(geohash)
+            if size > self.max_bytes:
+                return
+            while self._entries and self._bytes + size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                LATEST_CACHE_EVICTIONS.inc()
+            self._entries[geohash] = (etag, pc, size)
+            self._bytes += size
+            LATEST_CACHE_BYTES.set(self._bytes)
+
+    def invalidate(self, geohash: str):
+        with self._lock:
+            if geohash in self._entries:
+                self._remove(geohash)
+
+    def _remove(self, geohash: str):
+        _, _, size = self._entries.pop(geohash)
+        self._bytes -= size
+        LATEST_CACHE_BYTES.set(self._bytes)
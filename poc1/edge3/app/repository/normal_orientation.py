@@ -0,0 +1,47 @@
+# Poisson 再構成の前に法線の向きを揃える方法。MESH_NORMAL_ORIENTATION で切り替える
+#   mst      : orient_normals_consistent_tangent_plane（リーマン MST。従来どおり、最も遅い）
+#   up       : geohash セルの上方向（+Z）と逆向きの法線を反転（NumPy で一括）
+#   viewpoint: MESH_NORMAL_VIEWPOINT から見える向きに反転（NumPy で一括）
+#   camera   : Open3D の orient_normals_towards_camera_location（viewpoint と同じ基準、比較用）
+import os
+import numpy as np
+import open3d as o3d
+
+MESH_NORMAL_ORIENTATION = os.getenv("MESH_NORMAL_ORIENTATION", "mst")
+# latest のローカル座標での視点。原点は REGISTRATION_MODE=geo_prior なら geohash セルの南西角（ENU）、
+# それ以外は latest を初期化したアップロードの撮影開始位置
+MESH_NORMAL_VIEWPOINT = tuple(float(v) for v in os.getenv("MESH_NORMAL_VIEWPOINT", "0,0,0").split(","))
+MESH_NORMAL_UP = (0.0, 0.0, 1.0)
+MST_K = 30
+
+ORIENTATION_METHODS = ("mst", "up", "viewpoint", "camera")
+
+
+# direction と逆を向いている法線だけ符号を反転する
+def flip_toward_direction(normals: np.ndarray, direction) -> np.ndarray:
+    d = np.asarray(direction, dtype=np.float64)
+    sign = np.where(normals @ d < 0.0, -1.0, 1.0)
+    return normals * sign[:, None]
+
+
+# 各点から viewpoint へのベクトルと逆を向いている法線だけ符号を反転する
+def flip_toward_viewpoint(points: np.ndarray, normals: np.ndarray, viewpoint) -> np.ndarray:
+    to_view = np.asarray(viewpoint, dtype=np.float64) - points
+    sign = np.where(np.einsum("ij,ij->i", normals, to_view) < 0.0, -1.0, 1.0)
+    return normals * sign[:, None]
+
+
+# pcd の法線（推定済み）の向きをその場で揃える
+def orient_normals(pcd: o3d.geometry.PointCloud, method: str = MESH_NORMAL_ORIENTATION, viewpoint=MESH_NORMAL_VIEWPOINT):
+    if method == "mst":
+        pcd.orient_normals_consistent_tangent_plane(k=MST_K)
+    elif method == "up":
+        pcd.normals = o3d.utility.Vector3dVector(flip_toward_direction(np.asarray(pcd.normals), MESH_NORMAL_UP))
+    elif method == "viewpoint":
+        pcd.normals = o3d.utility.Vector3dVector(
+            flip_toward_viewpoint(np.asarray(pcd.points), np.asarray(pcd.normals), viewpoint)
+        )
+    elif method == "camera":
+        pcd.orient_normals_towards_camera_location(np.asarray(viewpoint, dtype=np.float64))
+    else:
+        raise ValueError(f"unknown MESH_NORMAL_ORIENTATION: {method} (choose from {', '.join(ORIENTATION_METHODS)})")
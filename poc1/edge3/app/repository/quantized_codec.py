@@ -0,0 +1,70 @@
+# エッジ→クラウド転送用の量子化点群フォーマット（.pcq）
+#
+#   b"PCQ1" | ヘッダ長(uint32 LE) | ヘッダ(JSON) | zstd 圧縮した本体
+#
+# 本体は属性ごと・軸ごとに連続した配列（x 全点, y 全点, z 全点, r.., g.., b.., nx..）で、圧縮が効きやすい並びにする。
+#   座標: origin（点群の最小角）からの差を precision[m] 単位の整数にし、範囲に応じて uint16 / uint32 で持つ
+#         origin はヘッダに入るので、latest の座標系（geo_prior ならセル南西角基準の ENU）はそのまま復元される
+#   色  : uint8
+#   法線: int8（×127）
+import io, json, struct
+import numpy as np
+import zstandard
+from typing import Dict
+
+MAGIC = b"PCQ1"
+CONTENT_TYPE = "application/x-pcq"
+
+
+def encode(arrays: Dict[str, np.ndarray], precision: float, level: int = 3) -> bytes:
+    points = np.asarray(arrays["points"], dtype=np.float64)
+    count = len(points)
+    origin = points.min(axis=0) if count else np.zeros(3)
+    q = np.rint((points - origin) / precision).astype(np.int64)
+    pos_dtype = "<u2" if count == 0 or q.max() <= np.iinfo(np.uint16).max else "<u4"
+    if count and q.max() > np.iinfo(np.uint32).max:
+        raise ValueError(f"point cloud extent too large for precision {precision}")
+
+    # 点の順序は意味を持たないので、x→y→z で並べ替えて差分が小さくなるようにする
+    order = np.lexsort((q[:, 2], q[:, 1], q[:, 0]))
+    parts = [np.ascontiguousarray(q[order].T, dtype=pos_dtype).tobytes()]
+    header = {
+        "count": count,
+        "precision": precision,
+        "origin": origin.tolist(),
+        "pos_dtype": pos_dtype,
+        "colors": "colors" in arrays,
+        "normals": "normals" in arrays,
+    }
+    if "colors" in arrays:
+        rgb = np.rint(np.clip(arrays["colors"][order], 0.0, 1.0) * 255.0).astype(np.uint8)
+        parts.append(np.ascontiguousarray(rgb.T).tobytes())
+    if "normals" in arrays:
+        n = np.rint(np.clip(arrays["normals"][order], -1.0, 1.0) * 127.0).astype(np.int8)
+        parts.append(np.ascontiguousarray(n.T).tobytes())
+
+    body = zstandard.ZstdCompressor(level=level).compress(b"".join(parts))
+    head = json.dumps(header).encode("utf-8")
+    return MAGIC + struct.pack("<I", len(head)) + head + body
+
+
+def decode(data: bytes) -> Dict[str, np.ndarray]:
+    if data[:4] != MAGIC:
+        raise ValueError("not a pcq payload")
+    (head_len,) = struct.unpack_from("<I", data, 4)
+    header = json.loads(data[8:8 + head_len])
+    raw = zstandard.ZstdDecompressor().decompress(data[8 + head_len:])
+    count = header["count"]
+    buf = io.BytesIO(raw)
+
+    def take(dtype: str) -> np.ndarray:
+        dt = np.dtype(dtype)
+        return np.frombuffer(buf.read(3 * count * dt.itemsize), dtype=dt).reshape(3, count).T
+
+    q = take(header["pos_dtype"])
+    arrays = {"points": q.astype(np.float64) * header["precision"] + np.asarray(header["origin"])}
+    if header["colors"]:
+        arrays["colors"] = take("u1").astype(np.float64) / 255.0
+    if header["normals"]:
+        arrays["normals"] = take("i1").astype(np.float64) / 127.0
+    return arrays
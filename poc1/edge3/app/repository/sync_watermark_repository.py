@@ -0,0 +1,96 @@
+from sqlalchemy.orm import Session
+from sqlalchemy import text
+from datetime import datetime
+import json
+import numpy as np
+from typing import List, NamedTuple, Optional, Tuple
+
+
+class SyncArea(NamedTuple):
+    area_id: int
+    geohash: str
+    updated_at: datetime
+    synced_etag: Optional[str]
+    last_upload_id: int
+    deltas_since_full: int
+
+
+class MergedUpload(NamedTuple):
+    id: int
+    object_key: str
+    transform: list
+
+
+# transform が無い（記録前の）行は latest の座標系のまま合成されたものとして単位行列で扱う
+def _transform(value) -> list:
+    if value is None:
+        return np.eye(4).tolist()
+    return json.loads(value) if isinstance(value, str) else value
+
+
+class SyncWatermarkRepository:
+    """Tracks which latest model (by ETag) and which uploads have already been synced to the cloud per area."""
+
+    # since = (updated_at, id) より後の areas（None なら全件）を、同期済みの状態と一緒に (updated_at, id) 順に返す
+    def list_areas(self, db: Session, since: Optional[Tuple[datetime, int]] = None) -> List[SyncArea]:
+        sql = """
+            SELECT a.id, a.geohash, a.updated_at, w.latest_etag,
+                   COALESCE(w.last_upload_id, 0), COALESCE(w.deltas_since_full, 0)
+            FROM areas a
+            LEFT JOIN sync_watermarks w ON w.area_id = a.id
+        """
+        params = {}
+        if since is not None:
+            # idx_areas_updated_at を使う範囲検索（同じ updated_at の行は id で続きから）
+            sql += " WHERE a.updated_at >= :since_at AND (a.updated_at > :since_at OR a.id > :since_id)"
+            params["since_at"], params["since_id"] = since
+        sql += " ORDER BY a.updated_at, a.id"
+        rows = db.execute(text(sql), params).all()
+        return [SyncArea(*r) for r in rows]
+
+    # DB 側の現在時刻（areas.updated_at と同じ時計で比べるため）
+    def now(self, db: Session) -> datetime:
+        return db.execute(text("SELECT CURRENT_TIMESTAMP(6)")).scalar()
+
+    # after_id より後に latest へ合成されたアップロード（id 順）
+    def list_merged_uploads(self, db: Session, area_id: int, after_id: int) -> List[MergedUpload]:
+        rows = db.execute(
+            text(
+                """
+                SELECT id, object_key, transform
+                FROM pc_uploaded_history
+                WHERE area_id = :area_id AND id > :after_id
+                ORDER BY id
+                """
+            ),
+            {"area_id": area_id, "after_id": after_id},
+        ).all()
+        return [MergedUpload(r[0], r[1], _transform(r[2])) for r in rows]
+
+    def max_upload_id(self, db: Session, area_id: int) -> int:
+        return db.execute(
+            text("SELECT COALESCE(MAX(id), 0) FROM pc_uploaded_history WHERE area_id = :area_id"),
+            {"area_id": area_id},
+        ).scalar()
+
+    def save(self, db: Session, area_id: int, latest_etag: str, area_updated_at: datetime, last_upload_id: int = 0, deltas_since_full: int = 0):
+        db.execute(
+            text(
+                """
+                INSERT INTO sync_watermarks (area_id, latest_etag, area_updated_at, last_upload_id, deltas_since_full)
+                VALUES (:area_id, :latest_etag, :area_updated_at, :last_upload_id, :deltas_since_full)
+                ON DUPLICATE KEY UPDATE
+                    latest_etag       = VALUES(latest_etag),
+                    area_updated_at   = VALUES(area_updated_at),
+                    last_upload_id    = VALUES(last_upload_id),
+                    deltas_since_full = VALUES(deltas_since_full)
+                """
+            ),
+            {
+                "area_id": area_id,
+                "latest_etag": latest_etag,
+                "area_updated_at": area_updated_at,
+                "last_upload_id": last_upload_id,
+                "deltas_since_full": deltas_since_full,
+            },
+        )
@@ -1,27 +1,237 @@
 from repository.batch_repository import BatchRepository
-import os, asyncio
+from repository.sync_watermark_repository import MergedUpload, SyncArea, SyncWatermarkRepository
+from repository import transfer_manager
+from db import SessionLocal
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+from multiprocessing import get_context
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from prometheus_client import Counter, Gauge, Histogram
+import os, threading, time
 from minio import Minio
 
 SYNC_INTERVAL_SEC = int(os.getenv("SYNC_INTERVAL_SEC", "30"))
+# incremental: 前回サイクル以降に更新された areas だけを対象にし、同期済み ETag と同じなら省略 / full: 毎回全 geohash を送る
+SYNC_MODE = os.getenv("SYNC_MODE", "incremental")
+# 同期ワーカープロセス数（0 ならプロセスを使わずスケジューラのスレッドで順に実行）
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", "2"))
+# 1サイクルの締め切り[秒]。過ぎたら未着手の geohash は次のサイクルへ回す
+SYNC_CYCLE_DEADLINE_SEC = float(os.getenv("SYNC_CYCLE_DEADLINE_SEC", "300"))
+# true なら前回の同期以降に合成されたアップロードだけを差分として送る（incremental のときのみ）
+SYNC_DELTA = os.getenv("SYNC_DELTA", "false").lower() == "true"
+# 差分をこの回数送ったら、修復のためにフルスナップショット（＋メッシュ）を送る
+SYNC_FULL_EVERY = int(os.getenv("SYNC_FULL_EVERY", "10"))
+# cursor はこの秒数より前の updated_at までしか進めない。updated_at は文の実行時刻なので、
+# 遅れてコミットしたトランザクションの行が cursor の手前に入ってきても次のサイクルで拾える
+SYNC_CURSOR_LAG_SEC = float(os.getenv("SYNC_CURSOR_LAG_SEC", "30"))
 CLOUD_BUCKET = "cloud-point-cloud"
 
+SYNC_CYCLE_SECONDS = Histogram(
+    "sync_cycle_seconds", "edge to cloud sync cycle duration",
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600),
+)
+SYNC_GEOHASH_SECONDS = Histogram(
+    "sync_geohash_seconds", "per-geohash sync latency", ["result", "kind"],
+    buckets=(0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120),
+)
+SYNC_BACKLOG = Gauge("sync_backlog", "geohashes waiting for or running a sync")
+SYNC_DEADLINE_EXCEEDED = Counter("sync_deadline_exceeded_total", "sync cycles that hit SYNC_CYCLE_DEADLINE_SEC")
+
+class SyncPlan(NamedTuple):
+    area: SyncArea
+    # None ならフルスナップショット、リストならその差分だけを送る
+    uploads: Optional[List[MergedUpload]]
+    # 成功したら watermark に記録する pc_uploaded_history.id
+    upload_id: int
+
+
+# plan を実行して同期した latest の ETag（送らなかったら None）を返す
+def _run_plan(repository: BatchRepository, plan: SyncPlan, synced_etag: Optional[str]) -> Optional[str]:
+    if plan.uploads is None:
+        return repository.upload_latest_for_geohash(plan.area.geohash, synced_etag)
+    return repository.upload_delta_for_geohash(plan.area.geohash, synced_etag, plan.uploads)
+
+
+# ワーカープロセス内の BatchRepository（_init_sync_worker で作る）
+_worker_repository: Optional[BatchRepository] = None
+
+
+def _init_sync_worker(local_config: dict, cloud_config: dict):
+    global _worker_repository
+    _worker_repository = BatchRepository(Minio(**local_config), Minio(**cloud_config))
+
+
+# (同期した latest の ETag or None, 所要秒数, 転送の計測値) を返す
+def _sync_task(plan: SyncPlan, synced_etag: Optional[str]) -> Tuple[Optional[str], float, List[dict]]:
+    start = time.perf_counter()
+    etag = _run_plan(_worker_repository, plan, synced_etag)
+    return etag, time.perf_counter() - start, _worker_repository.transfer_manager.drain_stats()
+
+
 class BatchUsecase:
-  def __init__(self, mc: Minio, mc_cloud: Minio):
+  """エッジ → クラウドの定期同期。API のイベントループとは別スレッドで回し、geohash ごとの処理はワーカープロセスへ投げる。"""
+
+  def __init__(self, mc: Minio, mc_cloud: Minio, local_config: Optional[dict] = None, cloud_config: Optional[dict] = None, workers: int = SYNC_WORKERS):
     self.mc_cloud = mc_cloud
     self.batch_repository = BatchRepository(mc, mc_cloud)
-  
-  async def periodic_sync_loop(self):
+    self.watermark_repository = SyncWatermarkRepository()
+    # 次のサイクルで (areas.updated_at, areas.id) > cursor の行だけを見る（起動直後は None で全件、ETag で省略する）
+    self.cursor: Optional[Tuple[datetime, int]] = None
+    self._executor = None
+    if workers > 0:
+        if local_config is None or cloud_config is None:
+            raise ValueError("SYNC_WORKERS > 0 requires MinIO configs for the worker processes")
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=get_context("spawn"),
+            initializer=_init_sync_worker,
+            initargs=(local_config, cloud_config),
+        )
+    self._lock = threading.Lock()
+    # 実行中・待機中の geohash（締め切りを過ぎても走り続けているものを次のサイクルで重複させない）
+    self._inflight: Dict[str, SyncPlan] = {}
+    self._stop = threading.Event()
+    self._thread = None
+
+  def _save_watermark(self, plan: SyncPlan, etag: str):
+    area = plan.area
+    deltas = 0 if plan.uploads is None else area.deltas_since_full + (1 if plan.uploads else 0)
+    db = SessionLocal()
+    try:
+        self.watermark_repository.save(db, area.area_id, etag, area.updated_at, plan.upload_id, deltas)
+        db.commit()
+    finally:
+        db.close()
+
+  # 1 geohash 分の結果を記録する（成功したら True）
+  def _finish(self, plan: SyncPlan, etag: Optional[str], seconds: float, error: Optional[BaseException]) -> bool:
+    area = plan.area
+    with self._lock:
+        self._inflight.pop(area.geohash, None)
+        SYNC_BACKLOG.set(len(self._inflight))
+    # result: uploaded / skipped / failed、kind: full（スナップショット）/ delta（差分）
+    kind = "full" if plan.uploads is None else "delta"
+    if error is not None:
+        SYNC_GEOHASH_SECONDS.labels("failed", kind).observe(seconds)
+        print(f"[sync] sync failed: geohash={area.geohash}: {error}")
+        return False
+    SYNC_GEOHASH_SECONDS.labels("skipped" if etag is None else "uploaded", kind).observe(seconds)
+    if etag is not None:
+        self._save_watermark(plan, etag)
+    return True
+
+  def _on_done(self, plan: SyncPlan, fut: Future) -> bool:
+    if fut.cancelled():
+        with self._lock:
+            self._inflight.pop(plan.area.geohash, None)
+            SYNC_BACKLOG.set(len(self._inflight))
+        return False
+    try:
+        etag, seconds, transfers = fut.result()
+    except Exception as e:
+        return self._finish(plan, None, 0.0, e)
+    transfer_manager.observe_stats(transfers)
+    return self._finish(plan, etag, seconds, None)
+
+  # 差分で送れるなら差分、そうでなければフルスナップショットの plan を作る
+  def _plan(self, db, area: SyncArea, incremental: bool) -> SyncPlan:
+    use_delta = (
+        SYNC_DELTA and incremental
+        and area.synced_etag is not None
+        and area.deltas_since_full < SYNC_FULL_EVERY
+    )
+    if use_delta:
+        uploads = self.watermark_repository.list_merged_uploads(db, area.area_id, area.last_upload_id)
+        return SyncPlan(area, uploads, uploads[-1].id if uploads else area.last_upload_id)
+    # latest を読む前に取るので、スナップショットにはこの id までのアップロードが必ず含まれる
+    return SyncPlan(area, None, self.watermark_repository.max_upload_id(db, area.area_id))
+
+  def sync_cycle(self):
+    incremental = SYNC_MODE == "incremental"
+    db = SessionLocal()
+    try:
+        # 一覧より前に取る。これより SYNC_CURSOR_LAG_SEC 以上前の行だけを確定済みとみなす
+        settled_before = self.watermark_repository.now(db) - timedelta(seconds=SYNC_CURSOR_LAG_SEC)
+        areas = self.watermark_repository.list_areas(db, self.cursor if incremental else None)
+        with self._lock:
+            busy = set(self._inflight)
+        targets = [self._plan(db, a, incremental) for a in areas if a.geohash not in busy]
+    finally:
+        db.close()
+
+    with self._lock:
+        targets = [p for p in targets if p.area.geohash not in self._inflight]
+        for p in targets:
+            self._inflight[p.area.geohash] = p
+        SYNC_BACKLOG.set(len(self._inflight))
+
+    deadline = time.monotonic() + SYNC_CYCLE_DEADLINE_SEC
+    done: List[SyncArea] = []
+    if self._executor is None:
+        for i, plan in enumerate(targets):
+            if time.monotonic() >= deadline:
+                SYNC_DEADLINE_EXCEEDED.inc()
+                with self._lock:
+                    for rest in targets[i:]:
+                        self._inflight.pop(rest.area.geohash, None)
+                    SYNC_BACKLOG.set(len(self._inflight))
+                break
+            start = time.perf_counter()
+            try:
+                etag = _run_plan(self.batch_repository, plan, plan.area.synced_etag if incremental else None)
+                ok = self._finish(plan, etag, time.perf_counter() - start, None)
+            except Exception as e:
+                ok = self._finish(plan, None, time.perf_counter() - start, e)
+            transfer_manager.observe_stats(self.batch_repository.transfer_manager.drain_stats())
+            if ok:
+                done.append(plan.area)
+    else:
+        futures = {}
+        for plan in targets:
+            fut = self._executor.submit(_sync_task, plan, plan.area.synced_etag if incremental else None)
+            futures[fut] = plan
+        finished, pending = wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+        if pending:
+            SYNC_DEADLINE_EXCEEDED.inc()
+        for fut in finished:
+            if self._on_done(futures[fut], fut):
+                done.append(futures[fut].area)
+        for fut in pending:
+            # 未着手ならキャンセル、実行中なら終わったときに結果だけ記録する
+            if not fut.cancel():
+                fut.add_done_callback(lambda f, p=futures[fut]: self._on_done(p, f))
+            else:
+                self._on_done(futures[fut], fut)
+
+    # (updated_at, id) 順に、成功していて確定済みの area が続く所までしか cursor を進めない。
+    # 成功しなかった area（失敗・締め切り超過・前サイクルから実行中）と、まだ遅れてコミットされる行が
+    # 手前に入りうる新しい area は次のサイクルでも拾う（同期済みなら ETag で省略される）
+    succeeded = {a.geohash for a in done}
+    for a in areas:
+        if a.geohash not in succeeded or a.updated_at > settled_before:
+            break
+        self.cursor = (a.updated_at, a.area_id)
+    # print(f"[sync] cycle done: areas={len(areas)} uploaded={len(done)}")
+    return len(done)
+
+  def _loop(self):
     # 起動時に一度 ensure
     self.batch_repository.ensure_bucket(self.mc_cloud, CLOUD_BUCKET)
 
-    while True:
+    while not self._stop.is_set():
+        start = time.perf_counter()
         try:
-            geos = self.batch_repository.list_all_geohashes_from_db()
-            ok = 0
-            for g in geos:
-                if self.batch_repository.upload_latest_for_geohash(g):
-                    ok += 1
-            # print(f"[sync] cycle done: geohashes={len(geos)} uploaded={ok}")
+            self.sync_cycle()
         except Exception as e:
             print(f"[sync] periodic sync failed: {e}")
-        await asyncio.sleep(SYNC_INTERVAL_SEC)
\ No newline at end of file
+        SYNC_CYCLE_SECONDS.observe(time.perf_counter() - start)
+        self._stop.wait(SYNC_INTERVAL_SEC)
+
+  def start(self):
+    self._thread = threading.Thread(target=self._loop, name="sync-scheduler", daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    self._stop.set()
+    if self._executor is not None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
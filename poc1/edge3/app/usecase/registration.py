@@ -0,0 +1,271 @@
+import os, math, time
+import numpy as np
+import open3d as o3d
+import pygeohash
+from typing import Dict, List, Optional, Tuple
+from prometheus_client import Histogram
+from logging_utils import log_duration, logger
+from usecase.global_registration import GLOBAL_REGISTRATION, get_global_registration
+from usecase import voxel_map
+
+VOXEL = 0.1
+DIST_RANSAC = VOXEL * 1.0
+DIST_ICP    = VOXEL * 0.5
+
+# true で RANSAC+ICP による位置合わせ＋合成を行う（false は位置合わせせず、取り込んだ座標のまま合成する）
+ALIGN_ENABLED = os.getenv("ALIGN_ENABLED", "false").lower() == "true"
+# true で新規分を真っ赤に塗る（動作確認のため）
+ALIGN_DEBUG_COLOR = os.getenv("ALIGN_DEBUG_COLOR", "false").lower() == "true"
+
+# ransac: FPFH + RANSAC で初期姿勢を求める / geo_prior: 予約座標から初期姿勢を作り ICP から始める
+REGISTRATION_MODE = os.getenv("REGISTRATION_MODE", "ransac")
+# geo_prior の ICP 結果がこの fitness 未満なら RANSAC にフォールバック
+GEO_PRIOR_MIN_FITNESS = float(os.getenv("GEO_PRIOR_MIN_FITNESS", "0.3"))
+
+# 多段 ICP（粗→密）のボクセルサイズと各段の最大反復回数（最後の段が VOXEL と一致するのが前提）
+ICP_VOXEL_SIZES = [float(v) for v in os.getenv("ICP_VOXEL_SIZES", "0.4,0.2,0.1").split(",")]
+ICP_MAX_ITERATIONS = [int(v) for v in os.getenv("ICP_MAX_ITERATIONS", "50,30,14").split(",")]
+# 各段の対応距離 = ボクセルサイズ × ICP_DIST_SCALE（既定値で最終段が DIST_ICP と一致）
+ICP_DIST_SCALE = float(os.getenv("ICP_DIST_SCALE", "0.5"))
+# 各段の収束判定（fitness / RMSE の相対変化量）。粗い段ほど緩くして早めに次の段へ進む
+ICP_RELATIVE_FITNESS = [float(v) for v in os.getenv("ICP_RELATIVE_FITNESS", "1e-4,1e-5,1e-6").split(",")]
+ICP_RELATIVE_RMSE = [float(v) for v in os.getenv("ICP_RELATIVE_RMSE", "1e-4,1e-5,1e-6").split(",")]
+
+# 段ごとの設定は ICP_VOXEL_SIZES と同じ数（1つだけなら全段共通）
+for _name, _values in (
+    ("ICP_MAX_ITERATIONS", ICP_MAX_ITERATIONS),
+    ("ICP_RELATIVE_FITNESS", ICP_RELATIVE_FITNESS),
+    ("ICP_RELATIVE_RMSE", ICP_RELATIVE_RMSE),
+):
+    if len(_values) not in (1, len(ICP_VOXEL_SIZES)):
+        raise ValueError(f"{_name} has {len(_values)} values; expected 1 or {len(ICP_VOXEL_SIZES)} (one per ICP_VOXEL_SIZES level)")
+
+
+def _per_level(values: list, i: int):
+    return values[0] if len(values) == 1 else values[i]
+
+REGISTRATION_SECONDS = Histogram(
+    "registration_seconds", "registration time per upload", ["backend", "stage"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60),
+)
+REGISTRATION_FITNESS = Histogram(
+    "registration_fitness", "final ICP fitness per upload", ["backend"],
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+)
+REGISTRATION_RMSE = Histogram(
+    "registration_rmse", "final ICP inlier RMSE per upload", ["backend"],
+    buckets=(0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.2),
+)
+
+# 緯度経度 1 度あたりのおおよその距離[m]
+_M_PER_DEG_LAT = 110540.0
+_M_PER_DEG_LON = 111320.0
+
+
+# 前処理（ダウンサンプリング＋法線推定）
+def preprocess(pc: o3d.geometry.PointCloud) -> o3d.geometry.PointCloud:
+    p = pc.voxel_down_sample(VOXEL)
+    p.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=VOXEL*2, max_nn=30))
+    return p
+
+
+# 特徴量計算（FPFH）
+def compute_fpfh(pc_preprocessed: o3d.geometry.PointCloud):
+    return o3d.pipelines.registration.compute_fpfh_feature(
+        pc_preprocessed,
+        o3d.geometry.KDTreeSearchParamHybrid(radius=VOXEL*5, max_nn=100)
+    )
+
+
+# 位置合わせの基準（ダウンサンプル済み base ＋ 法線 ＋ FPFH）
+class RegistrationTarget:
+    def __init__(self, pc_preprocessed: o3d.geometry.PointCloud, fpfh):
+        self.pc = pc_preprocessed
+        self.fpfh = fpfh
+        self._levels: Dict[float, o3d.geometry.PointCloud] = {}
+
+    # 多段 ICP 用に voxel サイズごとの target を返す（VOXEL 以下は前処理済みの pc をそのまま使う）
+    def level(self, voxel: float) -> o3d.geometry.PointCloud:
+        if voxel <= VOXEL:
+            return self.pc
+        if voxel not in self._levels:
+            self._levels[voxel] = self.pc.voxel_down_sample(voxel)
+        return self._levels[voxel]
+
+    # 永続化・プロセス間受け渡し用の配列に変換（fpfh は 33xN）
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "points": np.asarray(self.pc.points),
+            "normals": np.asarray(self.pc.normals, dtype=np.float32),
+            "fpfh": np.asarray(self.fpfh.data, dtype=np.float32),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "RegistrationTarget":
+        pc = o3d.geometry.PointCloud()
+        pc.points = o3d.utility.Vector3dVector(np.asarray(arrays["points"], dtype=np.float64))
+        pc.normals = o3d.utility.Vector3dVector(np.asarray(arrays["normals"], dtype=np.float64))
+        fpfh = o3d.pipelines.registration.Feature()
+        fpfh.data = np.asarray(arrays["fpfh"], dtype=np.float64)
+        return cls(pc, fpfh)
+
+
+def prepare_target(base_pc: o3d.geometry.PointCloud) -> RegistrationTarget:
+    with log_duration("alignment.preprocess_base"):
+        base_pc_preprocessed = preprocess(base_pc)
+    with log_duration("alignment.compute_fpfh_base"):
+        fpfh1 = compute_fpfh(base_pc_preprocessed)
+    return RegistrationTarget(base_pc_preprocessed, fpfh1)
+
+
+# 撮影位置（予約時の緯度経度）から geohash セル原点（南西角）基準の初期姿勢を作る
+# latest はセル原点を原点とする ENU（x=東, y=北）座標、アップロード点群は撮影位置を原点とする前提
+#   （latest を初期化するアップロードもこの変換で移す。aligmnent_usecase.execute_batch を参照）
+def geo_prior_transform(geohash: str, lat: float, lon: float) -> np.ndarray:
+    c_lat, c_lon, lat_err, lon_err = pygeohash.decode_exactly(geohash)
+    origin_lat, origin_lon = c_lat - lat_err, c_lon - lon_err
+    T = np.identity(4)
+    T[0, 3] = (lon - origin_lon) * _M_PER_DEG_LON * math.cos(math.radians(origin_lat))
+    T[1, 3] = (lat - origin_lat) * _M_PER_DEG_LAT
+    return T
+
+
+# 粗→密の多段 ICP。各段は前段の結果を初期値にする（target 側は法線付きなので point-to-plane）
+def multiscale_icp(target: RegistrationTarget, merge_pc: o3d.geometry.PointCloud, init: np.ndarray):
+    T = init
+    result = None
+    for i, voxel in enumerate(ICP_VOXEL_SIZES):
+        max_iter = _per_level(ICP_MAX_ITERATIONS, i)
+        with log_duration(f"alignment.icp_level{i}"):
+            source = merge_pc.voxel_down_sample(voxel)
+            target_level = target.level(voxel)
+            if source.is_empty() or target_level.is_empty():
+                continue
+            result = o3d.pipelines.registration.registration_icp(
+                source,
+                target_level,
+                max_correspondence_distance=voxel * ICP_DIST_SCALE,
+                init=T,
+                estimation_method=o3d.pipelines.registration.TransformationEstimationPointToPlane(),
+                criteria=o3d.pipelines.registration.ICPConvergenceCriteria(
+                    relative_fitness=_per_level(ICP_RELATIVE_FITNESS, i),
+                    relative_rmse=_per_level(ICP_RELATIVE_RMSE, i),
+                    max_iteration=max_iter,
+                ),
+            )
+        logger.info("icp_level%d: voxel=%.3f fitness=%.5f rmse=%.5f", i, voxel, result.fitness, result.inlier_rmse)
+        T = result.transformation
+    return result
+
+
+# merge_pc を target に位置合わせする変換行列と計測値を返す（base 側の前処理・特徴量は target を再利用）
+# init（geo_prior の初期姿勢）があれば多段 ICP から始め、fitness が足りないときだけ大域位置合わせに落とす
+def register(target: RegistrationTarget, merge_pc: o3d.geometry.PointCloud, init: Optional[np.ndarray] = None) -> Tuple[np.ndarray, dict]:
+    if init is not None:
+        start = time.perf_counter()
+        with log_duration("alignment.geo_prior_icp"):
+            result_prior = multiscale_icp(target, merge_pc, init)
+        if result_prior is not None and result_prior.fitness >= GEO_PRIOR_MIN_FITNESS:
+            return result_prior.transformation, {
+                "backend": "geo_prior",
+                "global_sec": 0.0,
+                "icp_sec": time.perf_counter() - start,
+                "fitness": result_prior.fitness,
+                "rmse": result_prior.inlier_rmse,
+            }
+        print(f"MEMO: geo-prior fitness below {GEO_PRIOR_MIN_FITNESS}, falling back to {GLOBAL_REGISTRATION}")
+
+    base_pc_preprocessed, fpfh1 = target.pc, target.fpfh
+    with log_duration("alignment.preprocess_merge"):
+        merge_pc_preprocessed = preprocess(merge_pc)
+    with log_duration("alignment.compute_fpfh_merge"):
+        fpfh2 = compute_fpfh(merge_pc_preprocessed)
+
+    # 大域位置合わせ（RANSAC / FGR / 時間予算付き RANSAC）
+    backend = get_global_registration(DIST_RANSAC)
+    start = time.perf_counter()
+    with log_duration(f"alignment.global_{backend.name}"):
+        result_global = backend.run(merge_pc_preprocessed, base_pc_preprocessed, fpfh2, fpfh1)
+    global_sec = time.perf_counter() - start
+    print(f"{backend.name} fitness:", result_global.fitness)
+
+    # ICP（粗→密）
+    start = time.perf_counter()
+    with log_duration("alignment.icp"):
+        result_icp = multiscale_icp(target, merge_pc, result_global.transformation)
+    icp_sec = time.perf_counter() - start
+    result = result_icp if result_icp is not None else result_global
+    print("ICP fitness   :", result.fitness)
+    print("RMSE          :", result.inlier_rmse)
+    return result.transformation, {
+        "backend": backend.name,
+        "global_sec": global_sec,
+        "icp_sec": icp_sec,
+        "fitness": result.fitness,
+        "rmse": result.inlier_rmse,
+    }
+
+
+# register の計測値を Prometheus に記録する（ワーカープロセスではなく /metrics を持つ親プロセスで呼ぶ）
+def observe_stats(stats: List[dict]):
+    for st in stats:
+        if "backend" not in st:
+            # 位置合わせしていない（ALIGN_ENABLED=false）
+            continue
+        REGISTRATION_SECONDS.labels(st["backend"], "global").observe(st["global_sec"])
+        REGISTRATION_SECONDS.labels(st["backend"], "icp").observe(st["icp_sec"])
+        REGISTRATION_FITNESS.labels(st["backend"]).observe(st["fitness"])
+        REGISTRATION_RMSE.labels(st["backend"]).observe(st["rmse"])
+
+
+# base_pc に merge_pcs を位置合わせして合成し、(合成結果, 合成結果に対する新しい target, 計測値) を返す
+# ドレイン内のアップロードはすべて同じ base（= 取り込み前の latest）の target に合わせる
+# inits は merge_pcs と同じ並びの初期姿勢（geo_prior。無いものは None）
+def align_and_merge(
+    base_pc: o3d.geometry.PointCloud,
+    merge_pcs: List[o3d.geometry.PointCloud],
+    target: Optional[RegistrationTarget] = None,
+    inits: Optional[List[Optional[np.ndarray]]] = None,
+) -> Tuple[o3d.geometry.PointCloud, Optional[RegistrationTarget], List[dict]]:
+    if ALIGN_ENABLED and target is None:
+        target = prepare_target(base_pc)
+
+    inits = inits or [None] * len(merge_pcs)
+    aligned_pcs = []
+    stats = []
+    for merge_pc, init in zip(merge_pcs, inits):
+        if ALIGN_ENABLED:
+            T, st = register(target, merge_pc, init)
+        else:
+            # 位置合わせせず単位行列で合成する（差分同期でもそのまま送れるよう変換は記録しておく）
+            T, st = np.eye(4), {}
+        # 差分同期でアップロード単体を latest の座標系へ移すために残す
+        st["transform"] = np.asarray(T).tolist()
+        stats.append(st)
+
+        # 座標変換
+        with log_duration("alignment.transform_full_resolution"):
+            merge_aligned = o3d.geometry.PointCloud(merge_pc)  # フル解像を変換
+            merge_aligned.transform(T)
+
+        # 新規分を真っ赤に（動作確認のため）
+        n = len(merge_aligned.points)
+        if ALIGN_DEBUG_COLOR and n > 0:
+            merge_aligned.colors = o3d.utility.Vector3dVector(
+                np.tile([1.0, 0.0, 0.0], (n, 1))
+            )
+
+        # 変化した範囲（tiled の latest で書き換えるタイルの判定に使う）
+        #   voxel 合成では新しい点の入ったボクセル全体の base の点が変わりうるので、ボクセル1つ分広げる
+        if n > 0:
+            pts = np.asarray(merge_aligned.points)
+            pad = voxel_map.MERGE_VOXEL_SIZE if voxel_map.MERGE_MODE == "voxel" else 0.0
+            st["bounds"] = ((pts.min(axis=0) - pad).tolist(), (pts.max(axis=0) + pad).tolist())
+        aligned_pcs.append(merge_aligned)
+
+    # 合成（MERGE_MODE=voxel ならボクセルあたりの点数を制限して latest の大きさを一定に保つ）
+    with log_duration("alignment.merge_point_clouds"):
+        merged = voxel_map.merge_point_clouds(base_pc, aligned_pcs)
+
+    # 次回の位置合わせ用に、新しい latest の前処理・特徴量をここで一度だけ計算する
+    return merged, (prepare_target(merged) if ALIGN_ENABLED else None), stats
@@ -2,48 +2,238 @@
 from minio import Minio
 from minio.error import S3Error
 from fastapi import HTTPException
-from typing import Tuple
-import requests
+from starlette.concurrency import run_in_threadpool
+from typing import Mapping, Optional, Tuple
+import httpx, json
+from datetime import datetime
+from repository.latest_repository import LatestRepository, LatestStat, tiled_body
+from repository.mesh_repository import MANIFEST_NAME, MeshRepository, mesh_key, resolve_key
+from repository.object_stream import ObjectStream
+from repository.async_s3 import AsyncConcatStream, AsyncObjectStream, AsyncS3
+from repository.cloud_cache import CLOUD_CACHE_REQUESTS, CacheEntry, CloudCache
+from repository.cloud_http import CloudHttpClient, HttpBody
+from repository.single_flight import SingleFlight
+from repository.negative_cache import NegativeCache
+from response import conditional
 
 LOCAL_BUCKET_DEFAULT = "edge3-point-cloud"
 CLOUD_BUCKET_DEFAULT = "cloud-point-cloud"
 
 NOT_FOUND_CODES = {"NoSuchKey", "NoSuchObject", "NotFound", "NoSuchBucket"}
 
+CLOUD_API_BASE = "http://host.docker.internal:8100"
+# クラウドへフォールバックするときにクライアントのリクエストから引き継ぐヘッダ（範囲指定・条件付き GET）
+PASSTHROUGH_HEADERS = ("Range", "If-None-Match", "If-Modified-Since")
+
+_default_cloud_http = CloudHttpClient()
+
 class StreamUsecase:
-    def __init__(self, mc_local: Minio, mc_cloud: Minio, geohash: str, local_bucket: str = LOCAL_BUCKET_DEFAULT, cloud_bucket: str = CLOUD_BUCKET_DEFAULT):
+    # request_headers: クライアントのリクエストヘッダ（PASSTHROUGH_HEADERS をクラウドへそのまま渡す）
+    # cloud_cache: クラウドから取った本体を残す read-through キャッシュ（None ならキャッシュしない）
+    # flights: 同じ URL への同時のフォールバックを1本の取得にまとめる（None ならまとめない）
+    # negative_cache: エッジにもクラウドにも無かった geohash を覚えておき、しばらくは問い合わせずに 404 を返す
+    # cloud_http: クラウド API への keep-alive な非同期クライアント（None ならモジュールで共有するクライアント）
+    # s3: エッジ MinIO への非同期アダプタ（None なら mc_local の stat・オープンをスレッドプールで行う）
+    def __init__(self, mc_local: Minio, mc_cloud: Minio, geohash: str, local_bucket: str = LOCAL_BUCKET_DEFAULT, cloud_bucket: str = CLOUD_BUCKET_DEFAULT, request_headers: Optional[Mapping[str, str]] = None, cloud_cache: Optional[CloudCache] = None, flights: Optional[SingleFlight] = None, negative_cache: Optional[NegativeCache] = None, cloud_http: Optional[CloudHttpClient] = None, s3: Optional[AsyncS3] = None):
         self.mc_local = mc_local
         self.mc_cloud = mc_cloud
         self.geohash = geohash
         self.local_bucket = local_bucket
         self.cloud_bucket = cloud_bucket
+        self.request_headers = request_headers or {}
+        self.cloud_cache = cloud_cache
+        self.flights = flights
+        self.negative_cache = negative_cache
+        self.cloud_http = cloud_http or _default_cloud_http
+        self.s3 = s3
 
     def _is_not_found(self, err: S3Error) -> bool:
         return err.code in NOT_FOUND_CODES
 
-    def _try_get(self, mc: Minio, bucket: str, key: str):
-        st = mc.stat_object(bucket, key)
-        obj = mc.get_object(bucket, key)
-        return obj, st
+    # エッジの MinIO は同期クライアントなので、stat・オープンだけスレッドプールで行う（本体は StreamingResponse が読む）
+    def _open_local(self):
+        try:
+            return LatestRepository(self.mc_local).open(self.local_bucket, self.geohash)
+        except S3Error as e:
+            if not self._is_not_found(e):
+                raise HTTPException(status_code=502, detail=f"edge stat/get error: {e.code}")
+            return None
 
-    def stream(self) -> Tuple[any, any, str, str, str]:
-        # 1) edge (局所モデル)
-        local_key = f"{self.geohash}/latest/latest.ply"
+    def _open_local_mesh(self, lod: Optional[int]):
+        try:
+            key = MeshRepository(self.mc_local).resolve(self.local_bucket, self.geohash, lod)
+            if key is None:
+                return None
+            st = self.mc_local.stat_object(self.local_bucket, key)
+            return ObjectStream(self.mc_local, self.local_bucket, key, st.size), st, key
+        except S3Error as e:
+            if not self._is_not_found(e):
+                raise HTTPException(status_code=502, detail=f"edge stat/get error: {e.code}")
+            return None
+
+    # 非同期アダプタで stat して、本体はイベントループ上で流す
+    async def _open_async(self, key: str):
+        try:
+            st = await self.s3.stat_object(self.local_bucket, key)
+        except S3Error as e:
+            if not self._is_not_found(e):
+                raise HTTPException(status_code=502, detail=f"edge stat/get error: {e.code}")
+            return None
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=502, detail=f"edge stat/get error: {e.__class__.__name__}")
+        return AsyncObjectStream(self.s3, self.local_bucket, key, st.size), st, key
+
+    # 小さな JSON（manifest）を非同期アダプタで読み、(内容, ETag) を返す（無ければ None）
+    async def _read_json_async(self, key: str) -> Optional[Tuple[dict, str]]:
         try:
-            obj, st = self._try_get(self.mc_local, self.local_bucket, local_key)
-            return obj, st, "edge", self.local_bucket, local_key
+            resp = await self.s3.get_object(self.local_bucket, key)
+            try:
+                return json.loads(await resp.aread()), resp.headers.get("ETag", "").strip('"')
+            finally:
+                await resp.aclose()
         except S3Error as e:
             if not self._is_not_found(e):
                 raise HTTPException(status_code=502, detail=f"edge stat/get error: {e.code}")
+            return None
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=502, detail=f"edge stat/get error: {e.__class__.__name__}")
+
+    async def _open_latest(self):
+        repo = LatestRepository(self.mc_local)
+        if self.s3 is None:
+            return await run_in_threadpool(self._open_local)
+        if repo.layout == "single":
+            return await self._open_async(repo.latest_key(self.geohash))
+        # tiled はタイルの本体を順に ranged get して1つの PLY としてつなぐ
+        key = repo.manifest_key(self.geohash)
+        found = await self._read_json_async(key)
+        if found is None:
+            return None
+        manifest, etag = found
+        header, parts = tiled_body(manifest)
+        obj = AsyncConcatStream(self.s3, self.local_bucket, header, parts)
+        return obj, LatestStat(etag, obj.size, datetime.fromisoformat(manifest["updated_at"])), key
+
+    async def _open_mesh(self, lod: Optional[int]):
+        if self.s3 is None:
+            return await run_in_threadpool(self._open_local_mesh, lod)
+        found = await self._read_json_async(mesh_key(self.geohash, MANIFEST_NAME))
+        if found is None:
+            return None
+        key = resolve_key(self.geohash, found[0], lod)
+        return await self._open_async(key) if key is not None else None
+
+    async def stream(self) -> Tuple[any, any, str, str, str]:
+        negative = self.negative_cache
+        if negative is not None and negative.is_absent(self.geohash):
+            raise HTTPException(status_code=404, detail="point cloud not found on edge nor cloud")
+
+        # 1) edge (局所モデル)
+        # LATEST_LAYOUT=tiled ならタイルを連結した1つの PLY として返す
+        # エッジの areas に無い geohash（Bloom filter で判定）は stat せずにクラウドへ
+        if negative is None or negative.may_exist(self.geohash):
+            opened = await self._open_latest()
+            if opened is not None:
+                obj, st, local_key = opened
+                return obj, st, "edge", self.local_bucket, local_key
 
         # 2) cloud (大域モデル) クラウド側のAPIへ問い合わせてストリーミング取得
-        cloud_url = f"http://host.docker.internal:8100/pointcloud/{self.geohash}"
         try:
-            resp = requests.get(cloud_url, stream=True, timeout=10)
-            if resp.status_code == 404:
-                raise HTTPException(status_code=404, detail="point cloud not found on edge nor cloud")
-            if resp.status_code >= 400:
-                raise HTTPException(status_code=502, detail=f"cloud http get error: {resp.status_code}")
-            return resp.raw, resp.headers, "cloud-http", "http", cloud_url
-        except requests.RequestException as e:
-            raise HTTPException(status_code=502, detail=f"cloud http request error: {e.__class__.__name__}: {e}")
\ No newline at end of file
+            return await self._from_cloud(f"{CLOUD_API_BASE}/pointcloud/{self.geohash}")
+        except HTTPException as e:
+            if e.status_code == 404 and negative is not None:
+                negative.add(self.geohash)
+            raise
+
+    # メッシュの LOD（None は最も粗いレベル）をエッジ→クラウドの順に探して返す
+    async def stream_mesh(self, lod: Optional[int]) -> Tuple[any, any, str, str, str]:
+        opened = await self._open_mesh(lod)
+        if opened is not None:
+            obj, st, key = opened
+            return obj, st, "edge", self.local_bucket, key
+
+        url = f"{CLOUD_API_BASE}/mesh/{self.geohash}"
+        return await self._from_cloud(url if lod is None else f"{url}?lod={lod}", "mesh")
+
+    # クラウド API への GET（404 / 416 / その他のエラーを HTTPException にする）
+    async def _get_cloud(self, cloud_url: str, headers: dict, what: str) -> httpx.Response:
+        resp = await self.cloud_http.get(cloud_url, headers)
+        if resp.status_code == 404:
+            await resp.aclose()
+            raise HTTPException(status_code=404, detail=f"{what} not found on edge nor cloud")
+        if resp.status_code == 416:
+            await resp.aclose()
+            raise HTTPException(
+                status_code=416, detail="range not satisfiable",
+                headers={"Content-Range": resp.headers.get("Content-Range", "")},
+            )
+        if resp.status_code >= 400:
+            await resp.aclose()
+            raise HTTPException(status_code=502, detail=f"cloud http get error: {resp.status_code}")
+        return resp
+
+    def _from_cache(self, entry: CacheEntry, result: str, cloud_url: str):
+        CLOUD_CACHE_REQUESTS.labels(result).inc()
+        return self.cloud_cache.open(entry), entry, "edge-cache", "cache", cloud_url
+
+    async def _from_cloud(self, cloud_url: str, what: str = "point cloud") -> Tuple[any, any, str, str, str]:
+        passthrough = {h: self.request_headers[h] for h in PASSTHROUGH_HEADERS if self.request_headers.get(h)}
+        cache = self.cloud_cache if self.cloud_cache is not None and self.cloud_cache.enabled else None
+        entry = cache.get(cloud_url) if cache is not None else None
+        try:
+            if entry is not None:
+                if cache.is_fresh(entry):
+                    return self._from_cache(entry, "hit", cloud_url)
+                # キャッシュの ETag で再検証（304 なら本体は転送されない）
+                try:
+                    resp = await self._get_cloud(cloud_url, {"If-None-Match": conditional.strong_etag(entry.etag)}, what)
+                except HTTPException as e:
+                    if e.status_code == 404:
+                        cache.invalidate(cloud_url)
+                    if e.status_code == 502:
+                        print(f"MEMO: serve stale cache for {cloud_url}: {e.detail}")
+                        return self._from_cache(entry, "stale", cloud_url)
+                    raise
+                if resp.status_code == 304:
+                    await resp.aclose()
+                    cache.touch(entry)
+                    return self._from_cache(entry, "revalidated", cloud_url)
+                # 更新されていた。範囲指定があるときはクライアントの条件で取り直す
+                if "Range" not in passthrough:
+                    return self._tee(cache, cloud_url, resp)
+                await resp.aclose()
+
+            # 範囲指定・条件付きでない取得は、同じ URL を取りに行っている他のリクエストと相乗りする
+            if self.flights is not None and not passthrough:
+                return await self._coalesced(cache, cloud_url, what)
+            resp = await self._get_cloud(cloud_url, passthrough, what)
+            if cache is not None and resp.status_code == 200:
+                return self._tee(cache, cloud_url, resp)
+            if cache is not None:
+                CLOUD_CACHE_REQUESTS.labels("bypass").inc()
+            return HttpBody(resp), resp.headers, "cloud-http", "http", cloud_url
+        except httpx.HTTPError as e:
+            if entry is not None:
+                # クラウドに届かないときは古いキャッシュでも返す
+                print(f"MEMO: serve stale cache for {cloud_url}: {e.__class__.__name__}")
+                return self._from_cache(entry, "stale", cloud_url)
+            raise HTTPException(status_code=502, detail=f"cloud http request error: {e.__class__.__name__}: {e}")
+
+    async def _coalesced(self, cache: Optional[CloudCache], cloud_url: str, what: str):
+        async def opener():
+            resp = await self._get_cloud(cloud_url, {}, what)
+            obj, headers = HttpBody(resp), resp.headers
+            if cache is not None:
+                obj, headers = self._tee(cache, cloud_url, resp)[:2]
+            length = headers.get("Content-Length")
+            return obj, headers, int(length) if length and length.isdigit() else None
+
+        obj, headers = await self.flights.open(cloud_url, opener)
+        return obj, headers, "cloud-http", "http", cloud_url
+
+    # クラウドの 200 応答をクライアントへ流しつつキャッシュへ書く
+    def _tee(self, cache: CloudCache, cloud_url: str, resp: httpx.Response):
+        body = HttpBody(resp)
+        tee = cache.tee(cloud_url, body, resp.headers)
+        CLOUD_CACHE_REQUESTS.labels("miss" if tee is not None else "bypass").inc()
+        return (tee or body), resp.headers, "cloud-http", "http", cloud_url
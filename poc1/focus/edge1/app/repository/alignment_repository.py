@@ -1,15 +1,19 @@
 from minio import Minio
 from minio.error import S3Error
-import tempfile, os
 import open3d as o3d
 from minio.commonconfig import CopySource
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 from sqlalchemy.orm import Session
 from sqlalchemy import text
+from repository import ply_codec
+from repository.async_s3 import AsyncS3
+import json
 
 class AlignmentRepository:
-    def __init__(self, mc: Minio):
+    # s3: MinIO への非同期アダプタ（webhook の取り込みのコピーをイベントループ上で行う。None なら a* の操作は使えない）
+    def __init__(self, mc: Minio, s3: Optional[AsyncS3] = None):
         self.mc = mc  # ← DBセッションは保持しない
+        self.s3 = s3
       
     # bucket+key の場所に点群データが存在するか確認する
     def check_folder_exists(self, bucket: str, key: str):
@@ -20,30 +24,28 @@ class AlignmentRepository:
               return None
           raise
     
-    # bucket+key の場所から点群データをダウンロードしてOpen3DのPointCloudとして返す
+    # bucket+key の場所から点群データをダウンロードしてOpen3DのPointCloudとして返す（一時ファイルを使わずストリームから直接パース）
     def download_ply(self, bucket: str, key: str) -> o3d.geometry.PointCloud:
-        with tempfile.NamedTemporaryFile(suffix=".ply", delete=False) as tf:
-            tmp = tf.name
+        resp = self.mc.get_object(bucket, key)
         try:
-            self.mc.fget_object(bucket, key, tmp)
-            pc = o3d.io.read_point_cloud(tmp)
-            return pc
+            return ply_codec.to_point_cloud(ply_codec.read_ply(resp))
         finally:
-            try: os.remove(tmp)
-            except FileNotFoundError: pass
+            resp.close()
+            resp.release_conn()
     
-    # bucket+key の場所にOpen3DのPointCloudをアップロードする        
-    def upload_ply(self, bucket: str, key: str, pc: o3d.geometry.PointCloud):
-        with tempfile.NamedTemporaryFile(suffix=".ply", delete=False) as tf:
-            tmp_out = tf.name
+    # bucket+key の場所から PLY をバイト列のまま取得する（デコードは ComputePool 側で行う）
+    def download_bytes(self, bucket: str, key: str) -> bytes:
+        resp = self.mc.get_object(bucket, key)
         try:
-            ok = o3d.io.write_point_cloud(tmp_out, pc)
-            if not ok:
-                raise RuntimeError("failed to write point cloud to temp file")
-            self.mc.fput_object(bucket, key, tmp_out, content_type="application/octet-stream")
+            return resp.read()
         finally:
-            try: os.remove(tmp_out)
-            except FileNotFoundError: pass
+            resp.close()
+            resp.release_conn()
+
+    # bucket+key の場所にOpen3DのPointCloudをアップロードする（binary PLY をチャンクで直接 put_object）
+    def upload_ply(self, bucket: str, key: str, pc: o3d.geometry.PointCloud):
+        body, length = ply_codec.encode_ply(ply_codec.from_point_cloud(pc))
+        return self.mc.put_object(bucket, key, body, length, content_type="application/octet-stream")
     
     # bucket+src_key の場所から点群データを bucket+dst_key にサーバサイドコピーする（uploadsとはminioで履歴用に使用しているフォルダーのこと）
     def copy_to_uploads(self, bucket: str, src_key: str, dst_key: str):
@@ -52,8 +54,17 @@ class AlignmentRepository:
             object_name=dst_key,
             source=CopySource(bucket, src_key),
         )
+
+    # copy_to_uploads の非同期版（スレッドを使わずにイベントループ上でコピーする）
+    async def acopy_to_uploads(self, bucket: str, src_key: str, dst_key: str):
+        await self.s3.copy_object(
+            bucket_name=bucket,
+            object_name=dst_key,
+            source=CopySource(bucket, src_key),
+        )
     
-    def save_pc_metadata(self, db: Session, geohash: str, geohash_level: int, filename: str, object_key: str, size_bytes: Optional[int], content_type: Optional[str]) -> Tuple[int, int]:
+    # transform は latest へ合成したときの 4x4 変換行列（合成していなければ None）
+    def save_pc_metadata(self, db: Session, geohash: str, geohash_level: int, filename: str, object_key: str, size_bytes: Optional[int], content_type: Optional[str], transform: Optional[list] = None) -> Tuple[int, int]:
 
         with db.begin():
             # 1) areas を1ステートメントで upsert して ID を取得（SELECT ... FOR UPDATE を避けてロック競合を緩和）
@@ -74,10 +85,11 @@ class AlignmentRepository:
             upload_res = db.execute(
                 text("""
                     INSERT INTO pc_uploaded_history
-                        (area_id, file_name, object_key, size_bytes, content_type)
+                        (area_id, file_name, object_key, size_bytes, content_type, transform)
                     VALUES
-                        (:area_id, :file_name, :object_key, :size_bytes, :content_type)
+                        (:area_id, :file_name, :object_key, :size_bytes, :content_type, :transform)
                     ON DUPLICATE KEY UPDATE
+                        transform = VALUES(transform),
                         id = LAST_INSERT_ID(id)
                 """),
                 {
@@ -86,8 +98,13 @@ class AlignmentRepository:
                     "object_key": object_key,
                     "size_bytes": size_bytes,
                     "content_type": content_type,
+                    "transform": json.dumps(transform) if transform is not None else None,
                 },
             )
             upload_id = upload_res.lastrowid
 
         return area_id, upload_id
+
+    # latest が作られたことのある geohash の一覧（負のキャッシュの Bloom filter に使う）
+    def list_geohashes(self, db: Session) -> List[str]:
+        return [r[0] for r in db.execute(text("SELECT geohash FROM areas")).all()]
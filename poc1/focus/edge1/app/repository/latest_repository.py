@@ -0,0 +1,296 @@
+# geohash ごとの latest モデルの読み書き
+#   single: {geohash}/latest/latest.ply の1オブジェクト（従来どおり）
+#   tiled : XY 平面を LATEST_TILE_SIZE[m] 四方のタイルに分け、タイルごとの PLY ＋ manifest.json で保持する
+import io, json, os
+import numpy as np
+import open3d as o3d
+from dataclasses import dataclass
+from datetime import datetime
+from minio import Minio
+from minio.error import S3Error
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+from repository import ply_codec
+from repository.object_stream import ObjectStream
+
+LATEST_LAYOUT = os.getenv("LATEST_LAYOUT", "single")
+LATEST_TILE_SIZE = float(os.getenv("LATEST_TILE_SIZE", "16.0"))
+
+NOT_FOUND_CODES = ("NoSuchKey", "NoSuchObject", "NotFound", "NoSuchBucket")
+
+# 合成で変化した範囲（(min_xyz, max_xyz) のリスト）
+Bounds = Sequence[Tuple[Sequence[float], Sequence[float]]]
+
+
+def _tile_xy(name: str) -> Tuple[int, int]:
+    x, y = name.split("_")
+    return int(x), int(y)
+
+
+# 共通する属性だけを連結する（空の配列は無視）
+def _concat_arrays(parts: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    parts = [p for p in parts if "points" in p and len(p["points"]) > 0]
+    if not parts:
+        return {"points": np.empty((0, 3))}
+    names = set.intersection(*(set(p) for p in parts))
+    return {n: np.concatenate([p[n] for p in parts]) for n in names}
+
+
+@dataclass
+class LatestStat:
+    """latest のバージョン情報（tiled では manifest の ETag がバージョンになる）"""
+
+    etag: str
+    size: int
+    last_modified: datetime
+
+
+# manifest のタイルを1つの PLY としてつなぐための (全点数のヘッダ, [(タイルのキー, 本体の先頭, 本体のバイト数)])
+#   各タイルのヘッダは読み飛ばし、本体だけをつなげる
+def tiled_body(manifest: dict) -> Tuple[bytes, List[Tuple[str, int, int]]]:
+    tiles = list(manifest["tiles"].values())
+    dtype = np.dtype([tuple(p) for p in manifest["properties"]])
+    header = ply_codec.ply_header(sum(t["points"] for t in tiles), dtype)
+    return header, [(t["key"], t["header_bytes"], t["bytes"] - t["header_bytes"]) for t in tiles]
+
+
+class TiledLatestObject:
+    """タイルを順に ranged get して1つの PLY として流す（get_city_model からは MinIO オブジェクトと同じに扱える）"""
+
+    def __init__(self, mc: Minio, bucket: str, manifest: dict):
+        self.mc = mc
+        self.bucket = bucket
+        self.header, self.parts = tiled_body(manifest)
+        self.size = len(self.header) + sum(length for _, _, length in self.parts)
+        self._resp = None
+
+    def stream(self, amt: int = 32 * 1024):
+        return self.stream_range(0, self.size - 1, amt)
+
+    # 連結した PLY の [start, end]（end を含む）を、重なるタイルだけ ranged get して流す
+    def stream_range(self, start: int, end: int, amt: int = 32 * 1024):
+        if start < len(self.header):
+            yield self.header[start:end + 1]
+        pos = len(self.header)
+        for key, offset, length in self.parts:
+            if pos > end:
+                break
+            lo, hi = max(start, pos), min(end, pos + length - 1)
+            pos += length
+            if lo > hi:
+                continue
+            self._resp = self.mc.get_object(self.bucket, key, offset=offset + lo - (pos - length), length=hi - lo + 1)
+            try:
+                yield from self._resp.stream(amt)
+            finally:
+                self.close()
+
+    def close(self):
+        if self._resp is not None:
+            self._resp.close()
+            self._resp.release_conn()
+            self._resp = None
+
+
+class LatestRepository:
+    # codec: PLY のデコード・エンコードを任せる先（decode_ply(bytes) / encode_ply(arrays)。ComputePool を渡す）
+    #   None なら呼び出し元スレッドでストリームのまま読み書きする
+    def __init__(self, mc: Minio, layout: str = LATEST_LAYOUT, tile_size: float = LATEST_TILE_SIZE, codec=None):
+        if layout not in ("single", "tiled"):
+            raise ValueError(f"unknown LATEST_LAYOUT: {layout} (choose from single, tiled)")
+        self.mc = mc
+        self.codec = codec
+        self.layout = layout
+        self.tile_size = tile_size
+
+    def latest_key(self, geohash: str) -> str:
+        return f"{geohash}/latest/latest.ply"
+
+    def manifest_key(self, geohash: str) -> str:
+        return f"{geohash}/latest/manifest.json"
+
+    def tile_key(self, geohash: str, tile: str, version: int) -> str:
+        return f"{geohash}/latest/tiles/{tile}-v{version}.ply"
+
+    # ログ・ヘッダ表示用の代表キー
+    def key(self, geohash: str) -> str:
+        return self.manifest_key(geohash) if self.layout == "tiled" else self.latest_key(geohash)
+
+    def _stat_or_none(self, bucket: str, key: str):
+        try:
+            return self.mc.stat_object(bucket, key)
+        except S3Error as e:
+            if e.code in NOT_FOUND_CODES:
+                return None
+            raise
+
+    def _read_manifest(self, bucket: str, geohash: str) -> Optional[Tuple[dict, str]]:
+        try:
+            resp = self.mc.get_object(bucket, self.manifest_key(geohash))
+        except S3Error as e:
+            if e.code in NOT_FOUND_CODES:
+                return None
+            raise
+        try:
+            return json.loads(resp.read()), resp.headers.get("ETag", "").strip('"')
+        finally:
+            resp.close()
+            resp.release_conn()
+
+    def _read_arrays(self, bucket: str, key: str) -> Dict[str, np.ndarray]:
+        resp = self.mc.get_object(bucket, key)
+        try:
+            if self.codec is None:
+                return ply_codec.read_ply(resp)
+            data = resp.read()
+        finally:
+            resp.close()
+            resp.release_conn()
+        return self.codec.decode_ply(data)
+
+    def _encode(self, arrays: Dict[str, np.ndarray]):
+        return (self.codec or ply_codec).encode_ply(arrays)
+
+    # latest のバージョン（無ければ None）
+    def stat(self, bucket: str, geohash: str) -> Optional[LatestStat]:
+        st = self._stat_or_none(bucket, self.key(geohash))
+        if st is None:
+            return None
+        return LatestStat(st.etag, st.size, st.last_modified)
+
+    # bounds（(min_xyz, max_xyz) のリスト）に重なるタイルの XY 番号
+    def tiles_of(self, bounds: Bounds) -> Set[Tuple[int, int]]:
+        tiles = set()
+        for lo, hi in bounds:
+            x0, y0 = np.floor(np.asarray(lo[:2]) / self.tile_size).astype(np.int64)
+            x1, y1 = np.floor(np.asarray(hi[:2]) / self.tile_size).astype(np.int64)
+            tiles.update((x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1))
+        return tiles
+
+    # loaded の範囲で読み込んだ latest だけで bounds の範囲を書き換えられるか（single は常に全体を読むので True）
+    def covers(self, loaded: Optional[Bounds], bounds: Bounds) -> bool:
+        if self.layout == "single" or loaded is None:
+            return True
+        return self.tiles_of(bounds) <= self.tiles_of(loaded)
+
+    def _load_tiles(self, bucket: str, tiles: Sequence[dict]) -> Dict[str, np.ndarray]:
+        return _concat_arrays([self._read_arrays(bucket, t["key"]) for t in tiles])
+
+    # latest を読み込む。tiled で bounds を渡すと重なるタイルだけを読む（bounds=None は全体）
+    def load(self, bucket: str, geohash: str, bounds: Optional[Bounds] = None) -> o3d.geometry.PointCloud:
+        if self.layout == "single":
+            return ply_codec.to_point_cloud(self._read_arrays(bucket, self.latest_key(geohash)))
+
+        found = self._read_manifest(bucket, geohash)
+        if found is None:
+            raise FileNotFoundError(f"latest manifest not found: {self.manifest_key(geohash)}")
+        tiles = found[0]["tiles"]
+        if bounds is not None:
+            wanted = self.tiles_of(bounds)
+            tiles = {name: t for name, t in tiles.items() if _tile_xy(name) in wanted}
+        return ply_codec.to_point_cloud(self._load_tiles(bucket, list(tiles.values())))
+
+    # GET /pointcloud 用に (ファイルライク, stat, key) を返す（無ければ None）
+    def open(self, bucket: str, geohash: str):
+        if self.layout == "single":
+            key = self.latest_key(geohash)
+            st = self._stat_or_none(bucket, key)
+            if st is None:
+                return None
+            return ObjectStream(self.mc, bucket, key, st.size), st, key
+
+        found = self._read_manifest(bucket, geohash)
+        if found is None:
+            return None
+        manifest, etag = found
+        obj = TiledLatestObject(self.mc, bucket, manifest)
+        st = LatestStat(etag, obj.size, datetime.fromisoformat(manifest["updated_at"]))
+        return obj, st, self.manifest_key(geohash)
+
+    # latest を保存してバージョン（ETag）を返す
+    # tiled では bounds に重なるタイルだけを書き換える（bounds=None は全タイル、空なら何もしない）
+    # loaded: pc が load(bounds=loaded) で読んだ一部のタイルだけのときの範囲（全タイルの書き直しになったら残りを読み足す）
+    def save(
+        self, bucket: str, geohash: str, pc: o3d.geometry.PointCloud,
+        bounds: Optional[Bounds] = None, loaded: Optional[Bounds] = None,
+    ) -> str:
+        arrays = ply_codec.from_point_cloud(pc)
+        if self.layout == "single":
+            body, length = self._encode(arrays)
+            result = self.mc.put_object(
+                bucket, self.latest_key(geohash), body, length, content_type="application/octet-stream"
+            )
+            return result.etag
+
+        found = self._read_manifest(bucket, geohash)
+        prev, prev_etag = found if found is not None else (None, None)
+        dtype = ply_codec.write_dtype(arrays)
+        properties = [[name, dtype[name].str] for name in dtype.names]
+        # レイアウトや属性が変わったときは全タイルを書き直す
+        rewrite_all = (
+            bounds is None or prev is None
+            or prev["tile_size"] != self.tile_size or prev["properties"] != properties
+        )
+        if not rewrite_all and not bounds:
+            return prev_etag
+        if rewrite_all and loaded is not None and prev is not None:
+            wanted = self.tiles_of(loaded)
+            rest = [t for name, t in prev["tiles"].items() if _tile_xy(name) not in wanted]
+            arrays = _concat_arrays([arrays, self._load_tiles(bucket, rest)])
+            dtype = ply_codec.write_dtype(arrays)
+            properties = [[name, dtype[name].str] for name in dtype.names]
+
+        points = arrays["points"]
+        cells = np.floor(points[:, :2] / self.tile_size).astype(np.int64)
+        uniq, inverse = np.unique(cells, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind="stable")
+        splits = np.cumsum(np.bincount(inverse, minlength=len(uniq)))[:-1]
+
+        touched = None if rewrite_all else self.tiles_of(bounds)
+
+        version = prev["version"] + 1 if prev is not None else 1
+        tiles = {} if rewrite_all else dict(prev["tiles"])
+        garbage = []
+        for (tx, ty), idx in zip(uniq.tolist(), np.split(order, splits)):
+            if touched is not None and (tx, ty) not in touched:
+                continue
+            name = f"{tx}_{ty}"
+            tile_arrays = {n: a[idx] for n, a in arrays.items()}
+            body, length = self._encode(tile_arrays)
+            key = self.tile_key(geohash, name, version)
+            self.mc.put_object(bucket, key, body, length, content_type="application/octet-stream")
+            if name in tiles:
+                garbage.append(tiles[name]["key"])
+            tiles[name] = {
+                "key": key,
+                "points": len(idx),
+                "bytes": length,
+                "header_bytes": len(ply_codec.ply_header(len(idx), dtype)),
+            }
+        if rewrite_all and prev is not None:
+            garbage = [t["key"] for t in prev["tiles"].values() if t["key"] not in {v["key"] for v in tiles.values()}]
+
+        manifest = {
+            "version": version,
+            "tile_size": self.tile_size,
+            "properties": properties,
+            "updated_at": datetime.now().astimezone().isoformat(),
+            "tiles": tiles,
+            # 置き換えたタイルは読み込み中のリクエストのために1世代残し、次の保存で消す
+            "garbage": garbage,
+        }
+        data = json.dumps(manifest).encode("utf-8")
+        result = self.mc.put_object(
+            bucket, self.manifest_key(geohash), io.BytesIO(data), len(data), content_type="application/json"
+        )
+        for key in (prev or {}).get("garbage", []):
+            try:
+                self.mc.remove_object(bucket, key)
+            except S3Error as e:
+                print(f"MEMO: failed to remove old tile {key}: {e.code}")
+        return result.etag
+
+    # 変化した範囲（位置合わせ済みアップロードの bounds）をまとめる
+    @staticmethod
+    def bounds_of(stats: List[dict]) -> Bounds:
+        return [s["bounds"] for s in stats if "bounds" in s]
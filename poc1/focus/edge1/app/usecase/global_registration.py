@@ -0,0 +1,96 @@
+# 大域位置合わせ（FPFH 特徴量マッチング）のバックエンド。GLOBAL_REGISTRATION で切り替える
+import os, time
+from abc import ABC, abstractmethod
+import open3d as o3d
+
+# ransac: 従来の RANSAC / fgr: Fast Global Registration / ransac_budget: 時間予算付き RANSAC
+GLOBAL_REGISTRATION = os.getenv("GLOBAL_REGISTRATION", "ransac")
+# ransac_budget: 1回の試行あたりの反復数・全体の時間予算[秒]・打ち切る fitness
+RANSAC_BUDGET_ROUND_ITERATIONS = int(os.getenv("RANSAC_BUDGET_ROUND_ITERATIONS", "20000"))
+RANSAC_BUDGET_SEC = float(os.getenv("RANSAC_BUDGET_SEC", "2.0"))
+RANSAC_BUDGET_TARGET_FITNESS = float(os.getenv("RANSAC_BUDGET_TARGET_FITNESS", "0.6"))
+RANSAC_CONFIDENCE = float(os.getenv("RANSAC_CONFIDENCE", "0.999"))
+
+
+class GlobalRegistration(ABC):
+    """source を target に合わせる初期姿勢を特徴量マッチングで求める。"""
+
+    name = ""
+
+    def __init__(self, distance: float):
+        self.distance = distance
+
+    # Open3D の RegistrationResult（transformation / fitness / inlier_rmse）を返す
+    @abstractmethod
+    def run(self, source, target, source_fpfh, target_fpfh):
+        ...
+
+
+class RansacRegistration(GlobalRegistration):
+    name = "ransac"
+
+    def _ransac(self, source, target, source_fpfh, target_fpfh, criteria):
+        return o3d.pipelines.registration.registration_ransac_based_on_feature_matching(
+            source,
+            target,
+            source_fpfh, target_fpfh,
+            mutual_filter=True,
+            max_correspondence_distance=self.distance,
+            estimation_method=o3d.pipelines.registration.TransformationEstimationPointToPoint(False),
+            ransac_n=4,
+            checkers=[
+                o3d.pipelines.registration.CorrespondenceCheckerBasedOnEdgeLength(0.9),
+                o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(self.distance)
+            ],
+            criteria=criteria,
+        )
+
+    def run(self, source, target, source_fpfh, target_fpfh):
+        return self._ransac(
+            source, target, source_fpfh, target_fpfh,
+            o3d.pipelines.registration.RANSACConvergenceCriteria(1000000, 1000),
+        )
+
+
+class BudgetedRansacRegistration(RansacRegistration):
+    """短い RANSAC を時間予算内で繰り返し、fitness が目標に届いた時点で打ち切る。"""
+
+    name = "ransac_budget"
+
+    def run(self, source, target, source_fpfh, target_fpfh):
+        criteria = o3d.pipelines.registration.RANSACConvergenceCriteria(
+            RANSAC_BUDGET_ROUND_ITERATIONS, RANSAC_CONFIDENCE
+        )
+        deadline = time.perf_counter() + RANSAC_BUDGET_SEC
+        best = None
+        while True:
+            result = self._ransac(source, target, source_fpfh, target_fpfh, criteria)
+            if best is None or result.fitness > best.fitness:
+                best = result
+            if best.fitness >= RANSAC_BUDGET_TARGET_FITNESS or time.perf_counter() >= deadline:
+                return best
+
+
+class FastGlobalRegistration(GlobalRegistration):
+    name = "fgr"
+
+    def run(self, source, target, source_fpfh, target_fpfh):
+        return o3d.pipelines.registration.registration_fgr_based_on_feature_matching(
+            source,
+            target,
+            source_fpfh, target_fpfh,
+            o3d.pipelines.registration.FastGlobalRegistrationOption(
+                maximum_correspondence_distance=self.distance * 0.5
+            ),
+        )
+
+
+GLOBAL_BACKENDS = {
+    cls.name: cls for cls in (RansacRegistration, BudgetedRansacRegistration, FastGlobalRegistration)
+}
+
+
+def get_global_registration(distance: float, name: str = GLOBAL_REGISTRATION) -> GlobalRegistration:
+    if name not in GLOBAL_BACKENDS:
+        raise ValueError(f"unknown GLOBAL_REGISTRATION: {name} (choose from {', '.join(GLOBAL_BACKENDS)})")
+    return GLOBAL_BACKENDS[name](distance)